@@ -8,4 +8,4 @@ The pybal package contains all PyBal modules
 from .version import *
 
 __all__ = ('ipvs', 'monitor', 'pybal', 'util', 'monitors', 'bgp',
-           'config', 'instrumentation', 'USER_AGENT_STRING')
+           'config', 'instrumentation', 'scheduler', 'USER_AGENT_STRING')
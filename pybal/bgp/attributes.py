@@ -45,6 +45,9 @@ ATTR_TYPE_MP_UNREACH_NLRI = 15
 
 ATTR_TYPE_INT_LAST_UPDATE = 256 + 1
 
+# Well-known communities
+COMMUNITY_GRACEFUL_SHUTDOWN = 0xFFFF0000 # RFC8326
+
 
 class Attribute(object):
     """
@@ -495,7 +498,7 @@ class MPReachNLRIAttribute(BaseMPAttribute):
         elif self.afi == bgp.AFI_INET6:
             nexthop = IPv6IP(packed=pnh)
 
-        nlri = self._parseNLRI(attrTuple, value[5+nhlen:])
+        nlri = self._parseNLRI(attrTuple, memoryview(value)[5+nhlen:])
 
         self.value = (self.afi, self.safi, nexthop, nlri)
 
@@ -537,7 +540,7 @@ class MPUnreachNLRIAttribute(BaseMPAttribute):
 
         self._unpackAFI(attrTuple)
 
-        nlri = self._parseNLRI(attrTuple, attrTuple[2][3:])
+        nlri = self._parseNLRI(attrTuple, memoryview(attrTuple[2])[3:])
 
         self.value = (self.afi, self.safi, nlri)
 
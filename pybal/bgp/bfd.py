@@ -0,0 +1,465 @@
+# bfd.py
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Bidirectional Forwarding Detection (RFC 5880) in asynchronous mode,
+for single hop IPv4/IPv6 peers (RFC 5881)
+"""
+
+# System imports
+import ctypes
+import logging
+import random
+import socket
+import struct
+
+# Twisted imports
+from twisted.internet import error, protocol
+import twisted.internet.reactor
+
+# Pybal imports :-(
+from pybal.metrics import Gauge
+from pybal.util import _log
+
+
+# Destination port of single hop BFD Control packets
+PORT = 3784
+# Range of the source ports
+SOURCE_PORT_MIN = 49152
+SOURCE_PORT_MAX = 65535
+
+# Single hop packets are sent, and must be received, with TTL 255 (GTSM)
+TTL = 255
+
+# Linux socket filter (classic BPF) accepting only packets with an IPv4
+# TTL or IPv6 Hop Limit of 255, read from the IP header at SKF_NET_OFF
+SO_ATTACH_FILTER = 26
+SKF_NET_OFF = 0xfff00000
+TTL_FILTER = [
+    (0x30, 0, 0, SKF_NET_OFF),          # ldb [net + 0]
+    (0x74, 0, 0, 4),                    # rsh #4
+    (0x15, 0, 2, 4),                    # jeq #4, v4, v6
+    (0x30, 0, 0, SKF_NET_OFF + 8),      # v4: ldb [net + 8]
+    (0x05, 0, 0, 2),                    # ja ttl
+    (0x15, 0, 3, 6),                    # v6: jeq #6, hl, drop
+    (0x30, 0, 0, SKF_NET_OFF + 7),      # hl: ldb [net + 7]
+    (0x15, 0, 1, TTL),                  # ttl: jeq #255, accept, drop
+    (0x06, 0, 0, 0xffffffff),           # accept: ret #-1
+    (0x06, 0, 0, 0),                    # drop: ret #0
+]
+
+VERSION = 1
+
+# Session states
+STATE_ADMIN_DOWN = 0
+STATE_DOWN = 1
+STATE_INIT = 2
+STATE_UP = 3
+
+stateDescr = {
+    STATE_ADMIN_DOWN: "AdminDown",
+    STATE_DOWN: "Down",
+    STATE_INIT: "Init",
+    STATE_UP: "Up"
+}
+
+# Diagnostic codes
+DIAG_NONE = 0
+DIAG_DETECTION_TIME_EXPIRED = 1
+DIAG_NEIGHBOR_DOWN = 3
+DIAG_ADMIN_DOWN = 7
+
+# Control packet flags
+FLAG_POLL = 0x20
+FLAG_FINAL = 0x10
+FLAG_CPI = 0x08
+FLAG_AUTH = 0x04
+FLAG_DEMAND = 0x02
+FLAG_MULTIPOINT = 0x01
+
+
+class BFDControlPacket(object):
+    """A BFD Control packet, without authentication section"""
+
+    FORMAT = '!BBBBIIIII'
+    LENGTH = struct.calcsize(FORMAT)
+
+    def __init__(self, state=STATE_DOWN, diag=DIAG_NONE, flags=0, detectMult=3,
+                 myDiscr=0, yourDiscr=0, desiredMinTx=0, requiredMinRx=0,
+                 requiredMinEchoRx=0):
+        self.state = state
+        self.diag = diag
+        self.flags = flags
+        self.detectMult = detectMult
+        self.myDiscr = myDiscr
+        self.yourDiscr = yourDiscr
+        # Intervals are in microseconds
+        self.desiredMinTx = desiredMinTx
+        self.requiredMinRx = requiredMinRx
+        self.requiredMinEchoRx = requiredMinEchoRx
+
+    def __repr__(self):
+        return repr(self.__dict__)
+
+    def encode(self):
+        return struct.pack(self.FORMAT,
+                           (VERSION << 5) | self.diag,
+                           (self.state << 6) | self.flags,
+                           self.detectMult,
+                           self.LENGTH,
+                           self.myDiscr,
+                           self.yourDiscr,
+                           self.desiredMinTx,
+                           self.requiredMinRx,
+                           self.requiredMinEchoRx)
+
+    @classmethod
+    def decode(cls, data):
+        """
+        Decodes a Control packet, and raises ValueError if it must be
+        discarded (RFC 5880 section 6.8.6)
+        """
+
+        if len(data) < cls.LENGTH:
+            raise ValueError("Packet too short")
+        (versionDiag, stateFlags, detectMult, length, myDiscr, yourDiscr,
+         desiredMinTx, requiredMinRx, requiredMinEchoRx) = struct.unpack_from(cls.FORMAT, data)
+
+        if versionDiag >> 5 != VERSION:
+            raise ValueError("Unsupported version {}".format(versionDiag >> 5))
+        if length < cls.LENGTH or length > len(data):
+            raise ValueError("Invalid length {}".format(length))
+        if detectMult == 0:
+            raise ValueError("Detect Mult is zero")
+        if stateFlags & FLAG_MULTIPOINT:
+            raise ValueError("Multipoint bit set")
+        if stateFlags & FLAG_AUTH:
+            raise ValueError("Authentication is not supported")
+        if myDiscr == 0:
+            raise ValueError("My Discriminator is zero")
+
+        return cls(state=stateFlags >> 6, diag=versionDiag & 0x1f,
+                   flags=stateFlags & 0x3f, detectMult=detectMult,
+                   myDiscr=myDiscr, yourDiscr=yourDiscr,
+                   desiredMinTx=desiredMinTx, requiredMinRx=requiredMinRx,
+                   requiredMinEchoRx=requiredMinEchoRx)
+
+
+def attachTTLFilter(sock):
+    """
+    Attaches TTL_FILTER to a socket, which then only receives packets
+    sent with TTL 255. Raises socket.error where it is not supported.
+    """
+
+    code = b''.join(struct.pack('HBBI', *insn) for insn in TTL_FILTER)
+    buf = ctypes.create_string_buffer(code, len(code))
+    # struct sock_fprog
+    fprog = struct.pack('HL', len(TTL_FILTER), ctypes.addressof(buf))
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+
+class BFDListener(protocol.DatagramProtocol):
+    """
+    Receives the BFD Control packets for all sessions, and hands them
+    to the session they belong to
+    """
+
+    def __init__(self):
+        self.sessions = {}          # by local discriminator
+        self.peerSessions = {}      # by peer address
+
+    def addSession(self, session):
+        """Registers a session, and gives it a unique discriminator"""
+
+        discr = random.randint(1, 2**32 - 1)
+        while discr in self.sessions:
+            discr = random.randint(1, 2**32 - 1)
+        session.localDiscr = discr
+        self.sessions[discr] = session
+        self.peerSessions[session.peerAddr] = session
+
+    def startProtocol(self):
+        # Packets must arrive with TTL 255 (RFC 5881 section 5). Python 2
+        # can't read the TTL of received packets (no recvmsg), and Linux
+        # doesn't apply IP_MINTTL to UDP, so a socket filter drops them
+        try:
+            attachTTLFilter(self.transport.getHandle())
+        except socket.error as e:
+            _log("Could not enforce the TTL of received BFD packets: {}".format(e),
+                 logging.WARN, "bfd")
+
+    def removeSession(self, session):
+        self.sessions.pop(session.localDiscr, None)
+        if self.peerSessions.get(session.peerAddr) is session:
+            del self.peerSessions[session.peerAddr]
+
+    def datagramReceived(self, data, (host, port)):
+        # IPv4 peers on a dual stack socket
+        if host.startswith('::ffff:') and '.' in host:
+            host = host[7:]
+
+        try:
+            packet = BFDControlPacket.decode(data)
+        except ValueError as e:
+            _log("Discarding BFD packet from {}: {}".format(host, e), logging.DEBUG, "bfd")
+            return
+
+        if packet.yourDiscr != 0:
+            session = self.sessions.get(packet.yourDiscr)
+            if session is None or session.peerAddr != host:
+                return
+        elif packet.state not in (STATE_DOWN, STATE_ADMIN_DOWN):
+            # A peer that doesn't know our discriminator can only be
+            # Down (RFC 5880 section 6.8.6)
+            return
+        else:
+            # E.g. a new peer, or one that has restarted
+            session = self.peerSessions.get(host)
+            if session is None:
+                return
+
+        session.packetReceived(packet)
+
+
+class BFDSession(protocol.DatagramProtocol):
+    """
+    Asynchronous mode BFD session with a single peer, in the Active
+    role. The session sends its Control packets from its own UDP
+    source port, and receives through a BFDListener.
+    """
+
+    # Transmit interval (microseconds) while the session is not up
+    SLOW_TX_INTERVAL = 1000000
+
+    metric_keywords = {
+        'labelnames': ('peer',),
+        'namespace': 'pybal',
+        'subsystem': 'bgp'
+    }
+
+    metrics = {
+        'bfd_session_state': Gauge(
+            'bfd_session_state',
+            'BFD session state (0: AdminDown, 1: Down, 2: Init, 3: Up)',
+            **metric_keywords)
+    }
+
+    reactor = twisted.internet.reactor
+
+    def __init__(self, listener, peerAddr, peerPort=PORT, desiredMinTx=300000,
+                 requiredMinRx=300000, detectMult=3):
+        self.listener = listener
+        self.peerAddr = peerAddr
+        self.peerPort = peerPort
+        self.localDiscr = 0
+        self.state = STATE_DOWN
+        self.localDiag = DIAG_NONE
+        self.desiredMinTx = desiredMinTx
+        self.requiredMinRx = requiredMinRx
+        self.detectMult = detectMult
+
+        self.remoteDiscr = 0
+        self.remoteState = STATE_DOWN
+        self.remoteMinRx = 1
+        self.remoteMinTx = 0
+        self.remoteDetectMult = 0
+
+        # Whether a Poll Sequence is in progress
+        self.polling = False
+        self.transmitCall = None
+        self.detectionCall = None
+
+        # Callables called with (session, up) when the session goes
+        # up or down
+        self.stateCallbacks = []
+
+        self.metric_labels = {'peer': peerAddr}
+        self.metrics['bfd_session_state'].labels(**self.metric_labels).set(self.state)
+
+        listener.addSession(self)
+
+    def log(self, msg, lvl=logging.DEBUG):
+        _log(msg, lvl, "bfd.BFDSession@{}".format(self.peerAddr))
+
+    def start(self):
+        """Binds the source port, and starts sending Control packets"""
+
+        interface = '::' if ':' in self.peerAddr else ''
+        port = random.randint(SOURCE_PORT_MIN, SOURCE_PORT_MAX)
+        for i in range(SOURCE_PORT_MAX - SOURCE_PORT_MIN + 1):
+            try:
+                self.reactor.listenUDP(port, self, interface=interface)
+            except error.CannotListenError:
+                port = SOURCE_PORT_MIN + (port + 1 - SOURCE_PORT_MIN) % (
+                    SOURCE_PORT_MAX - SOURCE_PORT_MIN + 1)
+            else:
+                break
+        else:
+            raise error.CannotListenError(interface, port, "No BFD source port available")
+
+        self.log("BFD session started", logging.INFO)
+        self._scheduleTransmit()
+
+    def startProtocol(self):
+        sock = self.transport.getHandle()
+        if sock.family == socket.AF_INET6:
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_UNICAST_HOPS, TTL)
+        else:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_TTL, TTL)
+
+    def stop(self):
+        """
+        Takes the session administratively down, and tells the peer so
+        it doesn't consider it a failure
+        """
+
+        self._setState(STATE_ADMIN_DOWN, DIAG_ADMIN_DOWN)
+        self._sendControl()
+        for call in (self.transmitCall, self.detectionCall):
+            if call is not None and call.active():
+                call.cancel()
+        self.listener.removeSession(self)
+        if self.transport is not None:
+            self.transport.stopListening()
+
+    def packetReceived(self, packet):
+        """Processes a received Control packet (RFC 5880 section 6.8.6)"""
+
+        self.remoteDiscr = packet.myDiscr
+        self.remoteState = packet.state
+        self.remoteMinRx = packet.requiredMinRx
+        self.remoteMinTx = packet.desiredMinTx
+        self.remoteDetectMult = packet.detectMult
+
+        if packet.flags & FLAG_FINAL and self.polling:
+            self.polling = False
+
+        if self.state == STATE_ADMIN_DOWN:
+            return
+
+        self._restartDetectionTimer()
+
+        if packet.state == STATE_ADMIN_DOWN:
+            if self.state != STATE_DOWN:
+                self._setState(STATE_DOWN, DIAG_NEIGHBOR_DOWN)
+        elif self.state == STATE_DOWN:
+            if packet.state == STATE_DOWN:
+                self._setState(STATE_INIT)
+            elif packet.state == STATE_INIT:
+                self._setState(STATE_UP)
+        elif self.state == STATE_INIT:
+            if packet.state in (STATE_INIT, STATE_UP):
+                self._setState(STATE_UP)
+        elif packet.state == STATE_DOWN:
+            # State Up
+            self._setState(STATE_DOWN, DIAG_NEIGHBOR_DOWN)
+
+        if packet.flags & FLAG_POLL:
+            self._sendControl(FLAG_FINAL)
+
+        # The remote's RequiredMinRx may have changed
+        self._scheduleTransmit()
+
+    def _setState(self, state, diag=DIAG_NONE):
+        if state == self.state:
+            return
+
+        wasUp = self.state == STATE_UP
+        self.log("BFD session {} -> {}".format(
+            stateDescr[self.state], stateDescr[state]),
+            logging.INFO if STATE_UP in (state, self.state) else logging.DEBUG)
+        self.state = state
+        self.localDiag = diag
+        self.metrics['bfd_session_state'].labels(**self.metric_labels).set(state)
+
+        # The transmit interval changes between the slow rate and the
+        # desired rate, which the peer confirms with a Poll Sequence
+        if (state == STATE_UP) != wasUp:
+            self.polling = state != STATE_ADMIN_DOWN
+            for callback in self.stateCallbacks:
+                callback(self, state == STATE_UP)
+
+    def _detectionTime(self):
+        """Returns the Detection Time in microseconds"""
+
+        return self.remoteDetectMult * max(self.requiredMinRx, self.remoteMinTx)
+
+    def _restartDetectionTimer(self):
+        if self.detectionCall is not None and self.detectionCall.active():
+            self.detectionCall.cancel()
+        self.detectionCall = self.reactor.callLater(
+            self._detectionTime() / 1e6, self._detectionTimeExpired)
+
+    def _detectionTimeExpired(self):
+        # The peer is only forgotten once it has gone silent, so a peer
+        # that signalled Down can still match our packets to its session
+        # (RFC 5880 section 6.8.1)
+        self.remoteDiscr = 0
+        if self.state in (STATE_INIT, STATE_UP):
+            self.log("BFD Detection Time expired", logging.INFO)
+            self._setState(STATE_DOWN, DIAG_DETECTION_TIME_EXPIRED)
+            self._scheduleTransmit()
+
+    def _localDesiredMinTx(self):
+        if self.state == STATE_UP:
+            return self.desiredMinTx
+        return max(self.desiredMinTx, self.SLOW_TX_INTERVAL)
+
+    def _scheduleTransmit(self):
+        """(Re)schedules the next periodic Control packet"""
+
+        if self.transmitCall is not None and self.transmitCall.active():
+            remaining = self.transmitCall.getTime() - self.reactor.seconds()
+        else:
+            remaining = None
+        if self.state == STATE_ADMIN_DOWN or self.remoteMinRx == 0:
+            # The peer doesn't want any packets
+            if remaining is not None:
+                self.transmitCall.cancel()
+            return
+
+        interval = max(self._localDesiredMinTx(), self.remoteMinRx) / 1e6
+        # Jitter of up to 25%, or 10% with a Detect Mult of 1
+        interval *= random.uniform(0.75, 0.9 if self.detectMult == 1 else 1.0)
+        if remaining is not None:
+            if remaining <= interval:
+                return
+            self.transmitCall.cancel()
+        self.transmitCall = self.reactor.callLater(interval, self._transmit)
+
+    def _transmit(self):
+        self.transmitCall = None
+        self._sendControl()
+        self._scheduleTransmit()
+
+    def _sendControl(self, flags=0):
+        if self.transport is None:
+            return
+
+        if self.polling and not flags & FLAG_FINAL:
+            flags |= FLAG_POLL
+        packet = BFDControlPacket(
+            state=self.state,
+            diag=self.localDiag,
+            flags=flags,
+            detectMult=self.detectMult,
+            myDiscr=self.localDiscr,
+            yourDiscr=self.remoteDiscr,
+            desiredMinTx=self._localDesiredMinTx(),
+            requiredMinRx=self.requiredMinRx)
+        try:
+            self.transport.write(packet.encode(), (self.peerAddr, self.peerPort))
+        except socket.error as e:
+            self.log("Could not send BFD packet: {}".format(e))
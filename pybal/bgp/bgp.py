@@ -144,6 +144,7 @@ class BGPUpdateMessage(BGPMessage):
         super(BGPUpdateMessage, self).__init__()
         self.msg = (self.msg[0], bytearray(2), bytearray(2), bytearray())
         self.withdrCount, self.attrCount, self.nlriCount = 0, 0, 0
+        self._updateMsgLen()
 
     def __repr__(self):
         return (super(BGPUpdateMessage, self).__repr__()[:-1]
@@ -210,7 +211,9 @@ class BGP(protocol.Protocol):
         self.fsm = None
 
         self.disconnected = False
-        self.receiveBuffer = ''
+        # Received data, parsed in place from receiveOffset
+        self.receiveBuffer = bytearray()
+        self.receiveOffset = 0
 
     def peerAddrStr(self):
         if self.transport:
@@ -277,11 +280,21 @@ class BGP(protocol.Protocol):
         """
 
         # Buffer possibly incomplete data first
-        self.receiveBuffer += data
+        try:
+            self.receiveBuffer.extend(data)
+        except BufferError:
+            # A view on the buffer is still alive, don't resize it
+            self.receiveBuffer = self.receiveBuffer + data
 
         # Attempt to parse as many messages as possible
         while(self.parseBuffer()): pass
 
+        # Drop the parsed messages, copying only the (incomplete)
+        # remainder once per read rather than once per message
+        if self.receiveOffset:
+            self.receiveBuffer = self.receiveBuffer[self.receiveOffset:]
+            self.receiveOffset = 0
+
     def closeConnection(self):
         """Close the connection"""
 
@@ -324,7 +337,7 @@ class BGP(protocol.Protocol):
         self.log("Sending BGP message: %s" % repr(bgpMessage))
 
         # FIXME: Twisted on Python 2 doesn't support bytearrays
-        self.transport.writeSequence(bytes(bgpMessage))
+        self.transport.write(bytes(bgpMessage))
 
     def constructOpen(self):
         """Constructs a BGP Open message"""
@@ -386,9 +399,13 @@ class BGP(protocol.Protocol):
             return None
 
     def parseBuffer(self):
-        """Parse received data in receiveBuffer"""
+        """
+        Parse the next message in receiveBuffer, at receiveOffset.
+        The message is parsed in place: the parsers get memoryviews
+        on the buffer rather than copies.
+        """
 
-        buf = self.receiveBuffer
+        buf = memoryview(self.receiveBuffer)[self.receiveOffset:]
 
         if len(buf) < HDR_LEN:
             # Every BGP message is at least 19 octets. Maybe the rest
@@ -402,7 +419,7 @@ class BGP(protocol.Protocol):
 
         # Parse the header
         try:
-            marker, length, type = struct.unpack('!16sHB', buf[:HDR_LEN])
+            length, type = struct.unpack_from('!HB', buf, 16)
         except struct.error:
             self.fsm.headerError(ERR_MSG_HDR_CONN_NOT_SYNC)
 
@@ -433,7 +450,7 @@ class BGP(protocol.Protocol):
             self.deferred.errback(e)
 
         # Message successfully processed, jump to next message
-        self.receiveBuffer = self.receiveBuffer[length:]
+        self.receiveOffset += length
         return True
 
     def parseOpen(self, message):
@@ -465,10 +482,11 @@ class BGP(protocol.Protocol):
     def parseUpdate(self, message):
         """Parses a BGP Update message"""
 
+        message = memoryview(message)
         try:
-            withdrawnLen = struct.unpack('!H', message[:2])[0]
+            withdrawnLen = struct.unpack_from('!H', message)[0]
             withdrawnPrefixesData = message[2:withdrawnLen+2]
-            attrLen = struct.unpack('!H', message[withdrawnLen+2:withdrawnLen+4])[0]
+            attrLen = struct.unpack_from('!H', message, withdrawnLen+2)[0]
             attributesData = message[withdrawnLen+4:withdrawnLen+4+attrLen]
             nlriData = message[withdrawnLen+4+attrLen:]
 
@@ -499,12 +517,13 @@ class BGP(protocol.Protocol):
     def parseNotification(self, message):
         """Parses a BGP Notification message"""
 
+        message = memoryview(message)
         try:
-            error, suberror = struct.unpack('!BB', message[:2])
+            error, suberror = struct.unpack_from('!BB', message)
         except struct.error:
             raise BadMessageLength(self)
 
-        return error, suberror, message[2:]
+        return error, suberror, message[2:].tobytes()
 
     def openReceived(self, version, ASN, holdTime, bgpId):
         """Called when a BGP Open message was received."""
@@ -580,16 +599,35 @@ class BGP(protocol.Protocol):
         for afi, safi in list(self.factory.addressFamilies):
             capabilities.append((CAP_MP_EXT, struct.pack('!HBB', afi, 0, safi)))
 
+        if self.factory.restartTime is not None:
+            capabilities.append((CAP_GRACEFUL_RESTART, self.constructGracefulRestart()))
+
         return capabilities
 
+    def constructGracefulRestart(self):
+        """
+        Constructs the value of a Graceful Restart capability (RFC 4724),
+        with the Forwarding State bit set for all address families: LVS
+        keeps forwarding while PyBal restarts.
+        """
+
+        flags = self.factory.restarting and GR_RESTART_STATE or 0
+        restartTime = min(self.factory.restartTime, GR_MAX_RESTART_TIME)
+        value = struct.pack('!H', (flags << 12) | restartTime)
+        for afi, safi in sorted(self.factory.addressFamilies):
+            value += struct.pack('!HBB', afi, safi, GR_FORWARDING_STATE)
+
+        return value
+
     @staticmethod
     def parseEncodedPrefixList(data, addressFamily=AFI_INET):
         """Parses an RFC4271 encoded blob of BGP prefixes into a list"""
 
+        data = memoryview(data)
         prefixes = []
-        postfix = data
-        while len(postfix) > 0:
-            prefixLen = ord(postfix[0])
+        offset = 0
+        while offset < len(data):
+            prefixLen = ord(data[offset])
             if (addressFamily == AFI_INET and prefixLen > 32
                 ) or (addressFamily == AFI_INET6 and prefixLen > 128):
                 raise BGPException(ERR_MSG_UPDATE, ERR_MSG_UPDATE_INVALID_NETWORK_FIELD)
@@ -599,36 +637,39 @@ class BGP(protocol.Protocol):
                 # prefix length doesn't fall on octet boundary
                 octetLen += 1
 
-            prefixData = map(ord, postfix[1:octetLen+1])
+            prefixData = data[offset+1:offset+octetLen+1].tobytes()
             # Zero the remaining bits in the last octet if it didn't fall
             # on an octet boundary
             if remainder > 0:
-                prefixData[-1] = prefixData[-1] & (255 << (8-remainder))
+                prefixData = prefixData[:-1] + chr(
+                    ord(prefixData[-1]) & (255 << (8-remainder)) & 255)
 
             prefixes.append(IPPrefix((prefixData, prefixLen), addressFamily))
 
             # Next prefix
-            postfix = postfix[octetLen+1:]
+            offset += octetLen + 1
 
         return prefixes
 
     @staticmethod
     def parseEncodedAttributes(data):
-        """Parses an RFC4271 encoded blob of BGP prefixes into a list"""
+        """Parses an RFC4271 encoded blob of BGP attributes into a list"""
 
+        data = memoryview(data)
         attributes = []
-        postfix = data
-        while len(postfix) > 0:
-            flags, typeCode = struct.unpack('!BB', postfix[:2])
+        offset = 0
+        while offset < len(data):
+            flags, typeCode = struct.unpack_from('!BB', data, offset)
 
             if flags & ATTR_EXTENDED_LEN:
-                attrLen = struct.unpack('!H', postfix[2:4])[0]
-                value = postfix[4:4+attrLen]
-                postfix = postfix[4+attrLen:]    # Next attribute
+                attrLen = struct.unpack_from('!H', data, offset+2)[0]
+                offset += 4
             else:    # standard 1-octet length
-                attrLen = ord(postfix[2])
-                value = postfix[3:3+attrLen]
-                postfix = postfix[3+attrLen:]    # Next attribute
+                attrLen = ord(data[offset+2])
+                offset += 3
+            # Attributes outlive the receive buffer, so copy the value
+            value = data[offset:offset+attrLen].tobytes()
+            offset += attrLen    # Next attribute
 
             attribute = (flags, typeCode, value)
             attributes.append(attribute)
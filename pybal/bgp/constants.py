@@ -80,6 +80,12 @@ OPEN_PARAM_CAPABILITIES = 2
 CAP_MP_EXT = 1
 CAP_ROUTE_REFRESH = 2
 CAP_ORF = 3
+CAP_GRACEFUL_RESTART = 64
+
+# Graceful Restart capability flags (RFC 4724)
+GR_RESTART_STATE = 0x8
+GR_FORWARDING_STATE = 0x80
+GR_MAX_RESTART_TIME = 4095
 
 AFI_INET = 1
 AFI_INET6 = 2
@@ -205,6 +205,32 @@ class FSM(object):
             self.state = ST_IDLE
             raise NotificationSent(self.protocol, ERR_CEASE, 0)
 
+    def gracefulStop(self):
+        """
+        Stops the session for a graceful restart (RFC 4724): closes the
+        connection without sending a NOTIFICATION and without releasing
+        resources, so that the peer retains our routes while we restart.
+        """
+
+        if self.state != ST_IDLE:
+            # Stop all timers
+            for timer in (self.connectRetryTimer, self.holdTimer, self.keepAliveTimer,
+                          self.delayOpenTimer, self.idleHoldTimer):
+                timer.cancel()
+            self._closeConnection()
+            self.connectRetryCounter = 0
+            self.state = ST_IDLE
+
+    def bfdDown(self):
+        """
+        Should be called when the BFD session with the peer went down
+        (RFC 5882). The connection is treated as failed (event 18) if
+        it has carried BGP messages.
+        """
+
+        if self.state in (ST_OPENCONFIRM, ST_ESTABLISHED):
+            self.connectionFailed()
+
     def automaticStart(self, idleHold=False):
         """
         Should be called when a BGP Automatic Start event (event 3) is requested.
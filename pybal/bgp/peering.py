@@ -15,6 +15,8 @@
 
 
 # Python imports
+import collections
+import functools
 import logging
 
 # Zope imports
@@ -30,10 +32,11 @@ from attributes import AttributeDict, FrozenAttributeDict
 from attributes import MPReachNLRIAttribute, MPUnreachNLRIAttribute
 from exceptions import BGPException, NotificationSent
 from bgp import BGP, BGPUpdateMessage
+from bfd import STATE_ADMIN_DOWN
 from fsm import FSM
 
 # Pybal imports :-(
-from pybal.metrics import Gauge
+from pybal.metrics import Counter, Gauge
 from pybal.util import _log
 
 
@@ -160,6 +163,12 @@ class BGPPeering(BGPFactory):
         self.outConnections = []
         self.estabProtocol = None    # reference to the BGPProtocol instance in ESTAB state
         self.consumers = set()
+        # Callables called with (peering, established) on session state changes
+        self.sessionCallbacks = []
+        # Graceful restart (RFC 4724) restart time in seconds, None if disabled
+        self.restartTime = None
+        # Whether we have (re)started and not sent End-of-RIB yet
+        self.restarting = True
 
         self.metric_labels = {
             'local_asn': self.myASN,
@@ -180,6 +189,8 @@ class BGPPeering(BGPFactory):
                      (msg, self.myASN, self.peerAddr),
                      logging.INFO)
             self.metrics['bgp_session_established'].labels(**self.metric_labels).set(metric_value)
+            for callback in self.sessionCallbacks:
+                callback(self, bool(value))
         #  old style class, super().__setattr__() doesn't work
         #  https://docs.python.org/2/reference/datamodel.html#customizing-attribute-access
         self.__dict__[name] = value
@@ -262,6 +273,32 @@ class BGPPeering(BGPFactory):
 
         return defer.succeed(True)
 
+    def gracefulStop(self):
+        """
+        Stops the session(s) for a graceful restart, leaving our routes
+        with the peer. Returns a Deferred that will fire once the
+        connection(s) have closed.
+        """
+
+        for c in self.inConnections + self.outConnections:
+            c.fsm.gracefulStop()
+
+        return defer.succeed(True)
+
+    def bfdStateChanged(self, session, up):
+        """
+        Called when the BFD session with the peer went up or down.
+        Closes the BGP connection(s) when the peer has become unreachable.
+        """
+
+        if up or STATE_ADMIN_DOWN in (session.state, session.remoteState):
+            # BFD was disabled on either side, which is not a failure
+            return
+
+        self.log("BFD session with peer %s down" % self.peerAddr, logging.INFO)
+        for c in self.inConnections + self.outConnections:
+            c.fsm.bfdDown()
+
     def automaticStart(self, idleHold=False):
         """BGP AutomaticStart event (event 3 or 5)"""
 
@@ -461,6 +498,62 @@ class BGPPeering(BGPFactory):
 
         self.addressFamilies = addressFamilies
 
+class UpdateCache(object):
+    """
+    Shared Adj-RIB-Out for peerings that get identical advertisements.
+    Encodes the UPDATE messages for each distinct change set once, and
+    hands the same messages to every peering sending that change set.
+    """
+
+    # Number of recent change sets to keep the messages of
+    MAX_ENTRIES = 32
+
+    metric_keywords = {
+        'namespace': 'pybal',
+        'subsystem': 'bgp'
+    }
+
+    metrics = {
+        'update_cache_hits_total': Counter(
+            'update_cache_hits_total',
+            'Change sets sent from previously encoded UPDATE messages',
+            **metric_keywords),
+        'update_cache_misses_total': Counter(
+            'update_cache_misses_total',
+            'Change sets encoded into UPDATE messages',
+            **metric_keywords)
+    }
+
+    def __init__(self):
+        self.entries = collections.OrderedDict()
+
+    def getUpdates(self, addressfamily, withdrawals, attributeMap, encode):
+        """
+        Returns the list of UPDATE messages for a change set of
+        withdrawals and updates (attributeMap), calling
+        encode(withdrawals, attributeMap) for change sets not seen before.
+        """
+
+        key = (addressfamily,
+               frozenset(w.prefix for w in withdrawals),
+               frozenset((attributes, frozenset(ad.prefix for ad in advertisements))
+                         for attributes, advertisements in attributeMap.iteritems()))
+        try:
+            messages = self.entries.pop(key)
+        except KeyError:
+            messages = encode(withdrawals, attributeMap)
+            self.metrics['update_cache_misses_total'].inc()
+        else:
+            self.metrics['update_cache_hits_total'].inc()
+
+        # Most recently used last
+        self.entries[key] = messages
+        while len(self.entries) > self.MAX_ENTRIES:
+            self.entries.popitem(last=False)
+
+        return messages
+
+
 class NaiveBGPPeering(BGPPeering):
     """
     "Naive" class managing a simple BGP session, not optimized for very many
@@ -474,6 +567,16 @@ class NaiveBGPPeering(BGPPeering):
         self.advertised = {}
         self.toAdvertise = {}
 
+        # Encoded UPDATE messages, may be shared with other peerings
+        self.updateCache = UpdateCache()
+
+        # Minimum Route Advertisement Interval (RFC 4271 9.2.1.1) in
+        # seconds. Changes made within the interval after an update are
+        # sent together at its end. 0 sends every change immediately.
+        self.mrai = 0
+        self.mraiCall = None
+        self.lastUpdateTime = None
+
     def completeInit(self, protocol):
         """
         Called by FSM when BGP resources should be initialized.
@@ -490,7 +593,15 @@ class NaiveBGPPeering(BGPPeering):
         ready for sending announcements.
         """
 
-        self._sendUpdates(self.advertised, self.toAdvertise)
+        # The initial update includes any pending changes
+        self._cancelMRAI()
+        if self._sendUpdates(self.advertised, self.toAdvertise):
+            self.lastUpdateTime = self.reactor.seconds()
+
+        if self.restartTime is not None:
+            # The initial update is complete
+            self._sendEndOfRIB()
+            self.restarting = False
 
     def setAdvertisements(self, advertisements):
         """
@@ -502,8 +613,37 @@ class NaiveBGPPeering(BGPPeering):
             self.advertised.setdefault(af, set())
             self.toAdvertise[af] = {ad for ad in iter(advertisements) if ad.addressfamily == af}
 
-        # Try to send
-        self._sendUpdates(*self._calculateChanges())
+        if self.mraiCall is not None:
+            # Goes out with the pending batch
+            return
+
+        wait = 0
+        if self.mrai and self.lastUpdateTime is not None:
+            wait = self.lastUpdateTime + self.mrai - self.reactor.seconds()
+        if wait > 0:
+            self.mraiCall = self.reactor.callLater(wait, self.flushUpdates)
+        else:
+            self.flushUpdates()
+
+    def flushUpdates(self):
+        """
+        Sends the changes made since the last update now, without
+        waiting for the rest of the MRAI.
+        """
+
+        self._cancelMRAI()
+        withdrawals, updates = self._calculateChanges()
+        if not any(withdrawals.values()) and not any(updates.values()):
+            return
+
+        # Try to send, the interval only starts once something was sent
+        if self._sendUpdates(withdrawals, updates):
+            self.lastUpdateTime = self.reactor.seconds()
+
+    def _cancelMRAI(self):
+        if self.mraiCall is not None and self.mraiCall.active():
+            self.mraiCall.cancel()
+        self.mraiCall = None
 
     def _calculateChanges(self):
         """Calculates the needed updates (for all address (sub)families)
@@ -513,8 +653,12 @@ class NaiveBGPPeering(BGPPeering):
 
         withdrawals, updates = {}, {}
         for af in set(self.advertised.keys() + self.toAdvertise.keys()):
-            withdrawals[af] = self.advertised[af] - self.toAdvertise[af]
             updates[af] = self.toAdvertise[af] - self.advertised[af]
+            # Announcing a prefix again implicitly withdraws its previous
+            # route, it shouldn't be in both withdrawals and updates
+            announced = {ad.prefix for ad in updates[af]}
+            withdrawals[af] = {ad for ad in self.advertised[af] - self.toAdvertise[af]
+                               if ad.prefix not in announced}
 
         return withdrawals, updates
 
@@ -525,12 +669,12 @@ class NaiveBGPPeering(BGPPeering):
         updates (both per (AFI, SAFI) combination), sorts them to
         equal attributes and sends the advertisements if possible.
         Assumes that self.toAdvertise reflects the advertised state
-        after withdrawals and updates.
+        after withdrawals and updates. Returns whether they were sent.
         """
 
         # This may have to wait for another time...
         if not self.estabProtocol or self.fsm.state != ST_ESTABLISHED:
-            return
+            return False
 
         # Process per (AFI, SAFI) pair
         for af in set(withdrawals.keys() + updates.keys()):
@@ -552,6 +696,25 @@ class NaiveBGPPeering(BGPPeering):
 
             self.advertised[af] = self.toAdvertise[af]
 
+        return True
+
+    def _sendEndOfRIB(self):
+        """
+        Sends the End-of-RIB marker (RFC 4724) for every address family:
+        an empty UPDATE for inet unicast, and an UPDATE with an empty
+        MP Unreach NLRI attribute for the others.
+        """
+
+        if not self.estabProtocol or self.fsm.state != ST_ESTABLISHED:
+            return
+
+        for af in sorted(self.addressFamilies):
+            bgpupdate = BGPUpdateMessage()
+            if af != (AFI_INET, SAFI_UNICAST):
+                bgpupdate.addAttributes(FrozenAttributeDict(
+                    [MPUnreachNLRIAttribute(af + ([], ))]))
+            self.estabProtocol.sendMessage(bgpupdate)
+
     def _sendInetUnicastUpdates(self, withdrawals, attributeMap):
         """
         Sends (multiple) UPDATE messages for the inet-unicast way,
@@ -562,6 +725,35 @@ class NaiveBGPPeering(BGPPeering):
         - attributeMap: a dict of FrozenAttributeDict to updates sets
         """
 
+        for bgpupdate in self.updateCache.getUpdates(
+                (AFI_INET, SAFI_UNICAST), withdrawals, attributeMap,
+                self._encodeInetUnicastUpdates):
+            self.estabProtocol.sendMessage(bgpupdate)
+
+    def _sendMPUpdates(self, addressfamily, withdrawals, attributeMap):
+        """
+        Sends (multiple) UPDATE messages the RFC4760 way.
+
+        Arguments:
+        - addressfamily: (AFI, SAFI) tuple
+        - withdrawals: a set of advertisements to withdraw
+        - attributeMap: a dict of FrozenAttributeDict to updates sets
+        """
+
+        for bgpupdate in self.updateCache.getUpdates(
+                addressfamily, withdrawals, attributeMap,
+                functools.partial(self._encodeMPUpdates, addressfamily)):
+            self.estabProtocol.sendMessage(bgpupdate)
+
+    @staticmethod
+    def _encodeInetUnicastUpdates(withdrawals, attributeMap):
+        """
+        Encodes (multiple) UPDATE messages for the inet-unicast way,
+        and returns them as a list.
+        """
+
+        messages = []
+
         # If attributeMap is empty, i.e there are no UPDATEs,
         # create an entry with no attributes to be used for withdrawals only
         if not attributeMap:
@@ -580,7 +772,7 @@ class NaiveBGPPeering(BGPPeering):
                     raise ValueError("Could not add any withdrawals")
                 if withdrawalPrefixSet:
                     # We overflowed the packet
-                    self.estabProtocol.sendMessage(bgpupdate)
+                    messages.append(bgpupdate)
                     bgpupdate = BGPUpdateMessage()
 
             # Attempt to add all attributes and (some) NLRI to the existing
@@ -592,14 +784,14 @@ class NaiveBGPPeering(BGPPeering):
                 bgpupdate.addAttributes(attributes)
             except ValueError:
                 # Alas, didn't fit. Just send out.
-                self.estabProtocol.sendMessage(bgpupdate)
+                messages.append(bgpupdate)
             else:
                 prefixesAdded = bgpupdate.addSomeNLRI(adPrefixSet)
                 if prefixesAdded == 0:
                     # Packet was full, no NLRI added. Nevermind, let's send
                     # this one without attributes & NLRI.
                     bgpupdate.clearAttributes()
-                self.estabProtocol.sendMessage(bgpupdate)
+                messages.append(bgpupdate)
 
             # Start with a clean slate
             while adPrefixSet:
@@ -616,20 +808,19 @@ class NaiveBGPPeering(BGPPeering):
                     prefixesAdded = bgpupdate.addSomeNLRI(adPrefixSet)
                     if prefixesAdded == 0:
                         raise ValueError("Could not add any NLRI prefixes")
-                    self.estabProtocol.sendMessage(bgpupdate)
+                    messages.append(bgpupdate)
 
         assert not withdrawalPrefixSet
+        return messages
 
-    def _sendMPUpdates(self, addressfamily, withdrawals, attributeMap):
+    @staticmethod
+    def _encodeMPUpdates(addressfamily, withdrawals, attributeMap):
         """
-        Sends (multiple) UPDATE messages the RFC4760 way.
-
-        Arguments:
-        - addressfamily: (AFI, SAFI) tuple
-        - withdrawals: a set of advertisements to withdraw
-        - attributeMap: a dict of FrozenAttributeDict to updates sets
+        Encodes (multiple) UPDATE messages the RFC4760 way, and returns
+        them as a list.
         """
 
+        messages = []
         afi, safi = addressfamily
 
         # Construct MPUnreachNLRI for withdrawals and send them
@@ -646,7 +837,7 @@ class NaiveBGPPeering(BGPPeering):
             if prefixesAdded == 0:
                 raise ValueError("Could not add any prefixes to MPUnreachNLRI attribute")
             bgpupdate.addAttributes(FrozenAttributeDict([unreachAttr]))
-            self.estabProtocol.sendMessage(bgpupdate)
+            messages.append(bgpupdate)
 
         # Move NLRI into MPReachNLRI attributes and send them
 
@@ -679,4 +870,6 @@ class NaiveBGPPeering(BGPPeering):
                     if prefixesAdded == 0:
                         raise ValueError("Could not add any prefixes to MPReachNLRI attribute")
                     bgpupdate.addAttributes(FrozenAttributeDict([reachAttr]))
-                    self.estabProtocol.sendMessage(bgpupdate)
+                    messages.append(bgpupdate)
+
+        return messages
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+  BGP parser benchmark
+  ~~~~~~~~~~~~~~~~~~~~
+
+  Measures the throughput of the BGP receive path, framing and parsing
+  a flood of UPDATE messages as received from a router sending a full
+  table. Run with:
+
+    python -m pybal.bgp.test.benchmark_parser [messages] [read size]
+
+"""
+
+from __future__ import print_function
+
+import struct
+import sys
+import time
+
+from .. import bgp, ip, attributes
+
+
+def buildUpdates(count):
+    """Returns count encoded UPDATE messages with 100 prefixes each"""
+
+    attrs = attributes.AttributeDict([
+        attributes.OriginAttribute(),
+        attributes.ASPathAttribute([64496, 64511]),
+        attributes.NextHopAttribute('192.0.2.1'),
+        attributes.MEDAttribute(100)])
+    messages = []
+    for i in range(count):
+        update = bgp.BGPUpdateMessage()
+        update.addAttributes(attrs)
+        update.addSomeNLRI(set(ip.IPPrefix('10.{}.{}.0/24'.format(i % 256, j))
+                               for j in range(100)))
+        messages.append(bytes(update))
+    return b''.join(messages)
+
+
+def buildEmptyUpdates(count):
+    """Returns count encoded empty UPDATE messages, as End-of-RIB markers"""
+
+    endOfRIB = bgp.BGPMessage.prependHeader(struct.pack('!HH', 0, 0), bgp.MSG_UPDATE)
+    return endOfRIB * count
+
+
+def benchmark(name, data, count, readSize):
+    protocol = bgp.BGP()
+    received = []
+    protocol.updateReceived = lambda *update: received.append(update)
+
+    start = time.time()
+    for offset in xrange(0, len(data), readSize):
+        protocol.dataReceived(data[offset:offset+readSize])
+    elapsed = time.time() - start
+
+    assert len(received) == count
+    print("{}: {} UPDATEs ({:.1f} MB) in {:.3f}s: {:.0f} messages/s, {:.1f} MB/s".format(
+        name, count, len(data) / 1e6, elapsed, count / elapsed,
+        len(data) / 1e6 / elapsed))
+
+
+def run(count=2000, readSize=65536):
+    # Full table: parsing dominates
+    benchmark("full table", buildUpdates(count), count, readSize)
+    # Small messages: framing dominates
+    benchmark("empty updates", buildEmptyUpdates(count * 50), count * 50, readSize)
+
+
+if __name__ == '__main__':
+    run(*map(int, sys.argv[1:3]))
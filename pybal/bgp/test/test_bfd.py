@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+"""
+  bgp.bfd unit tests
+  ~~~~~~~~~~~~~~~~~~
+
+  This module contains tests for `bgp.bfd`.
+"""
+
+# Python imports
+import socket, struct, unittest, mock
+
+# Twisted imports
+from twisted.internet import defer, protocol, reactor, task
+import twisted.trial.unittest
+
+# BGP imports
+from ..bfd import *
+
+
+class BFDControlPacketTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.packet = BFDControlPacket(
+            state=STATE_UP, diag=DIAG_NEIGHBOR_DOWN, flags=FLAG_POLL,
+            detectMult=3, myDiscr=1, yourDiscr=2, desiredMinTx=300000,
+            requiredMinRx=200000)
+
+    def testEncode(self):
+        self.assertEqual(self.packet.encode(), struct.pack(
+            '!BBBBIIIII', 0x23, 0xe0, 3, 24, 1, 2, 300000, 200000, 0))
+
+    def testDecode(self):
+        packet = BFDControlPacket.decode(self.packet.encode())
+        self.assertEqual(packet.__dict__, self.packet.__dict__)
+
+    def _testDiscard(self, data):
+        self.assertRaises(ValueError, BFDControlPacket.decode, data)
+
+    def testDecodeInvalid(self):
+        data = self.packet.encode()
+        self._testDiscard(data[:20])
+        self._testDiscard(chr(0x43) + data[1:])             # Version 2
+        self._testDiscard(data[:3] + chr(48) + data[4:])    # Length
+        self._testDiscard(data[:2] + chr(0) + data[3:])     # Detect Mult
+        self._testDiscard(data[0] + chr(0xe1) + data[2:])   # Multipoint
+        self._testDiscard(data[0] + chr(0xe4) + data[2:])   # Authentication
+        self._testDiscard(data[:4] + '\0\0\0\0' + data[8:]) # My Discriminator
+
+
+class BFDSessionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.listener = BFDListener()
+        self.session = BFDSession(self.listener, '127.0.0.2', desiredMinTx=50000,
+                                  requiredMinRx=100000, detectMult=3)
+        self.session.reactor = self.clock
+        self.session.transport = mock.Mock()
+        self.session.log = mock.Mock()
+        self.callback = mock.Mock()
+        self.session.stateCallbacks.append(self.callback)
+
+    def sent(self):
+        return BFDControlPacket.decode(self.session.transport.write.call_args[0][0])
+
+    def receive(self, state, flags=0):
+        self.session.packetReceived(BFDControlPacket(
+            state=state, flags=flags, detectMult=2, myDiscr=42,
+            yourDiscr=self.session.localDiscr, desiredMinTx=200000,
+            requiredMinRx=20000))
+
+    def bringUp(self):
+        self.receive(STATE_DOWN)
+        self.receive(STATE_UP)
+
+    def testDiscriminator(self):
+        self.assertNotEqual(self.session.localDiscr, 0)
+        self.assertIs(self.listener.sessions[self.session.localDiscr], self.session)
+
+    def testThreeWayHandshake(self):
+        self.receive(STATE_DOWN)
+        self.assertEqual(self.session.state, STATE_INIT)
+        self.assertEqual(self.session.remoteDiscr, 42)
+        self.callback.assert_not_called()
+        self.receive(STATE_UP)
+        self.assertEqual(self.session.state, STATE_UP)
+        self.callback.assert_called_once_with(self.session, True)
+
+    def testDownToUp(self):
+        self.receive(STATE_INIT)
+        self.assertEqual(self.session.state, STATE_UP)
+
+    def testSlowTransmit(self):
+        self.session._scheduleTransmit()
+        self.clock.advance(0.7)
+        self.session.transport.write.assert_not_called()
+        self.clock.advance(0.3)
+        packet = self.sent()
+        self.assertEqual(packet.state, STATE_DOWN)
+        self.assertEqual(packet.desiredMinTx, BFDSession.SLOW_TX_INTERVAL)
+        self.assertEqual(self.session.transport.write.call_args[0][1], ('127.0.0.2', PORT))
+
+    def testTransmit(self):
+        self.bringUp()
+        # The desired interval, as the peer accepts it
+        self.clock.advance(0.05)
+        packet = self.sent()
+        self.assertEqual(packet.state, STATE_UP)
+        self.assertEqual(packet.desiredMinTx, 50000)
+        self.assertEqual(packet.requiredMinRx, 100000)
+        self.assertEqual(packet.yourDiscr, 42)
+        # Poll Sequence for the changed interval
+        self.assertTrue(packet.flags & FLAG_POLL)
+        self.receive(STATE_UP, FLAG_FINAL)
+        self.clock.advance(0.05)
+        self.assertFalse(self.sent().flags & FLAG_POLL)
+
+    def testNoTransmit(self):
+        self.session.remoteMinRx = 0
+        self.session._scheduleTransmit()
+        self.assertFalse(self.clock.getDelayedCalls())
+
+    def testPoll(self):
+        self.bringUp()
+        self.receive(STATE_UP, FLAG_POLL)
+        self.assertTrue(self.sent().flags & FLAG_FINAL)
+        self.assertFalse(self.sent().flags & FLAG_POLL)
+
+    def testDetectionTimeExpired(self):
+        self.bringUp()
+        # Remote Detect Mult times the remote's transmit interval
+        self.clock.advance(0.39)
+        self.assertEqual(self.session.state, STATE_UP)
+        self.receive(STATE_UP)
+        self.clock.advance(0.39)
+        self.assertEqual(self.session.state, STATE_UP)
+        self.clock.advance(0.01)
+        self.assertEqual(self.session.state, STATE_DOWN)
+        self.assertEqual(self.session.localDiag, DIAG_DETECTION_TIME_EXPIRED)
+        self.assertEqual(self.session.remoteDiscr, 0)
+        self.callback.assert_called_with(self.session, False)
+
+    def testNeighborDown(self):
+        self.bringUp()
+        self.receive(STATE_DOWN)
+        self.assertEqual(self.session.state, STATE_DOWN)
+        self.assertEqual(self.session.localDiag, DIAG_NEIGHBOR_DOWN)
+        self.callback.assert_called_with(self.session, False)
+
+        # The peer's discriminator is kept until it goes silent
+        self.assertEqual(self.session.remoteDiscr, 42)
+        self.clock.advance(0.5)
+        self.assertEqual(self.sent().yourDiscr, 42)
+        self.clock.advance(self.session._detectionTime() / 1e6)
+        self.assertEqual(self.session.remoteDiscr, 0)
+
+    def testNoDiscriminatorInit(self):
+        # An Init packet without our discriminator doesn't skip the
+        # three-way handshake
+        packet = BFDControlPacket(state=STATE_INIT, myDiscr=42)
+        self.listener.datagramReceived(packet.encode(), ('127.0.0.2', SOURCE_PORT_MIN))
+        self.assertEqual(self.session.state, STATE_DOWN)
+        self.callback.assert_not_called()
+
+    def testPeerRestarted(self):
+        self.bringUp()
+        # The restarted peer has forgotten our discriminator
+        packet = BFDControlPacket(state=STATE_DOWN, myDiscr=43)
+        self.listener.datagramReceived(packet.encode(), ('127.0.0.2', SOURCE_PORT_MIN))
+        self.assertEqual(self.session.state, STATE_DOWN)
+        self.assertEqual(self.session.remoteDiscr, 43)
+        self.callback.assert_called_with(self.session, False)
+
+    def testRemoteAdminDown(self):
+        self.bringUp()
+        self.receive(STATE_ADMIN_DOWN)
+        self.assertEqual(self.session.state, STATE_DOWN)
+        self.assertEqual(self.session.remoteState, STATE_ADMIN_DOWN)
+        self.callback.assert_called_with(self.session, False)
+
+    def testStop(self):
+        self.bringUp()
+        self.session.stop()
+        packet = self.sent()
+        self.assertEqual(packet.state, STATE_ADMIN_DOWN)
+        self.assertEqual(packet.diag, DIAG_ADMIN_DOWN)
+        self.assertEqual(packet.yourDiscr, 42)
+        self.session.transport.stopListening.assert_called_once()
+        self.assertFalse(self.clock.getDelayedCalls())
+        self.assertNotIn(self.session.localDiscr, self.listener.sessions)
+
+        # Packets are ignored
+        self.receive(STATE_DOWN)
+        self.assertEqual(self.session.state, STATE_ADMIN_DOWN)
+
+
+class BFDListenerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.listener = BFDListener()
+        self.session = mock.Mock(peerAddr='192.0.2.1', state=STATE_DOWN)
+        self.listener.addSession(self.session)
+
+    def receive(self, host, yourDiscr=0, state=STATE_DOWN):
+        packet = BFDControlPacket(state=state, myDiscr=42, yourDiscr=yourDiscr)
+        self.listener.datagramReceived(packet.encode(), (host, SOURCE_PORT_MIN))
+
+    def testByDiscriminator(self):
+        self.receive('192.0.2.1', self.session.localDiscr)
+        self.session.packetReceived.assert_called_once()
+        # From another address
+        self.receive('192.0.2.2', self.session.localDiscr)
+        self.session.packetReceived.assert_called_once()
+
+    def testByAddress(self):
+        self.receive('::ffff:192.0.2.1')
+        self.session.packetReceived.assert_called_once()
+
+        # Whatever the state of the session, e.g. a restarted peer
+        self.session.state = STATE_UP
+        self.receive('192.0.2.1', state=STATE_ADMIN_DOWN)
+        self.assertEqual(self.session.packetReceived.call_count, 2)
+
+    def testByAddressNotDown(self):
+        # Only Down packets may lack our discriminator
+        for state in (STATE_INIT, STATE_UP):
+            self.receive('192.0.2.1', state=state)
+        self.session.packetReceived.assert_not_called()
+
+    def testInvalid(self):
+        self.listener.datagramReceived('invalid', ('192.0.2.1', SOURCE_PORT_MIN))
+        self.session.packetReceived.assert_not_called()
+
+    @mock.patch('pybal.bgp.bfd._log')
+    def testTTLFilterUnsupported(self, mock_log):
+        self.listener.transport = mock.Mock()
+        sock = self.listener.transport.getHandle.return_value
+        sock.setsockopt.side_effect = socket.error("Protocol not available")
+        self.listener.startProtocol()
+        sock.setsockopt.assert_called_once_with(
+            socket.SOL_SOCKET, SO_ATTACH_FILTER, mock.ANY)
+        mock_log.assert_called_once()
+
+
+class BFDStandIn(protocol.DatagramProtocol):
+    """
+    Stand-in for the BFD implementation of a router, which answers
+    every Control packet it receives
+    """
+
+    def __init__(self, peerPort):
+        self.peerPort = peerPort
+        self.silent = False
+        self.ttl = TTL
+
+    def startProtocol(self):
+        self.transport.getHandle().setsockopt(socket.IPPROTO_IP, socket.IP_TTL, self.ttl)
+
+    def datagramReceived(self, data, (host, port)):
+        packet = BFDControlPacket.decode(data)
+        if self.silent or packet.state == STATE_ADMIN_DOWN:
+            return
+        state = STATE_INIT if packet.state == STATE_DOWN else STATE_UP
+        flags = FLAG_FINAL if packet.flags & FLAG_POLL else 0
+        reply = BFDControlPacket(state=state, flags=flags, detectMult=3,
+                                 myDiscr=7, yourDiscr=packet.myDiscr,
+                                 desiredMinTx=50000, requiredMinRx=50000)
+        self.transport.write(reply.encode(), (host, self.peerPort))
+
+
+class BFDLoopbackTestCase(twisted.trial.unittest.TestCase):
+    """Runs a BFD session against a stand-in on loopback"""
+
+    timeout = 10
+
+    def setUp(self):
+        self.listener = BFDListener()
+        self.listenerPort = reactor.listenUDP(0, self.listener, interface='127.0.0.1')
+        self.standIn = BFDStandIn(self.listenerPort.getHost().port)
+        self.standInPort = reactor.listenUDP(0, self.standIn, interface='127.0.0.1')
+
+        self.session = BFDSession(self.listener, '127.0.0.1',
+                                  peerPort=self.standInPort.getHost().port,
+                                  desiredMinTx=50000, requiredMinRx=50000)
+        self.session.SLOW_TX_INTERVAL = 50000
+        self.states = []
+        self.stateChanged = None
+        self.session.stateCallbacks.append(self.recordState)
+        self.session.start()
+
+    def tearDown(self):
+        if self.session.state != STATE_ADMIN_DOWN:
+            self.session.stop()
+        return defer.gatherResults([
+            defer.maybeDeferred(self.listenerPort.stopListening),
+            defer.maybeDeferred(self.standInPort.stopListening)])
+
+    def recordState(self, session, up):
+        self.states.append(up)
+        if self.stateChanged is not None:
+            d, self.stateChanged = self.stateChanged, None
+            d.callback(up)
+
+    def waitForState(self):
+        self.stateChanged = defer.Deferred()
+        return self.stateChanged
+
+    def testUpDown(self):
+        def checkUp(up):
+            self.assertTrue(up)
+            self.assertEqual(self.session.remoteDiscr, 7)
+            # Fail the stand-in
+            self.failedAt = reactor.seconds()
+            self.standIn.silent = True
+            return self.waitForState()
+
+        def checkDown(up):
+            self.assertFalse(up)
+            self.assertEqual(self.session.localDiag, DIAG_DETECTION_TIME_EXPIRED)
+            # Detected well within a second
+            self.assertLess(reactor.seconds() - self.failedAt, 0.5)
+            self.assertEqual(self.states, [True, False])
+
+        return self.waitForState().addCallback(checkUp).addCallback(checkDown)
+
+    def testTTL(self):
+        """Packets from more than one hop away are discarded"""
+
+        def checkDown(up):
+            self.assertFalse(up)
+            self.assertEqual(self.session.localDiag, DIAG_DETECTION_TIME_EXPIRED)
+            self.assertEqual(self.states, [True, False])
+
+        def checkUp(up):
+            self.assertTrue(up)
+            # Nothing else reaches the listener from now on
+            self.standIn.transport.getHandle().setsockopt(
+                socket.IPPROTO_IP, socket.IP_TTL, 64)
+            return self.waitForState().addCallback(checkDown)
+
+        return self.waitForState().addCallback(checkUp)
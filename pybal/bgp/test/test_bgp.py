@@ -73,6 +73,11 @@ class BGPUpdateMessageTestCase(unittest.TestCase):
     def testFreeSpace(self):
         self.assertEqual(self.msg.freeSpace(), bgp.MAX_LEN-len(self.msg))
 
+    def testEmptyMessageLength(self):
+        # An empty UPDATE is the inet unicast End-of-RIB marker
+        self.assertEqual(bytes(self.msg),
+                         bgp.BGPMessage.prependHeader(b'\0\0\0\0', bgp.MSG_UPDATE))
+
 class BGPTestCase(unittest.TestCase):
     MSG_DATA_OPEN = (b'\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff' +
                      b'\x00+\x01\x04\xfcX\x00\xb4\x7f\x7f\x7f\x7f\x0e\x02\x0c\x01\x04' +
@@ -119,6 +124,23 @@ class BGPTestCase(unittest.TestCase):
         self.proto.dataReceived(d)
         self.assertIn(d, self.proto.receiveBuffer)
 
+    def testGracefulRestartCapability(self):
+        self.assertNotIn(bgp.CAP_GRACEFUL_RESTART,
+                         dict(self.proto._capabilities()))
+
+        self.factory.restartTime = 120
+        capabilities = dict(self.proto._capabilities())
+        self.assertEqual(capabilities[bgp.CAP_GRACEFUL_RESTART],
+                         struct.pack('!HHBBHBB', 0x8000 | 120,
+                                     bgp.AFI_INET, bgp.SAFI_UNICAST, 0x80,
+                                     bgp.AFI_INET6, bgp.SAFI_UNICAST, 0x80))
+        # The Restart State bit is cleared after the initial update
+        self.factory.restarting = False
+        value = self.proto.constructGracefulRestart()
+        self.assertEqual(struct.unpack('!H', value[:2])[0], 120)
+        self.assertIn(b'\x40' + chr(len(value)) + value,
+                      self.proto.constructOpen())
+
     def testCloseConnection(self):
         with mock.patch.object(self.proto.fsm, 'connectionFailed') as mock_method:
             self.tr.connected = True
@@ -320,6 +342,32 @@ class BGPUpdateParserTestCase(unittest.TestCase):
             BGPUpdateParserTestCase.MSG_UPDATE_ATTRIBUTES,
             BGPUpdateParserTestCase.MSG_UPDATE_NLRI)
 
+    def testDataReceivedFraming(self):
+        # Many messages, split at arbitrary boundaries
+        data = BGPUpdateParserTestCase.MSG_UPDATE * 50
+        for i in range(0, len(data), 7):
+            self.bgp.dataReceived(data[i:i+7])
+        self.assertEqual(self.bgp.updateReceived.call_count, 50)
+        self.bgp.updateReceived.assert_called_with(
+            BGPUpdateParserTestCase.MSG_UPDATE_WITHDRAWN_PREFIXES,
+            BGPUpdateParserTestCase.MSG_UPDATE_ATTRIBUTES,
+            BGPUpdateParserTestCase.MSG_UPDATE_NLRI)
+
+        # Parsed messages are dropped from the buffer
+        self.assertEqual(self.bgp.receiveOffset, 0)
+        self.bgp.dataReceived(data[:-1])
+        self.assertEqual(self.bgp.updateReceived.call_count, 99)
+        self.assertEqual(bytes(self.bgp.receiveBuffer),
+                         BGPUpdateParserTestCase.MSG_UPDATE[:-1])
+
+    def testParsedAttributesAreCopies(self):
+        self.bgp.dataReceived(BGPUpdateParserTestCase.MSG_UPDATE)
+        attrs = self.bgp.updateReceived.call_args[0][1]
+        for flags, typeCode, value in attrs:
+            self.assertIsInstance(value, str)
+        # The receive buffer is not pinned by the parsed message
+        self.bgp.receiveBuffer.extend(b'\xff')
+
 
 class BGPNotificationParserTestCase(unittest.TestCase):
     MSG_NOTIFICATION = (b'\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff' +
@@ -1153,6 +1153,29 @@ class FSMDefinitionStateEstablishedTestCase(FSMDefinitionTestCase):
         self.assertEqual(ar_ns.exception.suberror, suberror)
         self._subtest_Established_to_Idle
 
+    def test_Established_gracefulStop(self):
+        # Graceful restart (RFC 4724) is not an RFC 4271 event
+        self.fsm.gracefulStop()
+        self.fsm.protocol.sendNotification.assert_not_called()
+        self.fsm.bgpPeering.releaseResources.assert_not_called()
+        self.assertConnectionDropped()
+        self.assertTimerInactive(self.fsm.holdTimer)
+        self.assertTimerInactive(self.fsm.keepAliveTimer)
+        self.assertEqual(self.fsm.connectRetryCounter, 0)
+        self.assertState(ST_IDLE)
+
+    def test_Established_bfdDown(self):
+        # A BFD session failure (RFC 5882) is handled as event 18
+        self.fsm.bfdDown()
+        self.fsm.protocol.sendNotification.assert_not_called()
+        self._subtest_Established_to_Idle()
+
+    def test_Connect_bfdDown(self):
+        self._setState(ST_CONNECT)
+        self.fsm.bfdDown()
+        self.fsm.protocol.closeConnection.assert_not_called()
+        self.assertState(ST_CONNECT)
+
 
 class FSMTestCompletenessTestCase(unittest.TestCase):
     def testCompleteness(self):
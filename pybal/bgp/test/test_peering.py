@@ -7,20 +7,22 @@
 """
 
 # Python imports
-import unittest, mock
+import struct, unittest, mock
 
 # Twisted imports
 from twisted.internet.address import IPv4Address
 from twisted.python import failure
 import twisted.internet.base
 import twisted.internet.error
+import twisted.internet.task
 import twisted.test.proto_helpers
 
 # BGP imports
 from ..bgp import BGP, BGPUpdateMessage
 from ..peering import BGPFactory, BGPServerFactory, BGPPeering, NaiveBGPPeering
+from ..peering import UpdateCache
 from ..constants import *
-from .. import fsm, exceptions, bgp, attributes, ip
+from .. import fsm, exceptions, bgp, attributes, ip, bfd
 
 
 class BGPFactoryTestCase(unittest.TestCase):
@@ -184,6 +186,46 @@ class BGPPeeringTestCase(BGPFactoryTestCase):
 
         return deferred.addCallback(testAllStopped, self, allConnections)
 
+    def testGracefulStop(self):
+        self.factory.buildProtocol(self.testAddr)
+        allConnections = self.factory.inConnections + self.factory.outConnections
+        for c in allConnections:
+            c.fsm = mock.Mock(spec=fsm.FSM)
+        self.assertTrue(allConnections)
+
+        deferred = self.factory.gracefulStop()
+
+        def testAllStopped(result, testCase, allConnections):
+            for c in allConnections:
+                c.fsm.gracefulStop.assert_called_once()
+                c.fsm.manualStop.assert_not_called()
+
+        return deferred.addCallback(testAllStopped, self, allConnections)
+
+    def testBFDStateChanged(self):
+        self.factory.buildProtocol(self.testAddr)
+        connection, = self.factory.outConnections
+        connection.fsm = mock.Mock(spec=fsm.FSM)
+        session = mock.Mock(spec=bfd.BFDSession, state=bfd.STATE_DOWN,
+                            remoteState=bfd.STATE_UP)
+
+        self.factory.bfdStateChanged(session, True)
+        connection.fsm.bfdDown.assert_not_called()
+        self.factory.bfdStateChanged(session, False)
+        connection.fsm.bfdDown.assert_called_once()
+
+    def testBFDAdminDown(self):
+        self.factory.buildProtocol(self.testAddr)
+        connection, = self.factory.outConnections
+        connection.fsm = mock.Mock(spec=fsm.FSM)
+        # Disabling BFD on either side is not a failure
+        for state, remoteState in ((bfd.STATE_ADMIN_DOWN, bfd.STATE_UP),
+                                   (bfd.STATE_DOWN, bfd.STATE_ADMIN_DOWN)):
+            session = mock.Mock(spec=bfd.BFDSession, state=state,
+                                remoteState=remoteState)
+            self.factory.bfdStateChanged(session, False)
+        connection.fsm.bfdDown.assert_not_called()
+
     def testAutomaticStart(self):
         self.assertFalse(self.factory.passiveStart)
         with mock.patch.object(self.factory, 'fsm') as mock_fsm:
@@ -242,6 +284,18 @@ class BGPPeeringTestCase(BGPFactoryTestCase):
         testProtocol.deferred.errback(f)
         mocks['protocolError'].assert_called_with(f)
 
+    def testSessionCallbacks(self):
+        callback = mock.Mock()
+        self.factory.sessionCallbacks.append(callback)
+        testProtocol = self.factory.buildProtocol(self.testAddr)
+        self.factory.estabProtocol = testProtocol
+        callback.assert_called_once_with(self.factory, True)
+        # Only state changes are reported
+        self.factory.estabProtocol = testProtocol
+        callback.assert_called_once()
+        self.factory.estabProtocol = None
+        callback.assert_called_with(self.factory, False)
+
     def testConnectRetryEvent(self):
         with mock.patch.object(self.factory, 'connect') as mock_connect:
             self.factory.connectRetryEvent(mock.Mock(spec=BGP))
@@ -600,6 +654,27 @@ class NaiveBGPPeeringTestCase(unittest.TestCase):
         mock_sendUpdates.assert_called_with(
             self.peering.advertised, self.peering.toAdvertise)
 
+    def testSendEndOfRIB(self):
+        transport = self.peering.estabProtocol.transport
+        mpUnreach = BGP.encodeAttributes(attributes.FrozenAttributeDict(
+            [attributes.MPUnreachNLRIAttribute((AFI_INET6, SAFI_UNICAST, []))]))
+        endOfRIB = (
+            bgp.BGPMessage.prependHeader(b'\0\0\0\0', bgp.MSG_UPDATE) +
+            bgp.BGPMessage.prependHeader(
+                b'\0\0' + struct.pack('!H', len(mpUnreach)) + mpUnreach,
+                bgp.MSG_UPDATE))
+
+        # No End-of-RIB without graceful restart
+        transport.clear()
+        self.peering.sendAdvertisements()
+        self.assertNotIn(mpUnreach, transport.value())
+
+        self.peering.restartTime = 120
+        transport.clear()
+        self.peering.sendAdvertisements()
+        self.assertTrue(transport.value().endswith(endOfRIB))
+        self.assertFalse(self.peering.restarting)
+
     def testSetAdvertisements(self):
         self.assertEqual(self.peering.toAdvertise, self.emptyAFs)
 
@@ -650,6 +725,199 @@ class NaiveBGPPeeringTestCase(unittest.TestCase):
         self.assertEqual(self.peering.toAdvertise, self.emptyAFs)
         self.assertEqual(self.peering.advertised, self.peering.toAdvertise)
 
+    def _v4Advertisement(self, prefix, med=50):
+        attrs = attributes.AttributeDict(self.attrs)
+        attrs[attributes.MEDAttribute] = attributes.MEDAttribute(med)
+        attrs[attributes.NextHopAttribute] = attributes.NextHopAttribute('10.192.16.139')
+        return bgp.Advertisement(
+            prefix=ip.IPv4IP(prefix),
+            attributes=attributes.FrozenAttributeDict(attrs),
+            addressfamily=(AFI_INET, SAFI_UNICAST))
+
+    def testCalculateChangesReplaced(self):
+        adv = self._v4Advertisement('10.2.1.18')
+        self.peering.setAdvertisements({adv})
+        changed = self._v4Advertisement('10.2.1.18', med=100)
+        self.peering.setAdvertisements({changed})
+        # A changed route replaces the previous one without a withdrawal
+        self.assertEqual(self.peering.advertised[(AFI_INET, SAFI_UNICAST)], {changed})
+
+        self.peering.toAdvertise[(AFI_INET, SAFI_UNICAST)] = {adv}
+        withdrawals, updates = self.peering._calculateChanges()
+        self.assertEqual(withdrawals[(AFI_INET, SAFI_UNICAST)], set())
+        self.assertEqual(updates[(AFI_INET, SAFI_UNICAST)], {adv})
+
+    def testNoChanges(self):
+        transport = self.peering.estabProtocol.transport
+        transport.clear()
+        self.peering.setAdvertisements(set())
+        self.assertEqual(transport.value(), b'')
+
+    def testMRAI(self):
+        clock = twisted.internet.task.Clock()
+        self.peering.reactor = clock
+        self.peering.mrai = 5
+        transport = self.peering.estabProtocol.transport
+        adv1 = self._v4Advertisement('10.2.1.18')
+        adv2 = self._v4Advertisement('10.2.1.19')
+
+        # The first change is sent immediately
+        self.peering.setAdvertisements({adv1})
+        self.assertEqual(self.peering.advertised[(AFI_INET, SAFI_UNICAST)], {adv1})
+
+        # Changes within the interval are batched
+        transport.clear()
+        clock.advance(2)
+        self.peering.setAdvertisements(set())
+        self.peering.setAdvertisements({adv1, adv2})
+        self.assertEqual(transport.value(), b'')
+        self.assertEqual(len(clock.getDelayedCalls()), 1)
+
+        # ...and sent at its end, without the withdrawal of adv1
+        clock.advance(3)
+        messages = NaiveBGPPeering._encodeInetUnicastUpdates(
+            set(), {adv2.attributes: {adv2}})
+        self.assertEqual(transport.value(), b''.join(bytes(m) for m in messages))
+        self.assertEqual(self.peering.advertised[(AFI_INET, SAFI_UNICAST)], {adv1, adv2})
+        self.assertFalse(clock.getDelayedCalls())
+
+        # A flap within the interval cancels out
+        transport.clear()
+        clock.advance(1)
+        self.peering.setAdvertisements({adv1})
+        self.peering.setAdvertisements({adv1, adv2})
+        clock.advance(4)
+        self.assertEqual(transport.value(), b'')
+
+        # After the interval, changes are sent immediately again
+        clock.advance(5)
+        self.peering.setAdvertisements({adv2})
+        self.assertEqual(self.peering.advertised[(AFI_INET, SAFI_UNICAST)], {adv2})
+
+    def testMRAIFlush(self):
+        clock = twisted.internet.task.Clock()
+        self.peering.reactor = clock
+        self.peering.mrai = 5
+        adv = self._v4Advertisement('10.2.1.18')
+        self.peering.setAdvertisements({adv})
+        self.peering.setAdvertisements(set())
+        self.assertEqual(self.peering.advertised[(AFI_INET, SAFI_UNICAST)], {adv})
+
+        self.peering.flushUpdates()
+        self.assertEqual(self.peering.advertised[(AFI_INET, SAFI_UNICAST)], set())
+        self.assertFalse(clock.getDelayedCalls())
+
+    def testMRAISessionEstablished(self):
+        clock = twisted.internet.task.Clock()
+        self.peering.reactor = clock
+        self.peering.mrai = 5
+        self.peering.setAdvertisements({self._v4Advertisement('10.2.1.18')})
+        self.peering.setAdvertisements(set())
+        # The initial update of a new session includes pending changes
+        self.peering.completeInit(self.peering.estabProtocol)
+        self.peering.sendAdvertisements()
+        self.assertFalse(clock.getDelayedCalls())
+        self.assertEqual(self.peering.advertised, self.emptyAFs)
+
+    def testMRAINotEstablished(self):
+        clock = twisted.internet.task.Clock()
+        self.peering.reactor = clock
+        self.peering.mrai = 5
+        self.peering.fsm.state = fsm.ST_ACTIVE
+        self.peering.lastUpdateTime = None
+        self.peering.setAdvertisements({self._v4Advertisement('10.2.1.18')})
+        # Nothing was sent, so the interval hasn't started
+        self.assertIsNone(self.peering.lastUpdateTime)
+
+        self.peering.fsm.state = fsm.ST_ESTABLISHED
+        self.peering.setAdvertisements({self._v4Advertisement('10.2.1.19')})
+        self.assertFalse(clock.getDelayedCalls())
+        self.assertEqual(self.peering.lastUpdateTime, 0)
+
+
+class UpdateCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self._log_patcher = mock.patch.object(BGPFactory, 'log')
+        self._log_patcher.start()
+
+        self.updateCache = UpdateCache()
+        self.peerings = []
+        for peerAddr in ('10.0.0.1', '10.0.0.2'):
+            peering = NaiveBGPPeering(myASN=64600, peerAddr=peerAddr)
+            peering.updateCache = self.updateCache
+            peering.setEnabledAddressFamilies({(AFI_INET, SAFI_UNICAST)})
+            peering.fsm.state = fsm.ST_ESTABLISHED
+            peering.estabProtocol = mock.Mock(spec=BGP)
+            self.peerings.append(peering)
+
+        self.attrs = attributes.FrozenAttributeDict({
+            attributes.OriginAttribute((0)),
+            attributes.ASPathAttribute([(2, [64496])]),
+            attributes.NextHopAttribute('10.192.16.139')})
+
+    def tearDown(self):
+        self._log_patcher.stop()
+
+    def _advertisements(self, count):
+        return {bgp.Advertisement(ip.IPPrefix((i, 32), ip.AFI_INET), self.attrs)
+                for i in range(count)}
+
+    def _sent(self, peering):
+        return [args[0] for args, kwargs
+                in peering.estabProtocol.sendMessage.call_args_list]
+
+    def testSharedEncoding(self):
+        advertisements = self._advertisements(1000)
+        with mock.patch.object(NaiveBGPPeering, '_encodeInetUnicastUpdates',
+                               wraps=NaiveBGPPeering._encodeInetUnicastUpdates) as mock_encode:
+            for peering in self.peerings:
+                peering.setAdvertisements(advertisements)
+            # Encoded once, the same messages sent to both peers
+            mock_encode.assert_called_once()
+            sent = self._sent(self.peerings[0])
+            self.assertGreater(len(sent), 1)
+            self.assertEqual(sent, self._sent(self.peerings[1]))
+            for a, b in zip(sent, self._sent(self.peerings[1])):
+                self.assertIs(a, b)
+
+            # A different change set is encoded again
+            for peering in self.peerings:
+                peering.setAdvertisements(set())
+            self.assertEqual(mock_encode.call_count, 2)
+
+    def testDifferentChangeSets(self):
+        advertisements = self._advertisements(10)
+        extra = bgp.Advertisement(ip.IPPrefix('10.0.0.0/8'), self.attrs)
+        self.peerings[0].setAdvertisements(advertisements)
+        # The second peer has another advertisement already
+        self.peerings[1].setAdvertisements(advertisements | {extra})
+        self.peerings[1].setAdvertisements(advertisements)
+        withdrawals = self._sent(self.peerings[1])[-1]
+        self.assertEqual(withdrawals.withdrCount, 1)
+        self.assertEqual(withdrawals.nlriCount, 0)
+
+    def testEncodingError(self):
+        with mock.patch.object(NaiveBGPPeering, '_encodeMPUpdates',
+                               side_effect=ValueError) as mock_encode:
+            for i in range(2):
+                self.assertRaises(
+                    ValueError, self.updateCache.getUpdates,
+                    (AFI_INET6, SAFI_UNICAST), set(), {}, mock_encode)
+        # Failed encodings are not cached
+        self.assertEqual(mock_encode.call_count, 2)
+        self.assertEqual(len(self.updateCache.entries), 0)
+
+    def testMaxEntries(self):
+        encode = mock.Mock(return_value=[])
+        for i in range(UpdateCache.MAX_ENTRIES + 1):
+            self.updateCache.getUpdates(
+                (AFI_INET, SAFI_UNICAST), self._advertisements(i), {}, encode)
+        self.assertEqual(len(self.updateCache.entries), UpdateCache.MAX_ENTRIES)
+        # The least recently used entry was dropped
+        self.updateCache.getUpdates((AFI_INET, SAFI_UNICAST), set(), {}, encode)
+        self.assertEqual(encode.call_count, UpdateCache.MAX_ENTRIES + 2)
+
 
 class NaiveConstructAndSendTestCase(unittest.TestCase):
 
@@ -7,11 +7,12 @@ Copyright (C) 2006-2017 by Mark Bergsma <mark@nedworks.org>
 LVS Squid balancer/monitor for managing the Wikimedia Squid servers using LVS
 """
 
-from twisted.internet import reactor
+from twisted.internet import defer, reactor, task
 from twisted.internet.error import CannotListenError
 
+from pybal.bgpspeaker import BGPSpeakerProcess
 from pybal.util import log
-from pybal.bgp import bgp, peering as bgppeering, attributes as attrs
+from pybal.bgp import bgp, bfd, peering as bgppeering, attributes as attrs
 from pybal.bgp.ip import IPv4IP, IPv6IP
 from pybal.metrics import Gauge
 
@@ -28,9 +29,24 @@ class BGPFailover:
         'subsystem': 'bgp'
     }
     metrics = {
-        'enabled': Gauge('enabled', 'BGP Enabled', **metric_keywords)
+        'enabled': Gauge('enabled', 'BGP Enabled', **metric_keywords),
+        'shutdown_phase': Gauge(
+            'shutdown_phase',
+            'BGP session shutdown phase (0: running, 1: draining, 2: closed)',
+            labelnames=('peer',), **metric_keywords),
+        'prefix_healthy': Gauge(
+            'prefix_healthy',
+            'Service IP has enough pooled capacity to be announced normally',
+            labelnames=('prefix',), **metric_keywords),
+        'prefix_med': Gauge(
+            'prefix_med',
+            'Dynamic MED of a service IP',
+            labelnames=('prefix',), **metric_keywords)
     }
 
+    # Shutdown phases of a BGP session
+    PHASE_RUNNING, PHASE_DRAINING, PHASE_CLOSED = range(3)
+
     def __init__(self, globalConfig):
         # Store globalconfig so setup() can check whether BGP is enabled.
         self.globalConfig = globalConfig
@@ -48,6 +64,92 @@ class BGPFailover:
 
         self.defaultMED = self.globalConfig.getint('bgp-med', 0)
 
+        # Graceful restart (RFC 4724): keep our routes with the peers
+        # while PyBal restarts, as LVS keeps forwarding meanwhile
+        if self.globalConfig.getboolean('bgp-graceful-restart', False):
+            self.restartTime = self.globalConfig.getint('bgp-graceful-restart-time', 120)
+            if not 0 < self.restartTime <= bgp.GR_MAX_RESTART_TIME:
+                raise ValueError("bgp-graceful-restart-time must be between 1 and {}".format(
+                    bgp.GR_MAX_RESTART_TIME))
+        else:
+            self.restartTime = None
+
+        # Graceful shutdown (RFC 8326): before withdrawing on shutdown,
+        # announce the prefixes as less preferred for a while, so the
+        # routers can move the traffic to another LVS first
+        if self.globalConfig.getboolean('bgp-graceful-shutdown', False):
+            self.drainTime = self.globalConfig.getfloat('bgp-graceful-shutdown-time', 30.0)
+            self.drainCommunity = self.globalConfig.getboolean(
+                'bgp-graceful-shutdown-community', True)
+            self.drainMED = self.globalConfig.getint('bgp-graceful-shutdown-med', 0) or None
+            if self.drainTime < 0:
+                raise ValueError("bgp-graceful-shutdown-time must not be negative")
+            if not self.drainCommunity and self.drainMED is None:
+                raise ValueError(
+                    "bgp-graceful-shutdown needs bgp-graceful-shutdown-community "
+                    "or bgp-graceful-shutdown-med")
+            # With graceful restart the peers keep our routes while we're
+            # away, so drained routes would shift the traffic away and back
+            if self.restartTime is not None:
+                raise ValueError(
+                    "bgp-graceful-shutdown can't be combined with bgp-graceful-restart")
+        else:
+            self.drainTime = None
+
+        # Health gating: a service IP is withdrawn, or announced with
+        # bgp-health-med, while all its services have less pooled capacity
+        # than bgp-health-threshold. It is announced normally again once
+        # it has been healthy for bgp-health-hold-down seconds.
+        self.healthThreshold = self.globalConfig.getfloat('bgp-health-threshold', 0.0)
+        self.healthMED = self.globalConfig.getint('bgp-health-med', 0) or None
+        self.healthHoldDown = self.globalConfig.getfloat('bgp-health-hold-down', 30.0)
+        if not 0.0 <= self.healthThreshold <= 1.0:
+            raise ValueError("bgp-health-threshold must be between 0 and 1")
+        self.unhealthyPrefixes = set()
+        self.recoveryCalls = {}
+
+        # Dynamic MED: raise the MED of a service IP by up to
+        # bgp-dynamic-med-range as its pooled capacity drops, so that
+        # routers prefer better provisioned LVS instances. The MED only
+        # follows capacity changes of at least bgp-dynamic-med-hysteresis,
+        # and changes at most once per bgp-dynamic-med-interval seconds.
+        self.dynamicMED = self.globalConfig.getboolean('bgp-dynamic-med', False)
+        self.medRange = self.globalConfig.getint('bgp-dynamic-med-range', 100)
+        self.medHysteresis = self.globalConfig.getfloat('bgp-dynamic-med-hysteresis', 0.1)
+        self.medInterval = self.globalConfig.getfloat('bgp-dynamic-med-interval', 60.0)
+        if self.medRange < 0 or self.medHysteresis < 0 or self.medInterval < 0:
+            raise ValueError("bgp-dynamic-med options must not be negative")
+        # The current (MED, capacity) of every prefix with a dynamic MED
+        self.dynamicMEDs = {}
+        self.medChangeTimes = {}
+        self.medUpdateCalls = {}
+
+        # BFD (RFC 5880): detect a failed peer within bgp-bfd-multiplier
+        # times bgp-bfd-interval milliseconds, instead of the hold time
+        self.bfd = self.globalConfig.getboolean('bgp-bfd', False)
+        self.bfdInterval = self.globalConfig.getint('bgp-bfd-interval', 300)
+        self.bfdMultiplier = self.globalConfig.getint('bgp-bfd-multiplier', 3)
+        if self.bfd and (self.bfdInterval <= 0 or not 0 < self.bfdMultiplier < 256):
+            raise ValueError("Invalid bgp-bfd-interval or bgp-bfd-multiplier")
+        self.bfdSessions = {}
+
+        # Minimum Route Advertisement Interval in seconds: batch the
+        # changes to every peer into one update per interval. The
+        # interval of individual peers can be set in bgp-peer-mrai,
+        # a python dict of peer address to seconds.
+        self.mrai = self.globalConfig.getfloat('bgp-mrai', 0.0)
+        self.peerMRAI = eval(self.globalConfig.get('bgp-peer-mrai', '{}'))
+        if not isinstance(self.peerMRAI, dict):
+            raise ValueError("bgp-peer-mrai is not a python dict")
+        if any(mrai < 0 for mrai in [self.mrai] + self.peerMRAI.values()):
+            raise ValueError("Invalid bgp-mrai or bgp-peer-mrai")
+
+        # The current Advertisement of every prefix. They are reused as
+        # long as they don't change, so the peerings only send differences
+        self.prefixAdvertisements = {}
+        self.speaker = None
+        self.shuttingDown = False
+
         try:
             self.nexthopIPv4 = self.globalConfig['bgp-nexthop-ipv4']
         except KeyError:
@@ -70,15 +172,46 @@ class BGPFailover:
         if not self.globalConfig.getboolean('bgp', False):
             return
 
-        try:
-            advertisements = self.buildAdvertisements()
+        if self.healthThreshold or self.dynamicMED:
+            for states in self.ipServices.itervalues():
+                for state in states:
+                    state['lvsservice'].capacityCallbacks.append(
+                        self.serviceCapacityChanged)
+
+        addressFamilies = set(self.prefixes.keys())
+        if self.globalConfig.getboolean('bgp-speaker-process', False):
+            # Run the BGP sessions in a child process with its own
+            # reactor, isolated from the monitoring load
+            self.speaker = BGPSpeakerProcess(reactor, self.globalConfig, addressFamilies)
+            if self.drainTime:
+                # The speaker drains its sessions before exiting
+                self.speaker.stopTimeout += self.drainTime
+            self.speaker.setAdvertisements(self.buildAdvertisements())
+            log.info("Starting BGP speaker process", system="bgp")
+            self.speaker.start()
+            reactor.addSystemEventTrigger('before', 'shutdown', self.speaker.stop)
+        else:
+            self.startPeerings(addressFamilies, self.buildAdvertisements())
+
+    def startPeerings(self, addressFamilies, advertisements):
+        """
+        Starts the BGP sessions with all peers, announcing advertisements
+        """
 
+        # All peers get the same advertisements, encode them only once
+        updateCache = bgppeering.UpdateCache()
+
+        try:
             for peerAddr in self.peerAddresses:
                 peering = bgppeering.NaiveBGPPeering(self.myASN, peerAddr)
-                peering.setEnabledAddressFamilies(set(self.prefixes.keys()))
+                peering.updateCache = updateCache
+                peering.restartTime = self.restartTime
+                peering.mrai = self.peerMRAI.get(peerAddr, self.mrai)
+                peering.setEnabledAddressFamilies(addressFamilies)
                 peering.setAdvertisements(advertisements)
 
                 log.info("Starting BGP session with peer {}".format(peerAddr))
+                self.metrics['shutdown_phase'].labels(peer=peerAddr).set(self.PHASE_RUNNING)
                 peering.automaticStart()
                 self.peerings[peerAddr] = peering
                 reactor.addSystemEventTrigger('before', 'shutdown', self.closeSession, peering)
@@ -98,18 +231,111 @@ class BGPFailover:
                 try:
                     reactor.listenTCP(
                         bgp_local_port,
-                        peering.BGPServerFactory(self.peerings),
+                        bgppeering.BGPServerFactory(self.peerings),
                         interface=ip)
                 except CannotListenError as e:
                     log.critical(
                         "Could not listen for BGP connections: " + str(e))
                     raise
 
+            if self.bfd:
+                self.startBFD()
+
+    def startBFD(self):
+        """
+        Starts BFD sessions with all peers, which close the BGP sessions
+        when they go down
+        """
+
+        dualStack = any(':' in peerAddr for peerAddr in self.peerAddresses)
+        interface = self.globalConfig.get('bgp-bfd-local-ip', '::' if dualStack else '')
+        listener = bfd.BFDListener()
+        try:
+            reactor.listenUDP(bfd.PORT, listener, interface=interface)
+        except CannotListenError as e:
+            log.critical("Could not listen for BFD packets: " + str(e))
+            raise
+
+        for peerAddr in self.peerAddresses:
+            session = bfd.BFDSession(listener, peerAddr,
+                                     desiredMinTx=self.bfdInterval * 1000,
+                                     requiredMinRx=self.bfdInterval * 1000,
+                                     detectMult=self.bfdMultiplier)
+            session.stateCallbacks.append(self.peerings[peerAddr].bfdStateChanged)
+            log.info("Starting BFD session with peer {}".format(peerAddr))
+            session.start()
+            self.bfdSessions[peerAddr] = session
+
     def closeSession(self, peering):
-        log.info("Clearing session to {}".format(peering.peerAddr))
-        # Withdraw all announcements
-        peering.setAdvertisements(set())
-        return peering.manualStop()
+        """
+        Closes the session with a peer on shutdown, after draining it
+        if graceful shutdown is enabled. Returns a Deferred that fires
+        when the session has been closed.
+        """
+
+        # No more health driven updates
+        self.shuttingDown = True
+
+        if self.drainTime is not None and peering.estabProtocol is not None:
+            d = self.drainSession(peering)
+        else:
+            d = defer.succeed(None)
+        return d.addCallback(lambda _: self._stopSession(peering))
+
+    def drainSession(self, peering):
+        """
+        Re-announces all advertisements to the peer as less preferred,
+        and returns a Deferred that fires after the drain period.
+        """
+
+        log.info("Draining session to {} for {}s".format(peering.peerAddr, self.drainTime))
+        self.metrics['shutdown_phase'].labels(peer=peering.peerAddr).set(self.PHASE_DRAINING)
+        advertisements = set().union(*peering.toAdvertise.values())
+        peering.setAdvertisements(self.drainAdvertisements(advertisements))
+        peering.flushUpdates()
+        return task.deferLater(reactor, self.drainTime, lambda: None)
+
+    def drainAdvertisements(self, advertisements):
+        """
+        Returns a copy of advertisements with the GRACEFUL_SHUTDOWN
+        community and/or the drain MED set.
+        """
+
+        drained = set()
+        for ad in advertisements:
+            attributes = attrs.AttributeDict(ad.attributes)
+            if self.drainCommunity:
+                communities = attributes.get(attrs.CommunityAttribute)
+                communities = list(communities.value) if communities else []
+                if attrs.COMMUNITY_GRACEFUL_SHUTDOWN not in communities:
+                    communities.append(attrs.COMMUNITY_GRACEFUL_SHUTDOWN)
+                attributes[attrs.CommunityAttribute] = attrs.CommunityAttribute(communities)
+            if self.drainMED is not None:
+                attributes[attrs.MEDAttribute] = attrs.MEDAttribute(self.drainMED)
+            drained.add(bgp.Advertisement(
+                ad.prefix, attrs.FrozenAttributeDict(attributes), ad.addressfamily))
+        return drained
+
+    def _stopSession(self, peering):
+        self.metrics['shutdown_phase'].labels(peer=peering.peerAddr).set(self.PHASE_CLOSED)
+        if self.restartTime is not None:
+            # Leave the announcements with the peer until we're back,
+            # or the restart time has passed
+            log.info("Closing session to {} for graceful restart".format(peering.peerAddr))
+            d = peering.gracefulStop()
+        else:
+            log.info("Clearing session to {}".format(peering.peerAddr))
+            # Withdraw all announcements
+            peering.setAdvertisements(set())
+            peering.flushUpdates()
+            d = peering.manualStop()
+
+        # Take BFD down administratively after BGP, so the peer
+        # doesn't consider it a failure
+        bfdSession = self.bfdSessions.pop(peering.peerAddr, None)
+        if bfdSession is not None:
+            bfdSession.stop()
+        return d
 
     def buildAdvertisements(self):
         baseAttrs = attrs.AttributeDict([attrs.OriginAttribute(), attrs.ASPathAttribute(self.asPath)])
@@ -125,27 +351,170 @@ class BGPFailover:
                 raise ValueError("Unsupported address family {}".format(af))
 
             for prefix in self.prefixes[af]:
-                attributes = bgp.AttributeDict(afAttrs)
-                # This service IP may use a non-default MED
-                med = self.ipServices[prefix][0]['med'] # Guaranteed to exist, may be None
+                med = self.prefixMED(prefix)
                 if med is None:
-                    attributes[attrs.MEDAttribute] = attrs.MEDAttribute(self.defaultMED)
-                else:
-                    attributes[attrs.MEDAttribute] = attrs.MEDAttribute(med)
+                    # Withdrawn
+                    continue
 
-                attributes = attrs.FrozenAttributeDict(attributes)
-                advertisements.add(bgp.Advertisement(prefix, attributes, af))
+                advertisement = self.prefixAdvertisements.get(prefix)
+                if (advertisement is None
+                        or advertisement.attributes[attrs.MEDAttribute].value != med):
+                    attributes = bgp.AttributeDict(afAttrs)
+                    attributes[attrs.MEDAttribute] = attrs.MEDAttribute(med)
+                    attributes = attrs.FrozenAttributeDict(attributes)
+                    advertisement = bgp.Advertisement(prefix, attributes, af)
+                    self.prefixAdvertisements[prefix] = advertisement
+                advertisements.add(advertisement)
 
         return advertisements
 
-    @classmethod
-    def associateService(cls, ip, lvsservice, med):
+    def prefixMED(self, prefix):
+        """
+        Returns the MED to announce prefix with, or None if it should
+        be withdrawn.
+        """
+
+        if prefix in self.unhealthyPrefixes:
+            return self.healthMED
+        if prefix in self.dynamicMEDs:
+            return self.dynamicMEDs[prefix][0]
+        return self.staticMED(prefix)
+
+    def staticMED(self, prefix):
+        """Returns the configured MED of prefix"""
+
+        # This service IP may use a non-default MED
+        med = self.ipServices[prefix][0]['med'] # Guaranteed to exist, may be None
+        if med is None:
+            return self.defaultMED
+        return med
+
+    def prefixCapacity(self, prefix):
+        """
+        Returns the lowest known pooled capacity of the services of
+        prefix, or 1.0 if none is known yet.
+        """
+
+        capacities = [state['lvsservice'].capacity for state in self.ipServices[prefix]
+                      if state['lvsservice'].capacity is not None]
+        return min(capacities) if capacities else 1.0
+
+    def updateAdvertisements(self):
+        """Sends the current advertisements to the peers"""
+
+        if self.shuttingDown:
+            return
+
+        advertisements = self.buildAdvertisements()
+        if self.speaker is not None:
+            self.speaker.setAdvertisements(advertisements)
+        else:
+            for peering in self.peerings.itervalues():
+                peering.setAdvertisements(advertisements)
+
+    def serviceCapacityChanged(self, lvsservice):
+        """
+        Called when the pooled capacity of an LVS service has changed.
+        Updates the announcement of its service IP.
+        """
+
+        af, prefix = self.ipPrefix(lvsservice.ip)
+        changed = False
+        if self.healthThreshold:
+            changed |= self._updatePrefixHealth(prefix)
+        if self.dynamicMED:
+            changed |= self._updateDynamicMED(prefix)
+        if changed:
+            self.updateAdvertisements()
+
+    def _updatePrefixHealth(self, prefix):
+        """
+        Withdraws prefix when it has become unhealthy, or schedules its
+        announcement when it has recovered. Returns True if the
+        announcement has changed.
+        """
+
+        # A service IP is healthy as long as one of its services is
+        healthy = any(state['lvsservice'].capacity is None
+                      or state['lvsservice'].capacity >= self.healthThreshold
+                      for state in self.ipServices[prefix])
+
+        if not healthy:
+            recoveryCall = self.recoveryCalls.pop(prefix, None)
+            if recoveryCall is not None:
+                recoveryCall.cancel()
+            if prefix not in self.unhealthyPrefixes:
+                log.warn("Service IP {} has too little pooled capacity, {}".format(
+                    prefix, "withdrawing" if self.healthMED is None else "raising MED"),
+                    system="bgp")
+                self.unhealthyPrefixes.add(prefix)
+                self.metrics['prefix_healthy'].labels(prefix=str(prefix)).set(0)
+                return True
+        elif prefix in self.unhealthyPrefixes and prefix not in self.recoveryCalls:
+            log.info("Service IP {} has recovered, announcing in {}s".format(
+                prefix, self.healthHoldDown), system="bgp")
+            self.recoveryCalls[prefix] = reactor.callLater(
+                self.healthHoldDown, self._prefixRecovered, prefix)
+        return False
+
+    def _prefixRecovered(self, prefix):
+        del self.recoveryCalls[prefix]
+        self.unhealthyPrefixes.discard(prefix)
+        self.metrics['prefix_healthy'].labels(prefix=str(prefix)).set(1)
+        self.updateAdvertisements()
+
+    def _updateDynamicMED(self, prefix):
+        """
+        Updates the dynamic MED of prefix from its pooled capacity,
+        subject to hysteresis and rate limiting. Returns True if the
+        MED has changed.
+        """
+
+        if prefix in self.medUpdateCalls:
+            # Rate limited, the pending update will pick up the change
+            return False
+
+        capacity = self.prefixCapacity(prefix)
+        staticMED = self.staticMED(prefix)
+        med, medCapacity = self.dynamicMEDs.get(prefix, (staticMED, 1.0))
+        newMED = staticMED + int(round((1.0 - capacity) * self.medRange))
+        if newMED == med:
+            return False
+        # Small changes are ignored, but the ends of the range are always
+        # reached, so a recovered prefix gets its static MED back
+        if (newMED not in (staticMED, staticMED + self.medRange)
+                and abs(capacity - medCapacity) < self.medHysteresis):
+            return False
+
+        wait = self.medChangeTimes.get(prefix, 0) + self.medInterval - reactor.seconds()
+        if prefix in self.medChangeTimes and wait > 0:
+            self.medUpdateCalls[prefix] = reactor.callLater(wait, self._delayedMEDUpdate, prefix)
+            return False
+
+        log.info("Changing MED of service IP {} from {} to {} for pooled capacity {:.2f}".format(
+            prefix, med, newMED, capacity), system="bgp")
+        self.dynamicMEDs[prefix] = (newMED, capacity)
+        self.medChangeTimes[prefix] = reactor.seconds()
+        self.metrics['prefix_med'].labels(prefix=str(prefix)).set(newMED)
+        return True
+
+    def _delayedMEDUpdate(self, prefix):
+        del self.medUpdateCalls[prefix]
+        if self._updateDynamicMED(prefix):
+            self.updateAdvertisements()
+
+    @staticmethod
+    def ipPrefix(ip):
+        """Returns the address family and prefix of a service IP"""
+
         if ':' not in ip:
-            af = (bgp.AFI_INET, bgp.SAFI_UNICAST)
-            prefix = IPv4IP(ip)
+            return (bgp.AFI_INET, bgp.SAFI_UNICAST), IPv4IP(ip)
         else:
-            af = (bgp.AFI_INET6, bgp.SAFI_UNICAST)
-            prefix = IPv6IP(ip)
+            return (bgp.AFI_INET6, bgp.SAFI_UNICAST), IPv6IP(ip)
+
+    @classmethod
+    def associateService(cls, ip, lvsservice, med):
+        af, prefix = cls.ipPrefix(ip)
 
         # All services need to agree on the same MED for this IP
         if prefix in cls.ipServices and not med == cls.ipServices[prefix][0]['med']:
@@ -0,0 +1,308 @@
+"""
+bgpspeaker.py
+
+Isolated BGP speaker process for PyBal
+
+With bgp-speaker-process set, the BGP sessions are not run in the main
+PyBal process, but in a child process with its own reactor, so their
+keepalives can't be delayed by monitoring load in the main process.
+The main process pushes the advertisements to the speaker over the
+speaker's stdin, and the speaker reports BGP session state changes
+over its stdout, with one JSON object per line. The main process sends:
+
+    {"op": "configure", "configuration": {...}, "addressFamilies": [...],
+     "advertisements": [...]}
+    {"op": "advertise", "advertisements": [...]}
+
+and the speaker reports:
+
+    {"op": "session", "peer": "192.0.2.254", "established": true}
+
+The speaker closes its BGP sessions as an in-process BGPFailover would
+on shutdown, and exits when its stdin is closed.
+"""
+
+# Python imports
+import json, logging, os, sys
+
+# Twisted imports
+from twisted.internet import defer, error, protocol
+from twisted.protocols import basic
+
+# Pybal imports
+from pybal import util
+from pybal.bgp import bgp, peering as bgppeering
+from pybal.bgp.attributes import FrozenAttributeDict
+from pybal.bgp.ip import IPPrefix, IPv4IP, IPv6IP
+from pybal.metrics import Counter
+
+log = util.log
+
+
+def encodeAdvertisement(advertisement):
+    """Encodes an Advertisement to a JSON serializable dict"""
+
+    return {
+        'af': list(advertisement.addressfamily),
+        'prefix': advertisement.prefix.packed(pad=True).encode('hex'),
+        'prefixlen': advertisement.prefix.prefixlen,
+        'attributes': bgp.BGP.encodeAttributes(advertisement.attributes).encode('hex')
+    }
+
+
+def decodeAdvertisement(data):
+    """Decodes an Advertisement encoded by encodeAdvertisement"""
+
+    afi, safi = data['af']
+    packed = str(data['prefix']).decode('hex')
+    if afi == bgp.AFI_INET and data['prefixlen'] == 32:
+        prefix = IPv4IP(packed)
+    elif afi == bgp.AFI_INET6 and data['prefixlen'] == 128:
+        prefix = IPv6IP(packed=packed)
+    else:
+        prefix = IPPrefix((packed, data['prefixlen']), afi)
+    attributes = FrozenAttributeDict(bgp.BGP.parseEncodedAttributes(
+        str(data['attributes']).decode('hex')))
+    return bgp.Advertisement(prefix, attributes, (afi, safi))
+
+
+class BGPSpeakerProcess(protocol.ProcessProtocol):
+    """
+    Runs the BGP speaker in a child process, and keeps it running:
+    a speaker that exits unexpectedly is restarted, and given the
+    current advertisements again.
+    """
+
+    # Delay before restarting a speaker that exited
+    RESTART_DELAY = 1.0
+    # Time to wait for the speaker to close its sessions on shutdown
+    STOP_TIMEOUT = 10.0
+
+    MAX_LINE_LENGTH = 65536
+
+    metric_keywords = {
+        'namespace': 'pybal',
+        'subsystem': 'bgp'
+    }
+
+    metrics = {
+        'speaker_restarts_total': Counter(
+            'speaker_restarts_total', 'BGP speaker process restarts',
+            **metric_keywords)
+    }
+
+    def __init__(self, reactor, globalConfig, addressFamilies):
+        self.reactor = reactor
+        self.globalConfig = globalConfig
+        self.addressFamilies = addressFamilies
+        self.advertisements = set()
+        # Peers with an established BGP session
+        self.established = set()
+
+        self.running = False
+        self.stopping = False
+        self.stopDeferred = None
+        self.stopTimeout = self.STOP_TIMEOUT
+        self.buffer = ''
+
+    def start(self):
+        """Spawns the speaker process"""
+
+        self.buffer = ''
+        self.reactor.spawnProcess(
+            self, sys.executable,
+            [sys.executable, '-c', 'from pybal.bgpspeaker import main; main()'],
+            env=os.environ,
+            childFDs={0: 'w', 1: 'r', 2: 2})
+        self.running = True
+        # The sessions start with the complete set of advertisements,
+        # so End-of-RIB follows the initial update
+        self.sendMessage({
+            'op': 'configure',
+            'configuration': dict(self.globalConfig),
+            'addressFamilies': [list(af) for af in self.addressFamilies],
+            'advertisements': [encodeAdvertisement(ad)
+                               for ad in self.advertisements]
+        })
+
+    def stop(self):
+        """
+        Stops the speaker, which closes its BGP sessions first. Returns
+        a Deferred that fires when the speaker has exited.
+        """
+
+        self.stopping = True
+        if not self.running:
+            return defer.succeed(None)
+
+        self.stopDeferred = defer.Deferred()
+        self.transport.closeStdin()
+        killCall = self.reactor.callLater(self.stopTimeout, self._kill)
+
+        def cancelKill(result):
+            if killCall.active():
+                killCall.cancel()
+            return result
+        return self.stopDeferred.addBoth(cancelKill)
+
+    def setAdvertisements(self, advertisements):
+        """Sets the advertisements the speaker should announce"""
+
+        self.advertisements = set(advertisements)
+        self._sendAdvertisements()
+
+    def sendMessage(self, message):
+        """Sends a message (dict) to the speaker"""
+
+        # The speaker's stdin is closed once it's stopping
+        if self.running and not self.stopping:
+            self.transport.write(json.dumps(message) + '\n')
+
+    def outReceived(self, data):
+        self.buffer += data
+        while '\n' in self.buffer:
+            line, self.buffer = self.buffer.split('\n', 1)
+            try:
+                message = json.loads(line)
+                if message['op'] == 'session':
+                    self.sessionStateChanged(str(message['peer']),
+                                             message['established'])
+            except (ValueError, KeyError, TypeError):
+                log.warn("Invalid message from the BGP speaker: {!r}".format(
+                    line[:80]), system="bgp")
+        if len(self.buffer) > self.MAX_LINE_LENGTH:
+            self.buffer = ''
+
+    def sessionStateChanged(self, peer, established):
+        """Called when the speaker reports a BGP session state change"""
+
+        log.info("BGP session with peer {} {}".format(
+            peer, 'established' if established else 'gone'), system="bgp")
+        if established:
+            self.established.add(peer)
+        else:
+            self.established.discard(peer)
+        labels = {'local_asn': self.globalConfig.getint('bgp-local-asn'),
+                  'peer': peer}
+        bgppeering.BGPPeering.metrics['bgp_session_established'].labels(
+            **labels).set(int(established))
+
+    def processEnded(self, reason):
+        self.running = False
+        # The sessions have gone with the speaker
+        for peer in list(self.established):
+            self.sessionStateChanged(peer, False)
+
+        if self.stopping:
+            if self.stopDeferred is not None:
+                d, self.stopDeferred = self.stopDeferred, None
+                d.callback(None)
+            return
+
+        log.error("BGP speaker exited: {}".format(reason.getErrorMessage()),
+                  system="bgp")
+        self.metrics['speaker_restarts_total'].inc()
+        self.reactor.callLater(self.RESTART_DELAY, self._restart)
+
+    def _restart(self):
+        if not self.stopping and not self.running:
+            self.start()
+
+    def _kill(self):
+        try:
+            self.transport.signalProcess('KILL')
+        except error.ProcessExitedAlready:
+            pass
+
+    def _sendAdvertisements(self):
+        self.sendMessage({
+            'op': 'advertise',
+            'advertisements': [encodeAdvertisement(ad)
+                               for ad in self.advertisements]
+        })
+
+
+class BGPSpeakerControlProtocol(basic.LineReceiver):
+    """
+    The speaker side of the connection to the main process. Runs the
+    BGP peerings as an in-process BGPFailover would.
+    """
+
+    delimiter = '\n'
+    MAX_LENGTH = 16 << 20
+
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.failover = None
+        # The current Advertisement of every (address family, prefix)
+        self.advertisements = {}
+
+    def lineReceived(self, line):
+        try:
+            message = json.loads(line)
+            handler = getattr(self, 'do_' + message['op'])
+        except (ValueError, KeyError, TypeError, AttributeError):
+            log.warn("Invalid message from the main process: {!r}".format(
+                line[:80]), system="bgp")
+            return
+        handler(message)
+
+    def do_configure(self, message):
+        from pybal.bgpfailover import BGPFailover
+
+        configuration = util.ConfigDict(
+            (str(k), v.encode('utf-8') if isinstance(v, unicode) else v)
+            for k, v in message['configuration'].iteritems())
+        if configuration.getboolean('debug', False):
+            util.PyBalLogObserver.level = logging.DEBUG
+
+        self.failover = BGPFailover(configuration)
+        addressFamilies = set(tuple(af) for af in message['addressFamilies'])
+        advertisements = self.decodeAdvertisements(message.get('advertisements', []))
+        self.failover.startPeerings(addressFamilies, advertisements)
+        for peering in self.failover.peerings.itervalues():
+            peering.sessionCallbacks.append(self.sessionStateChanged)
+
+    def do_advertise(self, message):
+        if self.failover is None:
+            return
+        advertisements = self.decodeAdvertisements(message['advertisements'])
+        for peering in self.failover.peerings.itervalues():
+            peering.setAdvertisements(advertisements)
+
+    def decodeAdvertisements(self, advertisements):
+        """
+        Decodes a list of advertisements, reusing the current
+        Advertisement instances for the unchanged ones, so that the
+        peerings only send the differences.
+        """
+
+        previous, self.advertisements = self.advertisements, {}
+        for data in advertisements:
+            advertisement = decodeAdvertisement(data)
+            key = (advertisement.addressfamily, advertisement.prefix)
+            current = previous.get(key)
+            if current is not None and current.attributes == advertisement.attributes:
+                advertisement = current
+            self.advertisements[key] = advertisement
+        return set(self.advertisements.itervalues())
+
+    def sessionStateChanged(self, peering, established):
+        self.sendLine(json.dumps({'op': 'session', 'peer': peering.peerAddr,
+                                  'established': established}))
+
+    def connectionLost(self, reason):
+        # Stopping the reactor closes the BGP sessions
+        try:
+            self.reactor.stop()
+        except error.ReactorNotRunning:
+            pass
+
+
+def main():
+    """Runs a BGP speaker on stdin and stdout"""
+
+    from twisted.internet import reactor, stdio
+
+    stdio.StandardIO(BGPSpeakerControlProtocol(reactor), reactor=reactor)
+    reactor.run()
@@ -65,6 +65,10 @@ class Coordinator:
             'depool_threshold',
             "Threshold of up servers vs total servers below which pybal can't depool any more",
             **metric_keywords),
+        'pooled_capacity': Gauge(
+            'pooled_capacity',
+            'Fraction of the server weight that is pooled and up',
+            **metric_keywords),
     }
 
     def __init__(self, lvsservice, configUrl):
@@ -125,7 +129,8 @@ class Coordinator:
               "reports server {host} ({status}) down: {reason}"
         log.error(msg.format(**data), system=self.lvsservice.name)
 
-        if server.up:
+        # The aggregation policy of the service may keep the server up
+        if server.up and not server.calcStatus():
             server.up = False
             if server.pool: self.depool(server)
 
@@ -161,6 +166,7 @@ class Coordinator:
             log.error(msg, system=self.lvsservice.name)
             self.metrics['could_not_depool_total'].labels(**self.metric_labels).inc()
         self._updatePooledDownMetrics()
+        self._updateCapacity()
 
     def repool(self, server):
         """
@@ -185,6 +191,7 @@ class Coordinator:
         # See if we can depool any servers that could not be depooled before
         while len(self.pooledDownServers) > 0 and self.canDepool():
             self.depool(self.pooledDownServers.pop())
+        self._updateCapacity()
 
     def canDepool(self):
         """Returns a boolean denoting whether another server can be depooled"""
@@ -205,6 +212,19 @@ class Coordinator:
         # configured threshold
         return upServerCount >= totalServerCount * self.lvsservice.getDepoolThreshold()
 
+    def pooledCapacity(self):
+        """
+        Returns the fraction of the total server weight that is pooled
+        and up, i.e. actually serving traffic
+        """
+
+        totalWeight = sum(server.weight for server in self.servers.itervalues())
+        if not totalWeight:
+            return 0.0
+        pooledWeight = sum(server.weight for server in self.servers.itervalues()
+                           if server.pool and server.up)
+        return float(pooledWeight) / totalWeight
+
     def onConfigUpdate(self, config):
         """
         Takes a dictionary of server hostnames to configuration dicts as the
@@ -291,6 +311,7 @@ class Coordinator:
             ).set(
                 len([s for s in self.servers.itervalues() if s.pool]))
         self._updatePooledDownMetrics()
+        self._updateCapacity()
 
     def _updateServerMetrics(self):
         """Update gauge metrics for servers on config change"""
@@ -315,3 +336,9 @@ class Coordinator:
         self.metrics['can_depool'].labels(
             **self.metric_labels
             ).set(self.canDepool() and 1 or 0)
+
+    def _updateCapacity(self):
+        """Hands the pooled capacity over to LVSService"""
+        capacity = self.pooledCapacity()
+        self.metrics['pooled_capacity'].labels(**self.metric_labels).set(capacity)
+        self.lvsservice.setCapacity(capacity)
@@ -189,6 +189,12 @@ class LVSService:
 
         self.configuration = configuration
 
+        # Fraction of the server weight that is pooled and up, None
+        # until known
+        self.capacity = None
+        # Callables called with (lvsservice) when the capacity changes
+        self.capacityCallbacks = []
+
         self.ipvsManager.DryRun = configuration.getboolean('dryrun', False)
         self.ipvsManager.Debug = configuration.getboolean('debug', False)
 
@@ -264,6 +270,14 @@ class LVSService:
 
         self.ipvsManager.modifyState(cmdList)
 
+    def setCapacity(self, capacity):
+        """Sets the fraction of the server weight that is pooled and up."""
+
+        if capacity != self.capacity:
+            self.capacity = capacity
+            for callback in self.capacityCallbacks:
+                callback(self)
+
     def initServer(self, server):
         """Initializes a server instance with LVS service specific
         configuration."""
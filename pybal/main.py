@@ -22,6 +22,9 @@ from twisted.internet import reactor
 from pybal import util, ipvs, instrumentation, etcd, kubernetes
 from pybal.bgpfailover import BGPFailover
 from pybal.coordinator import Coordinator
+from pybal.monitors.runcommand import RunCommandExecutor
+from pybal.scheduler import CheckAdmission, CheckScheduler
+from pybal.worker import MonitorWorkerPool
 
 log = util.log
 
@@ -71,6 +74,26 @@ def installSignalHandlers():
         signal.signal(sig, sighandler)
 
 
+def configureChecks(configdict, reactor):
+    """
+    Applies the global check limits in configdict to the monitors
+    running in reactor
+    """
+
+    # Limit the total check rate adaptive check intervals may speed up to
+    scheduler = CheckScheduler.forReactor(reactor)
+    scheduler.rateBudget = configdict.getfloat('check-rate-budget', 0) or None
+
+    # Limit the number of checks in flight, globally and per server
+    admission = CheckAdmission.forReactor(reactor)
+    admission.maxInFlight = configdict.getint('max-checks-in-flight', 0) or None
+    admission.maxPerServer = configdict.getint('max-checks-per-server', 0) or None
+
+    # Limit the number of concurrently running RunCommand processes
+    executor = RunCommandExecutor.forReactor(reactor)
+    executor.maxChildren = configdict.getint('runcommand-max-children', 0) or None
+
+
 def main():
     services, cliconfig = {}, {}
 
@@ -124,6 +147,13 @@ def main():
         else:
             util.PyBalLogObserver.level = logging.INFO
 
+        configureChecks(configdict, reactor)
+
+        # Shard the monitors over worker processes
+        workerPool = MonitorWorkerPool.forReactor(reactor)
+        workerPool.workers = configdict.getint('monitor-workers', 0)
+        workerPool.configuration = dict(configdict)
+
         bgpannouncement = BGPFailover(configdict)
         bgpannouncement.setup()
 
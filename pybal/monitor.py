@@ -10,11 +10,12 @@ import logging
 
 # Twisted imports
 import twisted.internet.reactor
-from twisted.internet import task
+from twisted.internet import defer
 
 # Pybal imports
 from . import util
-from pybal.metrics import Counter, Gauge
+from .scheduler import CheckAdmission, CheckScheduler, ScheduledCall
+from pybal.metrics import Counter, Gauge, Histogram
 
 
 _log = util._log
@@ -35,12 +36,27 @@ class MonitoringProtocol(object):
         'subsystem': 'monitor'
     }
 
+    # Few buckets, as there's a histogram for every service, server and
+    # monitor (and result or phase)
+    DURATION_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
     metrics = {
         'up_transitions_total': Counter('up_transitions_total', 'Monitor up transition count', **metric_keywords),
         'down_transitions_total': Counter('down_transitions_total', 'Monitor down transition count', **metric_keywords),
         'up_results_total': Counter('up_results_total', 'Monitor up result count', **metric_keywords),
         'down_results_total': Counter('down_results_total', 'Monitor down result count', **metric_keywords),
-        'status': Gauge('status', 'Monitor up status', **metric_keywords)
+        'status': Gauge('status', 'Monitor up status', **metric_keywords),
+        'check_interval_seconds': Gauge('check_interval_seconds', 'Monitor check interval', **metric_keywords),
+        'check_duration_seconds': Histogram(
+            'check_duration_seconds', 'Monitor check duration',
+            labelnames=metric_labelnames + ('result',),
+            namespace='pybal', subsystem='monitor',
+            buckets=DURATION_BUCKETS),
+        'check_phase_duration_seconds': Histogram(
+            'check_phase_duration_seconds', 'Monitor check phase duration',
+            labelnames=metric_labelnames + ('phase',),
+            namespace='pybal', subsystem='monitor',
+            buckets=DURATION_BUCKETS)
     }
 
     def __init__(self, coordinator, server, configuration={}, reactor=None):
@@ -110,6 +126,19 @@ class MonitoringProtocol(object):
             self.metrics['down_transitions_total'].labels(**self.metric_labels).inc()
             self.metrics['status'].labels(**self.metric_labels).set(0)
 
+    def observeCheckDuration(self, duration, result):
+        """Records the duration of a completed check"""
+        self.metrics['check_duration_seconds'].labels(
+            result=result, **self.metric_labels).observe(duration)
+
+    def observePhaseDuration(self, phase, duration):
+        """
+        Records the duration of a phase of a check, e.g. 'dns', 'connect',
+        'tls_handshake' or 'ttfb' (time to first byte)
+        """
+        self.metrics['check_phase_duration_seconds'].labels(
+            phase=phase, **self.metric_labels).observe(duration)
+
     def report(self, text, level=logging.DEBUG):
         """Common method for reporting/logging check results."""
         msg = "%s (%s): %s" % (
@@ -128,8 +157,15 @@ class MonitoringProtocol(object):
         return self.configuration.getint(
             '%s.%s' % (self.__name__.lower(), optionname), default)
 
-    def _getConfigString(self, optionname):
-        val = self.configuration[self.__name__.lower() + '.' + optionname]
+    def _getConfigFloat(self, optionname, default=None):
+        return self.configuration.getfloat(
+            '%s.%s' % (self.__name__.lower(), optionname), default)
+
+    def _getConfigString(self, optionname, default=None):
+        key = self.__name__.lower() + '.' + optionname
+        if default is not None and key not in self.configuration:
+            return default
+        val = self.configuration[key]
         if type(val) == str:
             return val
         else:
@@ -156,10 +192,19 @@ class MonitoringProtocol(object):
 class LoopingCheckMonitoringProtocol(MonitoringProtocol):
     """
     Class that sets up a looping call (self.check) to do a monitoring check with
-    a semi-fixed interval.
+    a semi-fixed interval. Checks are scheduled by the central CheckScheduler,
+    which spreads the checks of all monitors over their intervals.
+
+    If a fast and/or slow interval is configured, the interval adapts to
+    recent results: the fast interval is used for FAST_COUNT checks after
+    any change of result, and the slow interval after STABLE_COUNT
+    consistent results. Speeding up is subject to the rate budget of the
+    scheduler.
     """
 
     INTV_CHECK = 10
+    FAST_COUNT = 3
+    STABLE_COUNT = 30
 
     def __init__(self, coordinator, server, configuration={}, reactor=None):
 
@@ -173,7 +218,16 @@ class LoopingCheckMonitoringProtocol(MonitoringProtocol):
 
         self.intvCheck = self._getConfigInt('interval', self.INTV_CHECK)
 
+        # Adaptive check intervals
+        self.intvFast = self._getConfigInt('interval-fast', 0) or None
+        self.intvSlow = self._getConfigInt('interval-slow', 0) or None
+        self.fastCount = self._getConfigInt('fast-count', self.FAST_COUNT)
+        self.stableCount = self._getConfigInt('stable-count', self.STABLE_COUNT)
+        self.lastResult = None
+        self.resultStreak = 0
+
         self.checkCall = None
+        self.admissionDeferred = None
 
     def run(self):
         """
@@ -182,9 +236,11 @@ class LoopingCheckMonitoringProtocol(MonitoringProtocol):
 
         super(LoopingCheckMonitoringProtocol, self).run()
 
-        self.checkCall = task.LoopingCall(self.check)
-        self.checkCall.clock = self.reactor
+        self.checkCall = ScheduledCall(self._admittedCheck,
+                                       CheckScheduler.forReactor(self.reactor),
+                                       self.check)
         self.checkCall.start(self.intvCheck, now=False).addErrback(self.onCheckFailure)
+        self.metrics['check_interval_seconds'].labels(**self.metric_labels).set(self.intvCheck)
 
     def stop(self):
         """
@@ -193,12 +249,79 @@ class LoopingCheckMonitoringProtocol(MonitoringProtocol):
 
         if self.checkCall is not None and self.checkCall.running:
             self.checkCall.stop()
+        if self.admissionDeferred is not None:
+            self.admissionDeferred.cancel()
 
         super(LoopingCheckMonitoringProtocol, self).stop()
 
     def check(self):
         raise NotImplementedError()
 
+    def _admittedCheck(self, check):
+        """
+        Runs check once it has been admitted by the check admission
+        controller, and releases the admission when it finishes.
+        """
+
+        admission = CheckAdmission.forReactor(self.reactor)
+        key = self.server.host
+
+        def admitted(_):
+            self.admissionDeferred = None
+            return defer.maybeDeferred(check).addBoth(release)
+
+        def release(result):
+            admission.release(key)
+            return result
+
+        def cancelled(failure):
+            failure.trap(defer.CancelledError)
+            self.admissionDeferred = None
+
+        d = self.admissionDeferred = admission.acquire(key)
+        return d.addCallbacks(admitted, cancelled)
+
+    def _resultUp(self):
+        super(LoopingCheckMonitoringProtocol, self)._resultUp()
+        self._adaptInterval(True)
+
+    def _resultDown(self, reason=None):
+        super(LoopingCheckMonitoringProtocol, self)._resultDown(reason)
+        self._adaptInterval(False)
+
+    def _adaptInterval(self, result):
+        """
+        Keeps track of the streak of consistent results, and adapts the
+        check interval to it if a fast or slow interval is configured.
+        """
+
+        if self.lastResult is None:
+            # The first result is not a change
+            self.resultStreak = self.fastCount
+        elif result == self.lastResult:
+            self.resultStreak += 1
+        else:
+            self.resultStreak = 0
+        self.lastResult = result
+
+        if (not (self.intvFast or self.intvSlow)
+                or self.checkCall is None or not self.checkCall.running):
+            return
+
+        if self.resultStreak < self.fastCount:
+            interval = self.intvFast or self.intvCheck
+        elif self.resultStreak >= self.stableCount:
+            interval = self.intvSlow or self.intvCheck
+        else:
+            interval = self.intvCheck
+
+        interval = self.checkCall.scheduler.grantInterval(self.checkCall,
+                                                          interval)
+        if interval != self.checkCall.interval:
+            self.checkCall.setInterval(interval)
+            self.metrics['check_interval_seconds'].labels(
+                **self.metric_labels).set(interval)
+
     def onCheckFailure(self, failure):
         """
         Called when the looping call (check) throws an error/Failure
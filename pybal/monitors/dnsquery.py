@@ -6,17 +6,124 @@ DNS Monitor class implementation for PyBal
 """
 
 # Python imports
-import random, socket
+import itertools, random, socket
 import logging
 
 # Twisted imports
 from twisted.internet import defer
-from twisted.names import client, dns, error
-from twisted.python import runtime
+from twisted.names import client, common, dns, error
+from twisted.python import failure, runtime
 
 # Pybal imports
 from pybal import monitor
 from pybal.metrics import Gauge
+from pybal.util import PerReactor
+
+
+class DNSQueryEngine(PerReactor):
+    """
+    Resolver engine shared by all DNSQuery monitors, which multiplexes
+    the queries to all monitored DNS servers over a small pool of UDP
+    sockets, by query ID. Queries of which the response was truncated
+    are retried over TCP.
+    """
+
+    POOL_SIZE = 4
+
+    def __init__(self, reactor, poolSize=POOL_SIZE):
+        self.reactor = reactor
+        self.protocols = [dns.DNSDatagramProtocol(self, reactor=reactor)
+                          for i in range(poolSize)]
+        self.nextProtocol = itertools.cycle(self.protocols)
+        # TCP resolvers by server address, for truncated responses
+        self.tcpResolvers = {}
+
+    def query(self, address, query, timeout):
+        """
+        Sends query to the DNS server at address over UDP, using the next
+        socket of the pool. Returns a Deferred that fires with the
+        response Message, or errbacks with DNSQueryTimeoutError after
+        timeout seconds.
+        """
+
+        protocol = next(self.nextProtocol)
+        if protocol.transport is None:
+            # Sockets of the pool are opened on first use
+            protocol.startListening()
+        queryId = protocol.pickID()
+
+        def cancel(d):
+            try:
+                _, timer = protocol.liveMessages.pop(queryId)
+            except KeyError:
+                pass
+            else:
+                timer.cancel()
+            protocol.removeResend(queryId)
+
+        def done(result):
+            protocol.removeResend(queryId)
+            return result
+
+        d = defer.Deferred(cancel)
+        protocol.query(address, [query], timeout, queryId
+            ).addBoth(done).chainDeferred(d)
+        return d
+
+    def queryTCP(self, address, query, timeout):
+        """Sends query to the DNS server at address over TCP"""
+
+        try:
+            resolver = self.tcpResolvers[address]
+        except KeyError:
+            resolver = self.tcpResolvers[address] = client.Resolver(
+                servers=[address], reactor=self.reactor)
+        return resolver.queryTCP([query], timeout)
+
+    def messageReceived(self, message, protocol, address=None):
+        """Called for responses to queries that are no longer awaited"""
+        pass
+
+
+class SharedResolver(common.ResolverBase):
+    """
+    Resolver for a single (multi-address) DNS server, which queries it
+    through the shared DNSQueryEngine. Successive attempts after a
+    timeout go to the next address of the server.
+    """
+
+    TIMEOUT = (5,)
+
+    def __init__(self, engine, servers):
+        common.ResolverBase.__init__(self)
+        self.engine = engine
+        self.servers = servers
+
+    def _lookup(self, name, cls, type, timeout):
+        query = dns.Query(name, type, cls)
+        return self._query(query, timeout or self.TIMEOUT, 0)
+
+    def _query(self, query, timeouts, attempt):
+        address = self.servers[attempt % len(self.servers)]
+
+        def retry(failure):
+            failure.trap(error.DNSQueryTimeoutError)
+            if attempt + 1 < len(timeouts):
+                return self._query(query, timeouts, attempt + 1)
+            return failure
+
+        d = self.engine.query(address, query, timeouts[attempt])
+        d.addCallback(self._filterAnswers, address, query, timeouts[attempt])
+        return d.addErrback(retry)
+
+    def _filterAnswers(self, message, address, query, timeout):
+        if message.trunc:
+            # The response didn't fit in a UDP datagram; retry over TCP
+            d = self.engine.queryTCP(address, query, timeout)
+            return d.addCallback(self._filterAnswers, address, query, timeout)
+        if message.rCode != dns.OK:
+            raise self.exceptionForCode(message.rCode)(message)
+        return (message.answers, message.authority, message.additional)
 
 
 class DNSQueryMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
@@ -27,6 +134,7 @@ class DNSQueryMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
     __name__ = 'DNSQuery'
 
     TIMEOUT_QUERY = 5
+    QUERIES_PER_CHECK = 1
 
     catchList = (defer.TimeoutError, error.DomainError,
                  error.AuthoritativeDomainError, error.DNSFormatError, error.DNSNameError,
@@ -60,6 +168,7 @@ class DNSQueryMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
         self.toQuery = self._getConfigInt('timeout', self.TIMEOUT_QUERY)
         self.hostnames = self._getConfigStringList('hostnames')
         self.failOnNXDOMAIN = self._getConfigBool('fail-on-nxdomain', False)
+        self.queriesPerCheck = self._getConfigInt('queries-per-check', self.QUERIES_PER_CHECK)
 
         self.resolver = None
         self.DNSQueryDeferred = None
@@ -70,10 +179,11 @@ class DNSQueryMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
 
         super(DNSQueryMonitoringProtocol, self).run()
 
-        # Create a resolver. Use the DNS server IPv4 addresses instead of
-        # self.server.ip as Twisted's createResolver (< 17.1.0) does not
-        # support querying a nameserver over IPv6.
-        self.resolver = client.createResolver([(ip, 53) for ip in self.server.ip4_addresses])
+        # Query the DNS server IPv4 addresses through the shared engine,
+        # as its socket pool is IPv4.
+        self.resolver = SharedResolver(
+            DNSQueryEngine.forReactor(self.reactor),
+            [(ip, 53) for ip in self.server.ip4_addresses])
 
     def stop(self):
         """Stop the monitoring"""
@@ -83,34 +193,67 @@ class DNSQueryMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
             self.DNSQueryDeferred.cancel()
 
     def check(self):
-        """Periodically called method that does a single uptime check."""
+        """
+        Periodically called method that does a single uptime check. A check
+        round queries queries-per-check randomly chosen hostnames at once,
+        and succeeds if all queries succeed.
+        """
 
-        hostname = random.choice(self.hostnames)
-        query = dns.Query(hostname, type=random.choice([dns.A, dns.AAAA]))
+        hostnames = random.sample(self.hostnames,
+                                  min(self.queriesPerCheck, len(self.hostnames)))
+        queries = [dns.Query(hostname, type=random.choice([dns.A, dns.AAAA]))
+                   for hostname in hostnames]
 
         self.checkStartTime = runtime.seconds()
 
-        if query.type == dns.A:
-            self.DNSQueryDeferred = self.resolver.lookupAddress(hostname, timeout=[self.toQuery])
-        elif query.type == dns.AAAA:
-            self.DNSQueryDeferred = self.resolver.lookupIPV6Address(hostname, timeout=[self.toQuery])
-
-        self.DNSQueryDeferred.addCallback(self._querySuccessful, query
-                ).addErrback(self._queryFailed, query
+        self.DNSQueryDeferred = defer.gatherResults(
+            [self._lookup(query) for query in queries], consumeErrors=True)
+        self.DNSQueryDeferred.addCallback(self._querySuccessful, queries
+                ).addErrback(self._queryFailed, queries
                 ).addBoth(self._checkFinished)
         return self.DNSQueryDeferred
 
-    def _querySuccessful(self, (answers, authority, additional), query):
-        """Called when the DNS query finished successfully."""
+    def _lookup(self, query):
+        """Looks up a single query"""
+
+        startTime = runtime.seconds()
 
-        if query.type in (dns.A, dns.AAAA):
+        def answered(result):
+            # Any response of the server, including error responses
+            if not isinstance(result, failure.Failure) or result.check(error.DomainError):
+                self.observePhaseDuration('dns', runtime.seconds() - startTime)
+            return result
+
+        if query.type == dns.A:
+            d = self.resolver.lookupAddress(query.name.name, timeout=[self.toQuery])
+        elif query.type == dns.AAAA:
+            d = self.resolver.lookupIPV6Address(query.name.name, timeout=[self.toQuery])
+        return d.addBoth(answered).addErrback(self._nameError, query)
+
+    def _nameError(self, failure, query):
+        """Treats NXDOMAIN as a successful query unless configured not to"""
+
+        failure.trap(error.DNSNameError)
+        if self.failOnNXDOMAIN:
+            return failure
+        self.report("%s NXDOMAIN" % query.name, level=logging.INFO)
+        return None
+
+    def _querySuccessful(self, results, queries):
+        """Called when the DNS queries finished successfully."""
+
+        resultStrs = []
+        for result, query in zip(results, queries):
+            if result is None:
+                # NXDOMAIN
+                continue
+            answers, authority, additional = result
             addressFamily = query.type == dns.A and socket.AF_INET or socket.AF_INET6
             addresses = " ".join([socket.inet_ntop(addressFamily, r.payload.address)
                                   for r in answers
                                   if r.type == query.type])
-            resultStr = "%s %s %s" % (query.name, dns.QUERY_TYPES[query.type], addresses)
-        else:
-            resultStr = None
+            resultStrs.append("%s %s %s" % (query.name, dns.QUERY_TYPES[query.type], addresses))
+        resultStr = "; ".join(resultStrs)
 
         duration = runtime.seconds() - self.checkStartTime
         self.report('DNS query successful, %.3f s' % (duration)
@@ -121,11 +264,17 @@ class DNSQueryMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
             result='successful',
             **self.metric_labels
             ).set(duration)
+        self.observeCheckDuration(duration, 'successful')
+
+        return results
 
-        return answers, authority, additional
+    def _queryFailed(self, failure, queries):
+        """Called when any of the DNS queries finished with a failure."""
 
-    def _queryFailed(self, failure, query):
-        """Called when the DNS query finished with a failure."""
+        # Unwrap the failure of the first failed query
+        failure.trap(defer.FirstError)
+        query = queries[failure.value.index]
+        failure = failure.value.subFailure
 
         queryStr = ", query: %s %s" % (query.name, dns.QUERY_TYPES[query.type])
 
@@ -138,10 +287,6 @@ class DNSQueryMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
             errorStr = "DNS server error" + queryStr
         elif failure.check(error.DNSNameError):
             errorStr = "%s NXDOMAIN" % query.name
-            if not self.failOnNXDOMAIN:
-                self.report(errorStr, level=logging.INFO)
-                self._resultUp()
-                return None
         elif failure.check(error.DNSQueryRefusedError):
             errorStr = "DNS query refused" + queryStr
         else:
@@ -159,6 +304,7 @@ class DNSQueryMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
             result='failed',
             **self.metric_labels
             ).set(duration)
+        self.observeCheckDuration(duration, 'failed')
 
         failure.trap(*self.catchList)
 
@@ -0,0 +1,357 @@
+"""
+icmpreachability.py
+
+ICMP reachability monitor class implementation for PyBal
+"""
+
+# Python imports
+import collections, errno, itertools, logging, os, socket, struct
+
+# Twisted imports
+from twisted.internet.interfaces import IReadDescriptor
+from zope.interface import implementer
+
+# Pybal imports
+from pybal import monitor
+from pybal.metrics import Counter, Gauge
+from pybal.scheduler import CheckScheduler, ScheduledCall
+from pybal.util import PerReactor, log
+
+
+def _checksum(data):
+    """Returns the Internet checksum of data"""
+
+    if len(data) % 2:
+        data += '\0'
+    total = sum(struct.unpack('!%dH' % (len(data) // 2), data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+@implementer(IReadDescriptor)
+class EchoSocket(object):
+    """
+    An ICMP socket of the ICMPEchoEngine for one address family, which
+    is an unprivileged ICMP datagram socket if allowed, and a raw socket
+    otherwise.
+    """
+
+    ECHO_REQUEST = {socket.AF_INET: 8, socket.AF_INET6: 128}
+    ECHO_REPLY = {socket.AF_INET: 0, socket.AF_INET6: 129}
+    PROTOCOL = {socket.AF_INET: socket.IPPROTO_ICMP, socket.AF_INET6: 58}
+
+    # type, code, checksum, identifier, sequence
+    HEADER = struct.Struct('!BBHHH')
+    PAYLOAD = 'pybal-icmp-echo!'
+
+    def __init__(self, engine, family):
+        self.engine = engine
+        self.family = family
+        try:
+            self.sock = socket.socket(family, socket.SOCK_DGRAM, self.PROTOCOL[family])
+            self.raw = False
+        except socket.error:
+            # Not in net.ipv4.ping_group_range; requires CAP_NET_RAW
+            self.sock = socket.socket(family, socket.SOCK_RAW, self.PROTOCOL[family])
+            self.raw = True
+        self.sock.setblocking(False)
+
+    def sendEcho(self, ip, identifier, sequence):
+        """Sends an echo request to ip"""
+
+        header = self.HEADER.pack(self.ECHO_REQUEST[self.family], 0, 0,
+                                  identifier, sequence)
+        if self.family == socket.AF_INET:
+            # The kernel computes ICMPv6 checksums
+            header = self.HEADER.pack(self.ECHO_REQUEST[self.family], 0,
+                                      _checksum(header + self.PAYLOAD),
+                                      identifier, sequence)
+        self.sock.sendto(header + self.PAYLOAD, (ip, 0))
+
+    def parseReply(self, data):
+        """
+        Returns the (identifier, sequence) of an echo reply packet, or
+        None if it isn't one. Identifiers are rewritten by the kernel for
+        datagram sockets, and returned as None.
+        """
+
+        if self.raw and self.family == socket.AF_INET:
+            # Raw IPv4 sockets receive the IP header
+            data = data[(ord(data[0]) & 0x0f) * 4:]
+        if len(data) < self.HEADER.size:
+            return None
+        type, code, checksum, identifier, sequence = self.HEADER.unpack_from(data)
+        if type != self.ECHO_REPLY[self.family]:
+            return None
+        return (identifier if self.raw else None), sequence
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def doRead(self):
+        while True:
+            try:
+                data, address = self.sock.recvfrom(2048)
+            except socket.error, e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    log.warn("Error reading ICMP socket: {}".format(e))
+                return
+            reply = self.parseReply(data)
+            if reply is not None:
+                self.engine.echoReplyReceived(address[0], *reply)
+
+    def connectionLost(self, reason):
+        self.sock.close()
+
+    def logPrefix(self):
+        return 'ICMPEchoEngine'
+
+
+class ICMPEchoEngine(PerReactor):
+    """
+    Sends the echo requests of all ICMPReachability monitors from one
+    shared ICMP socket per address family. Monitors with the same
+    interval and timeout are grouped, and each group is checked in
+    batched rounds: every round sends one echo request to each host of
+    the group, and reports a reply or a loss for each host to its
+    monitors.
+    """
+
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.identifier = os.getpid() & 0xffff
+        self.sequence = itertools.count()
+        # EchoSockets by address family, opened on first use
+        self.sockets = {}
+        # Monitors by host IP, by (interval, timeout) group
+        self.groups = {}
+        # Round calls by group
+        self.rounds = {}
+        # Outstanding requests: sequence -> (packed ip, send time, group)
+        self.pending = {}
+
+    def register(self, monitor):
+        """
+        Starts sending echo requests to the server of monitor. Raises
+        socket.error if no ICMP socket can be opened.
+        """
+
+        self._socket(self._family(monitor.server.ip))
+        group = (monitor.interval, monitor.timeout)
+        hosts = self.groups.setdefault(group, {})
+        hosts.setdefault(monitor.server.ip, set()).add(monitor)
+        if group not in self.rounds:
+            self.rounds[group] = ScheduledCall(
+                self._round, CheckScheduler.forReactor(self.reactor), group)
+            self.rounds[group].start(monitor.interval, now=False)
+
+    def unregister(self, monitor):
+        """Stops sending echo requests to the server of monitor"""
+
+        group = (monitor.interval, monitor.timeout)
+        hosts = self.groups.get(group, {})
+        monitors = hosts.get(monitor.server.ip, set())
+        monitors.discard(monitor)
+        if not monitors:
+            hosts.pop(monitor.server.ip, None)
+        if not hosts:
+            self.groups.pop(group, None)
+            roundCall = self.rounds.pop(group, None)
+            if roundCall is not None and roundCall.running:
+                roundCall.stop()
+        if not self.groups:
+            for echoSocket in self.sockets.values():
+                self.reactor.removeReader(echoSocket)
+                echoSocket.sock.close()
+            self.sockets.clear()
+
+    def echoReplyReceived(self, ip, identifier, sequence):
+        """Called by an EchoSocket when an echo reply has been received"""
+
+        if identifier is not None and identifier != self.identifier:
+            # A reply to another process
+            return
+        try:
+            packedIP, sendTime, group = self.pending[sequence]
+        except KeyError:
+            return
+        if self._pack(ip) != packedIP:
+            return
+        del self.pending[sequence]
+
+        rtt = self.reactor.seconds() - sendTime
+        for monitor in list(self.groups.get(group, {}).get(ip, ())):
+            monitor.echoReply(rtt)
+
+    def _round(self, group):
+        """Sends an echo request to every host of group"""
+
+        sent = []
+        now = self.reactor.seconds()
+        for ip in self.groups.get(group, {}).keys():
+            sequence = next(self.sequence) & 0xffff
+            try:
+                self._socket(self._family(ip)).sendEcho(ip, self.identifier, sequence)
+            except socket.error, e:
+                log.warn("Could not send ICMP echo request to {}: {}".format(ip, e))
+            self.pending[sequence] = (self._pack(ip), now, group)
+            sent.append(sequence)
+
+        self.reactor.callLater(group[1], self._expire, sent)
+
+    def _expire(self, sequences):
+        """Reports the requests of a round that got no reply as lost"""
+
+        for sequence in sequences:
+            try:
+                packedIP, sendTime, group = self.pending.pop(sequence)
+            except KeyError:
+                # Replied to
+                continue
+            ip = self._unpack(packedIP)
+            for monitor in list(self.groups.get(group, {}).get(ip, ())):
+                monitor.echoLost()
+
+    def _socket(self, family):
+        try:
+            return self.sockets[family]
+        except KeyError:
+            echoSocket = self.sockets[family] = EchoSocket(self, family)
+            self.reactor.addReader(echoSocket)
+            return echoSocket
+
+    @staticmethod
+    def _family(ip):
+        return socket.AF_INET6 if ':' in ip else socket.AF_INET
+
+    @classmethod
+    def _pack(cls, ip):
+        return socket.inet_pton(cls._family(ip), ip)
+
+    @staticmethod
+    def _unpack(packedIP):
+        family = socket.AF_INET6 if len(packedIP) == 16 else socket.AF_INET
+        return socket.inet_ntop(family, packedIP)
+
+
+class ICMPReachabilityMonitoringProtocol(monitor.MonitoringProtocol):
+    """
+    Monitor that checks whether the server is reachable on its service
+    IP, by sending it ICMP echo requests through the shared
+    ICMPEchoEngine. The server is considered down after max-lost
+    consecutive echo requests got no reply within the timeout, and up
+    again after a reply.
+    """
+
+    __name__ = 'ICMPReachability'
+
+    INTERVAL = 1.0
+    TIMEOUT = 0.5
+    MAX_LOST = 3
+    LOSS_WINDOW = 20
+
+    metric_labelnames = ('service', 'host', 'monitor')
+    metric_keywords = {
+        'namespace': 'pybal',
+        'subsystem': 'monitor_' + __name__.lower()
+    }
+
+    icmpreachability_metrics = {
+        'rtt_seconds': Gauge(
+            'rtt_seconds',
+            'ICMP echo round trip time',
+            labelnames=metric_labelnames,
+            **metric_keywords),
+        'loss_ratio': Gauge(
+            'loss_ratio',
+            'Fraction of recent ICMP echo requests lost',
+            labelnames=metric_labelnames,
+            **metric_keywords),
+        'echo_lost_total': Counter(
+            'echo_lost_total',
+            'ICMP echo requests lost',
+            labelnames=metric_labelnames,
+            **metric_keywords)
+    }
+
+    def __init__(self, coordinator, server, configuration, reactor=None):
+        """Constructor"""
+
+        # Call ancestor constructor
+        super(ICMPReachabilityMonitoringProtocol, self).__init__(
+            coordinator,
+            server,
+            configuration,
+            reactor=reactor)
+
+        self.interval = self._getConfigFloat('interval', self.INTERVAL)
+        self.timeout = min(self._getConfigFloat('timeout', self.TIMEOUT), self.interval)
+        self.maxLost = self._getConfigInt('max-lost', self.MAX_LOST)
+
+        self.engine = None
+        self.lost = 0
+        self.results = collections.deque(maxlen=self.LOSS_WINDOW)
+
+    def run(self):
+        """Start the monitoring"""
+
+        super(ICMPReachabilityMonitoringProtocol, self).run()
+
+        engine = ICMPEchoEngine.forReactor(self.reactor)
+        try:
+            engine.register(self)
+        except socket.error, e:
+            self.report("Could not open an ICMP socket: {}".format(e),
+                        level=logging.ERROR)
+        else:
+            self.engine = engine
+
+    def stop(self):
+        """Stop the monitoring"""
+
+        super(ICMPReachabilityMonitoringProtocol, self).stop()
+
+        if self.engine is not None:
+            self.engine.unregister(self)
+            self.engine = None
+
+    def echoReply(self, rtt):
+        """Called by the engine when an echo reply has been received"""
+
+        if not self.active:
+            return
+
+        self.lost = 0
+        self.results.append(True)
+        self._resultUp()
+
+        self.icmpreachability_metrics['rtt_seconds'].labels(
+            **self.metric_labels
+            ).set(rtt)
+        self._updateLossRatio()
+        self.observeCheckDuration(rtt, 'successful')
+
+    def echoLost(self):
+        """Called by the engine when an echo request got no reply"""
+
+        if not self.active:
+            return
+
+        self.lost += 1
+        self.results.append(False)
+        if self.lost >= self.maxLost:
+            self._resultDown("%d consecutive ICMP echo requests lost" % self.lost)
+            if self.lost == self.maxLost:
+                self.report("%s unreachable" % self.server.ip, level=logging.WARN)
+
+        self.icmpreachability_metrics['echo_lost_total'].labels(
+            **self.metric_labels
+            ).inc()
+        self._updateLossRatio()
+        self.observeCheckDuration(self.timeout, 'failed')
+
+    def _updateLossRatio(self):
+        self.icmpreachability_metrics['loss_ratio'].labels(
+            **self.metric_labels
+            ).set(float(self.results.count(False)) / len(self.results))
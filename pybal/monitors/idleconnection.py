@@ -6,12 +6,13 @@ Monitor class implementations for PyBal
 """
 
 from pybal import monitor, util
-from pybal.metrics import Counter
+from pybal.metrics import Counter, Gauge
+from pybal.scheduler import CheckAdmission
 
-from twisted.internet import reactor, protocol
+from twisted.internet import defer, reactor, protocol, task
 import logging
 
-import socket
+import socket, struct
 
 log = util.log
 
@@ -30,6 +31,15 @@ class IdleConnectionMonitoringProtocol(monitor.MonitoringProtocol, protocol.Reco
     KEEPALIVE_RETRIES = 3
     KEEPALIVE_IDLE = 10
     KEEPALIVE_INTERVAL = 30
+    TCP_INFO_INTERVAL = 5
+    MAX_RETRANSMITS = 3
+    USER_TIMEOUT = 20
+
+    # Not exported by the socket module (Linux)
+    TCP_USER_TIMEOUT = getattr(socket, 'TCP_USER_TIMEOUT', 18)
+
+    # struct tcp_info (Linux), up to and including tcpi_rttvar
+    TCP_INFO = struct.Struct('8B17I')
 
     __name__ = 'IdleConnection'
 
@@ -49,6 +59,11 @@ class IdleConnectionMonitoringProtocol(monitor.MonitoringProtocol, protocol.Reco
             'connections_lost_total',
             'Connections lost uncleanly',
             labelnames=metric_labelnames + ('reason',),
+            **metric_keywords),
+        'rtt_seconds': Gauge(
+            'rtt_seconds',
+            'Smoothed round trip time of the idle connection',
+            labelnames=metric_labelnames,
             **metric_keywords)
     }
 
@@ -65,6 +80,18 @@ class IdleConnectionMonitoringProtocol(monitor.MonitoringProtocol, protocol.Reco
         self.keepAliveRetries = self._getConfigInt('keepalive-retries', self.KEEPALIVE_RETRIES)
         self.keepAliveIdle = self._getConfigInt('keepalive-idle', self.KEEPALIVE_IDLE)
         self.keepAliveInterval = self._getConfigInt('keepalive-interval', self.KEEPALIVE_INTERVAL)
+        self.tcpInfoInterval = self._getConfigInt('tcp-info-interval', self.TCP_INFO_INTERVAL)
+        self.maxRetransmits = self._getConfigInt('max-retransmits', self.MAX_RETRANSMITS)
+        self.userTimeout = self._getConfigInt('user-timeout', self.USER_TIMEOUT)
+
+        self.tcpInfoCall = None
+        # Consecutive polls that found a keepalive probe or data unacked
+        self.stalledPolls = 0
+
+        # Connection attempts are subject to check admission control
+        self.admissionDeferred = None
+        self.admitted = False
+        self.connectStartTime = None
 
     def run(self):
         """Start the monitoring"""
@@ -78,6 +105,11 @@ class IdleConnectionMonitoringProtocol(monitor.MonitoringProtocol, protocol.Reco
         super(IdleConnectionMonitoringProtocol, self).stop()
 
         self.stopTrying()
+        self._stopTCPInfoPolling()
+
+        if self.admissionDeferred is not None:
+            self.admissionDeferred.cancel()
+        self._releaseAdmission()
 
     def startedConnecting(self, connector):
         self.transport = getattr(connector, 'transport', None)
@@ -89,6 +121,9 @@ class IdleConnectionMonitoringProtocol(monitor.MonitoringProtocol, protocol.Reco
     def clientConnectionFailed(self, connector, reason):
         """Called if the connection attempt failed"""
 
+        self._releaseAdmission()
+        self._observeConnect()
+
         if not self.active:
             return
 
@@ -108,6 +143,8 @@ class IdleConnectionMonitoringProtocol(monitor.MonitoringProtocol, protocol.Reco
     def clientConnectionLost(self, connector, reason):
         """Called if the connection was previously established, but lost at some point."""
 
+        self._stopTCPInfoPolling()
+
         if not self.active:
             return
 
@@ -145,6 +182,18 @@ class IdleConnectionMonitoringProtocol(monitor.MonitoringProtocol, protocol.Reco
             except AttributeError:
                 log.warn("Could not set TCP_KEEPIDLE, TCP_KEEPCNT, TCP_KEEPINTVL socket options (not Linux?)")
 
+        if self.transport is not None and self.userTimeout:
+            # Abort the connection when sent data (including keepalive
+            # probes) remains unacknowledged for this long
+            sock = self.transport.getHandle()
+            try:
+                sock.setsockopt(socket.SOL_TCP, self.TCP_USER_TIMEOUT, self.userTimeout * 1000)
+            except socket.error:
+                log.warn("Could not set TCP_USER_TIMEOUT socket option (not Linux?)")
+
+        if self.transport is not None and self.tcpInfoInterval:
+            self._startTCPInfoPolling()
+
         # Set status to up
         self._resultUp()
 
@@ -159,12 +208,102 @@ class IdleConnectionMonitoringProtocol(monitor.MonitoringProtocol, protocol.Reco
         has been established successfully.
         """
 
+        self._releaseAdmission()
+        self._observeConnect()
         self.clientConnectionMade()
 
         # Let the ancestor method do the real work
         return super(IdleConnectionMonitoringProtocol, self).buildProtocol(addr)
 
     def _connect(self, *args, **kwargs):
-        """Starts a TCP connection attempt"""
+        """
+        Starts a TCP connection attempt, once admitted by the check
+        admission controller
+        """
+
+        def admitted(_):
+            self.admissionDeferred = None
+            self.admitted = True
+            self.connectStartTime = self.reactor.seconds()
+            self.reactor.connectTCP(self.server.ip, self.server.port, self, *args, **kwargs)
+
+        def cancelled(failure):
+            failure.trap(defer.CancelledError)
+            self.admissionDeferred = None
+
+        admission = CheckAdmission.forReactor(self.reactor)
+        self.admissionDeferred = admission.acquire(self.server.host)
+        self.admissionDeferred.addCallbacks(admitted, cancelled)
 
-        self.reactor.connectTCP(self.server.ip, self.server.port, self, *args, **kwargs)
+    def _releaseAdmission(self):
+        """Releases the admission of a finished connection attempt"""
+
+        if self.admitted:
+            self.admitted = False
+            CheckAdmission.forReactor(self.reactor).release(self.server.host)
+
+    def _observeConnect(self):
+        """Records the duration of a finished connection attempt"""
+
+        if self.connectStartTime is not None:
+            self.observePhaseDuration(
+                'connect', self.reactor.seconds() - self.connectStartTime)
+            self.connectStartTime = None
+
+    def _startTCPInfoPolling(self):
+        """Starts periodically reading TCP_INFO from the connection"""
+
+        # A local getsockopt() on an open connection, it doesn't take
+        # from the check rate budget of the CheckScheduler
+        self._stopTCPInfoPolling()
+        self.stalledPolls = 0
+        self.tcpInfoCall = task.LoopingCall(self._pollTCPInfo)
+        self.tcpInfoCall.clock = self.reactor
+        self.tcpInfoCall.start(self.tcpInfoInterval, now=False)
+
+    def _stopTCPInfoPolling(self):
+        if self.tcpInfoCall is not None and self.tcpInfoCall.running:
+            self.tcpInfoCall.stop()
+        self.tcpInfoCall = None
+
+    def _pollTCPInfo(self):
+        """
+        Reads TCP_INFO from the connection, exports the RTT, and aborts
+        the connection if the path appears dead or degraded, rather than
+        waiting for the keepalive idle time and retries to expire.
+        """
+
+        try:
+            sock = self.transport.getHandle()
+            info = self.TCP_INFO.unpack_from(
+                sock.getsockopt(socket.SOL_TCP, socket.TCP_INFO, self.TCP_INFO.size))
+        except (AttributeError, socket.error, struct.error), e:
+            log.warn("Could not read TCP_INFO from {}: {}".format(
+                self._report_prefix(), e))
+            self._stopTCPInfoPolling()
+            return
+
+        # tcpi_retransmits, tcpi_probes, tcpi_unacked, tcpi_rtt (us)
+        retransmits, probes = info[2], info[3]
+        unacked, rtt = info[12], info[23]
+
+        self.idleconnection_metrics['rtt_seconds'].labels(
+            **self.metric_labels
+            ).set(rtt / 1e6)
+
+        # On a working path a probe is acknowledged within an RTT, so one
+        # that is still unacknowledged a poll later means the path is
+        # dead, long before the keepalive retries have run out
+        if probes or unacked:
+            self.stalledPolls += 1
+        else:
+            self.stalledPolls = 0
+
+        if (retransmits >= self.maxRetransmits or probes >= self.maxRetransmits
+                or self.stalledPolls > 1):
+            self.report("%s degraded (%d retransmits, %d keepalive probes, "
+                        "%d unacked segments), aborting." % (
+                            self._report_prefix(), retransmits, probes, unacked),
+                        level=logging.WARN)
+            self._stopTCPInfoPolling()
+            self.transport.abortConnection()
@@ -6,17 +6,25 @@ Monitor class implementations for PyBal
 """
 
 # Python imports
-import logging, random
+import logging, random, re, weakref
 
 # Twisted imports
-from twisted.internet import defer
+from twisted.internet import defer, endpoints, protocol
+from twisted.internet.abstract import isIPAddress, isIPv6Address
+from twisted.internet.interfaces import (IOpenSSLClientConnectionCreator,
+                                         IStreamClientEndpoint)
 from twisted.web import client
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import IAgentEndpointFactory
+from twisted.python import failure
+from twisted.web.http import PotentialDataLoss
 from twisted.python.runtime import seconds
 import twisted.internet.reactor
+from zope.interface import implementer
 
 # Pybal imports
 from pybal import monitor, util
-from pybal.metrics import Gauge
+from pybal.metrics import Counter, Gauge
 
 
 log = util.log
@@ -34,11 +42,357 @@ class RedirHTTPPageGetter(client.HTTPPageGetter):
     handleStatus_200 = client.HTTPPageGetter.handleStatusDefault
 
 
-class RedirHTTPClientFactory(client.HTTPClientFactory):
+class TimedHTTPClientFactory(client.HTTPClientFactory):
+    """
+    HTTPClientFactory that calls phaseCallback with the duration of the
+    connect and ttfb (time to first byte) phases, both since startTime
+    """
+
+    phaseCallback = None
+    startTime = None
+
+    def buildProtocol(self, addr):
+        # Called once the TCP connection has been established
+        self._observePhase('connect')
+        return client.HTTPClientFactory.buildProtocol(self, addr)
+
+    def gotStatus(self, version, status, message):
+        self._observePhase('ttfb')
+        client.HTTPClientFactory.gotStatus(self, version, status, message)
+
+    def _observePhase(self, phase):
+        if self.phaseCallback is not None and self.startTime is not None:
+            self.phaseCallback(phase, seconds() - self.startTime)
+
+
+class RedirHTTPClientFactory(TimedHTTPClientFactory):
     """HTTPClientFactory that accepts redirects as valid responses"""
     protocol = RedirHTTPPageGetter
 
 
+class BodyValidationError(Exception):
+    """Raised when a response body doesn't contain the required content"""
+
+
+class ResponseBodyValidator(protocol.Protocol):
+    """
+    Consumes a response body incrementally, without buffering it, while
+    looking for a required substring and/or regular expression. Stops
+    reading as soon as the required content has been found, or once the
+    maximum body size has been read.
+
+    finished is called back with the number of body bytes read, or
+    errbacks with BodyValidationError if the required content was not
+    found.
+
+    Every chunk is searched for the regular expression together with the
+    last REGEX_OVERLAP bytes before it, so regular expression matches can
+    span chunks, but not more than REGEX_OVERLAP bytes of earlier ones.
+    A match that extends to the end of what has been read so far only
+    counts once the body has ended, as anchors like $ and \\b, and
+    lookaheads, depend on the data that follows.
+    """
+
+    # Bytes of earlier chunks a regular expression match can extend into
+    REGEX_OVERLAP = 8192
+
+    def __init__(self, finished, match=None, regex=None, maxSize=None):
+        self.finished = finished
+        self.match = match
+        self.regex = regex
+        self.maxSize = maxSize
+
+        self.length = 0
+        self.matchFound = not match
+        self.regexFound = regex is None
+        # Trailing bytes that may hold the start of a substring match
+        self.tail = ''
+        # Trailing bytes that may hold the start of a regular expression
+        # match, after one byte of context for anchors and lookbehinds
+        self.buffer = ''
+
+    def dataReceived(self, data):
+        if self.finished is None:
+            return
+
+        if self.maxSize is not None and self.length + len(data) > self.maxSize:
+            data = data[:self.maxSize - self.length]
+        self.length += len(data)
+
+        if not self.matchFound:
+            window = self.tail + data
+            self.matchFound = self.match in window
+            self.tail = window[1 - len(self.match):] if len(self.match) > 1 else ''
+        if not self.regexFound:
+            window = self.buffer + data
+            # Unless the window starts the body, its first byte is context
+            pos = 1 if self.length > len(window) else 0
+            found = self.regex.search(window, pos)
+            self.regexFound = found is not None and found.end() < len(window)
+            self.buffer = window[-(self.REGEX_OVERLAP + 1):] if not self.regexFound else ''
+
+        if ((self.match or self.regex is not None)
+                and self.matchFound and self.regexFound):
+            # No need to read the rest of the body
+            self._finish()
+            self.transport.stopProducing()
+        elif self.maxSize is not None and self.length >= self.maxSize:
+            self._finish()
+            self.transport.stopProducing()
+
+    def connectionLost(self, reason):
+        if self.finished is None:
+            return
+
+        if reason.check(client.ResponseDone, PotentialDataLoss):
+            if not self.regexFound:
+                # The end of the buffer is now the end of the body
+                pos = 1 if self.length > len(self.buffer) else 0
+                self.regexFound = self.regex.search(self.buffer, pos) is not None
+            self._finish()
+        else:
+            d, self.finished = self.finished, None
+            d.errback(reason)
+
+    def _finish(self):
+        d, self.finished = self.finished, None
+        self.buffer = self.tail = ''
+        if self.matchFound and self.regexFound:
+            d.callback(self.length)
+        else:
+            d.errback(BodyValidationError(
+                "Required content not found in response body ({} bytes read)"
+                .format(self.length)))
+
+
+class TLSClientContext(object):
+    """
+    TLS client context shared by all servers of a service. Remembers the
+    last TLS session per server and host name, so that subsequent
+    connections can resume it rather than doing a full handshake.
+    Optionally verifies the server certificate and host name.
+    """
+
+    def __init__(self, verify=False, caFile=None):
+        from OpenSSL import SSL
+
+        self.verify = verify
+        # (server, hostname) -> last TLS session
+        self.sessions = {}
+
+        ctx = SSL.Context(SSL.SSLv23_METHOD)
+        ctx.set_options(SSL.OP_NO_SSLv2 | SSL.OP_NO_SSLv3)
+        ctx.set_session_cache_mode(SSL.SESS_CACHE_CLIENT)
+        if verify:
+            ctx.set_verify(SSL.VERIFY_PEER,
+                           lambda conn, cert, errno, depth, ok: ok)
+            if caFile:
+                ctx.load_verify_locations(caFile)
+            else:
+                ctx.set_default_verify_paths()
+        # The context must not keep its TLSClientContext alive
+        selfRef = weakref.ref(self)
+
+        def infoCallback(connection, where, ret):
+            tlsContext = selfRef()
+            if tlsContext is not None:
+                tlsContext._infoCallback(connection, where, ret)
+        ctx.set_info_callback(infoCallback)
+        self.context = ctx
+
+    def connectionCreator(self, key, hostname, handshakeCallback=None):
+        """
+        Returns a connection creator for TLS connections to the server
+        identified by key, for host name hostname. handshakeCallback, if
+        given, is called with (resumed, duration) for every completed
+        handshake.
+        """
+
+        return TLSConnectionCreator(self, key, hostname, handshakeCallback)
+
+    def clientConnection(self, creator, tlsProtocol):
+        """Creates a new OpenSSL connection on the shared context"""
+
+        from OpenSSL import SSL
+
+        connection = SSL.Connection(self.context, None)
+        connection.set_app_data(_TLSConnectionState(creator, tlsProtocol))
+
+        # Literal IP addresses are not permitted as SNI host names
+        hostname = creator.hostname
+        if not isIPAddress(hostname) and not isIPv6Address(hostname):
+            connection.set_tlsext_host_name(hostname)
+
+        session = self.sessions.get((creator.key, hostname))
+        if session is not None:
+            connection.set_session(session)
+
+        return connection
+
+    def forget(self, key):
+        """Forgets the TLS sessions of the server identified by key"""
+
+        for k in [k for k in self.sessions if k[0] == key]:
+            del self.sessions[k]
+
+    def _infoCallback(self, connection, where, ret):
+        from OpenSSL import SSL
+
+        state = connection.get_app_data()
+        if state is None:
+            return
+
+        try:
+            if state.handshakeDone:
+                # With TLS 1.3 session tickets arrive after the handshake,
+                # and replace the session
+                if where & SSL.SSL_CB_CONNECT_EXIT == SSL.SSL_CB_CONNECT_EXIT:
+                    self._sessionUpdated(connection, state)
+            elif where & SSL.SSL_CB_HANDSHAKE_START:
+                state.startTime = seconds()
+            elif where & SSL.SSL_CB_HANDSHAKE_DONE:
+                self._handshakeDone(connection, state)
+        except Exception:
+            f = failure.Failure()
+            log.error("Error during TLS handshake callback: {}".format(
+                f.getErrorMessage()))
+            if state.tlsProtocol is not None:
+                state.tlsProtocol.failVerification(f)
+
+    def _handshakeDone(self, connection, state):
+        creator = state.creator
+        # Only verify the initial handshake of every connection
+        state.handshakeDone = True
+
+        if self.verify:
+            from service_identity import VerificationError
+            from service_identity.pyopenssl import (verify_hostname,
+                                                    verify_ip_address)
+            hostname = creator.hostname.decode('ascii')
+            try:
+                if isIPAddress(creator.hostname) or isIPv6Address(creator.hostname):
+                    verify_ip_address(connection, hostname)
+                else:
+                    verify_hostname(connection, hostname)
+            except VerificationError:
+                connection.set_app_data(None)
+                state.tlsProtocol.failVerification(failure.Failure())
+                return
+
+        # Keep the session, but not the connection with its socket state
+        self.sessions[(creator.key, creator.hostname)] = connection.get_session()
+        # From now on, only session updates are of interest
+        state.tlsProtocol = None
+
+        if creator.handshakeCallback is not None:
+            duration = seconds() - (state.startTime or seconds())
+            creator.handshakeCallback(_sessionReused(connection), duration)
+
+    def _sessionUpdated(self, connection, state):
+        key = (state.creator.key, state.creator.hostname)
+        session = connection.get_session()
+        # Sessions of forgotten servers stay forgotten
+        if key in self.sessions and session is not None:
+            self.sessions[key] = session
+
+
+class _TLSConnectionState(object):
+    """Handshake state of a single TLS connection"""
+
+    def __init__(self, creator, tlsProtocol):
+        self.creator = creator
+        self.tlsProtocol = tlsProtocol
+        self.startTime = None
+        self.handshakeDone = False
+
+
+def _sessionReused(connection):
+    """Returns whether a TLS connection resumed an earlier session"""
+
+    if hasattr(connection, 'session_reused'):
+        return bool(connection.session_reused())
+    else:
+        # pyOpenSSL before 21.0 doesn't expose SSL_session_reused
+        from OpenSSL._util import lib
+        return bool(lib.SSL_session_reused(connection._ssl))
+
+
+@implementer(IOpenSSLClientConnectionCreator)
+class TLSConnectionCreator(object):
+    """
+    Creates TLS client connections to a single server and host name,
+    using the shared context of a TLSClientContext
+    """
+
+    def __init__(self, tlsContext, key, hostname, handshakeCallback=None):
+        self.tlsContext = tlsContext
+        self.key = key
+        self.hostname = hostname
+        self.handshakeCallback = handshakeCallback
+
+    def clientConnectionForTLS(self, tlsProtocol):
+        return self.tlsContext.clientConnection(self, tlsProtocol)
+
+
+@implementer(IAgentEndpointFactory)
+class ServerEndpointFactory(object):
+    """
+    Agent endpoint factory that connects to the monitored server,
+    regardless of the host in the requested URL
+    """
+
+    def __init__(self, reactor, server, timeout, contextFactoryForHost=None,
+                 connectCallback=None):
+        self.reactor = reactor
+        self.server = server
+        self.timeout = timeout
+        self.contextFactoryForHost = contextFactoryForHost
+        self.connectCallback = connectCallback
+
+    def endpointForURI(self, uri):
+        """Returns a client endpoint to the server for the given URI"""
+
+        if uri.scheme == b'https':
+            if self.contextFactoryForHost is not None:
+                contextFactory = self.contextFactoryForHost(uri.host)
+            else:
+                from twisted.internet import ssl
+                contextFactory = ssl.ClientContextFactory()
+            endpoint = endpoints.SSL4ClientEndpoint(
+                self.reactor, self.server.ip, self.server.port or uri.port,
+                contextFactory, timeout=self.timeout)
+        else:
+            endpoint = endpoints.TCP4ClientEndpoint(
+                self.reactor, self.server.ip, self.server.port or uri.port,
+                timeout=self.timeout)
+
+        if self.connectCallback is not None:
+            return TimedEndpoint(endpoint, self.connectCallback)
+        else:
+            return endpoint
+
+
+@implementer(IStreamClientEndpoint)
+class TimedEndpoint(object):
+    """
+    Client endpoint wrapper that calls callback with the duration of
+    every successful connection attempt
+    """
+
+    def __init__(self, endpoint, callback):
+        self.endpoint = endpoint
+        self.callback = callback
+
+    def connect(self, protocolFactory):
+        startTime = seconds()
+
+        def connected(protocol):
+            self.callback(seconds() - startTime)
+            return protocol
+
+        return self.endpoint.connect(protocolFactory).addCallback(connected)
+
+
 class ProxyFetchMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
     """
     Monitor that checks server uptime by repeatedly fetching a certain URL
@@ -48,11 +402,18 @@ class ProxyFetchMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
 
     HTTP_STATUS = 200
 
+    KEEPALIVE = False
+
+    METHOD = 'GET'
+
+    USER_AGENT = 'Twisted PageGetter'
+
     __name__ = 'ProxyFetch'
 
     from twisted.internet import error
     from twisted.web import error as weberror
-    catchList = ( defer.TimeoutError, weberror.Error, error.ConnectError, error.DNSLookupError )
+    catchList = ( defer.TimeoutError, weberror.Error, error.ConnectError, error.DNSLookupError,
+                  client.ResponseFailed, client.ResponseNeverReceived, BodyValidationError )
 
     metric_labelnames = ('service', 'host', 'monitor')
     metric_keywords = {
@@ -65,9 +426,18 @@ class ProxyFetchMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
             'request_duration_seconds',
             'HTTP(S) request duration',
             labelnames=metric_labelnames + ('result',), # TODO: statuscode
+            **metric_keywords),
+        'tls_handshakes_total': Counter(
+            'tls_handshakes_total',
+            'TLS handshake count',
+            labelnames=metric_labelnames + ('result',),
             **metric_keywords)
     }
 
+    # Shared TLS client contexts, by (service, verify, CA file), for as
+    # long as monitors use them
+    tlsContexts = weakref.WeakValueDictionary()
+
     def __init__(self, coordinator, server, configuration={}, reactor=None):
         """Constructor"""
 
@@ -88,6 +458,77 @@ class ProxyFetchMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
 
         self.URL = self._getConfigStringList('url')
 
+        # Keep-alive connections and HEAD requests need the Agent based client
+        self.keepAlive = self._getConfigBool('keepalive', self.KEEPALIVE)
+        self.method = self._getConfigString('method', self.METHOD).upper()
+        if self.method not in ('GET', 'HEAD'):
+            raise ValueError("Unsupported HTTP method: %s" % self.method)
+
+        # Response body validation, also done by the Agent based client
+        self.match = self._getConfigString('match', '') or None
+        regex = self._getConfigString('match-regex', '')
+        self.matchRegex = re.compile(regex) if regex else None
+        self.maxBodySize = self._getConfigInt('max-body-size', 0) or None
+        if self.method == 'HEAD' and (self.match or self.matchRegex):
+            raise ValueError("Response body validation requires method GET")
+
+        # HTTPS checks of all servers of a service share a TLS context
+        self.tlsContext = None
+        if any(url.lower().startswith('https:') for url in self.URL):
+            self.tlsContext = self.getTLSContext(
+                self.server.lvsservice.name,
+                verify=self._getConfigBool('tls-verify', False),
+                caFile=self._getConfigString('tls-ca-file', '') or None)
+
+        self.pool = None
+        self.agent = None
+        if (self.keepAlive or self.method != 'GET' or self.match
+                or self.matchRegex or self.maxBodySize):
+            self.pool = client.HTTPConnectionPool(self.reactor,
+                                                  persistent=self.keepAlive)
+            # A single connection per server suffices for serial checks, and
+            # it should stay cached across check intervals
+            self.pool.maxPersistentPerHost = 1
+            self.pool.cachedConnectionTimeout = max(
+                self.pool.cachedConnectionTimeout, 2 * self.intvCheck)
+            self.agent = client.Agent.usingEndpointFactory(
+                self.reactor,
+                ServerEndpointFactory(
+                    self.reactor, self.server, self.toGET,
+                    contextFactoryForHost=self._tlsConnectionCreator,
+                    connectCallback=lambda duration:
+                        self.observePhaseDuration('connect', duration)),
+                pool=self.pool)
+
+    @classmethod
+    def getTLSContext(cls, service, verify=False, caFile=None):
+        """Returns the shared TLS client context for a service"""
+
+        key = (service, verify, caFile)
+        try:
+            return cls.tlsContexts[key]
+        except KeyError:
+            tlsContext = cls.tlsContexts[key] = TLSClientContext(verify, caFile)
+            return tlsContext
+
+    def _tlsConnectionCreator(self, hostname):
+        """Returns a TLS connection creator for this server"""
+
+        if self.tlsContext is None:
+            return None
+        return self.tlsContext.connectionCreator(
+            self.server.host, hostname, self._tlsHandshakeDone)
+
+    def _tlsHandshakeDone(self, resumed, duration):
+        """Called when a TLS handshake with the server has completed."""
+
+        result = 'resumed' if resumed else 'full'
+        self.proxyfetch_metrics['tls_handshakes_total'].labels(
+            result=result,
+            **self.metric_labels
+            ).inc()
+        self.observePhaseDuration('tls_handshake', duration)
+
     def stop(self):
         """Stop all running and/or upcoming checks"""
 
@@ -96,6 +537,12 @@ class ProxyFetchMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
         if self.getPageDeferred is not None:
             self.getPageDeferred.cancel()
 
+        if self.pool is not None:
+            self.pool.closeCachedConnections()
+
+        if self.tlsContext is not None:
+            self.tlsContext.forget(self.server.host)
+
     def check(self):
         """Periodically called method that does a single uptime check."""
 
@@ -103,22 +550,33 @@ class ProxyFetchMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
             log.warn("ProxyFetchMonitoringProtocol.check() called while active == False")
             return
 
-        # FIXME: Use GET as a workaround for a Twisted bug with HEAD/Content-length
-        # where it expects a body and throws a PartialDownload failure
-
         url = random.choice(self.URL)
 
         self.checkStartTime = seconds()
-        self.getPageDeferred = self.getProxyPage(
-            url,
-            method='GET',
-            host=self.server.ip,
-            port=self.server.port,
-            status=self.expectedStatus,
-            timeout=self.toGET,
-            followRedirect=False,
-            reactor=self.reactor
-        ).addCallbacks(
+        if self.agent is not None:
+            d = self.getAgentPage(
+                url,
+                method=self.method,
+                status=self.expectedStatus,
+                timeout=self.toGET
+            )
+        else:
+            # FIXME: Use GET as a workaround for a Twisted bug with HEAD/Content-length
+            # where it expects a body and throws a PartialDownload failure
+            d = self.getProxyPage(
+                url,
+                contextFactory=self._tlsConnectionCreator(
+                    client.URI.fromBytes(url).host),
+                method='GET',
+                host=self.server.ip,
+                port=self.server.port,
+                status=self.expectedStatus,
+                timeout=self.toGET,
+                followRedirect=False,
+                reactor=self.reactor,
+                phaseCallback=self.observePhaseDuration
+            )
+        self.getPageDeferred = d.addCallbacks(
             self._fetchSuccessful,
             self._fetchFailed
         ).addBoth(self._checkFinished)
@@ -135,6 +593,7 @@ class ProxyFetchMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
             result='successful',
             **self.metric_labels
             ).set(duration)
+        self.observeCheckDuration(duration, 'successful')
 
         return result
 
@@ -155,6 +614,7 @@ class ProxyFetchMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
             result='failed',
             **self.metric_labels
             ).set(duration)
+        self.observeCheckDuration(duration, 'failed')
 
         failure.trap(*self.catchList)
 
@@ -168,20 +628,101 @@ class ProxyFetchMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
 
         return result
 
+    def getAgentPage(self, url, method='GET', status=None, timeout=None):
+        """
+        Fetches a page using the (possibly persistent) connection pool
+        of this monitor. Returns a deferred, which will callback with the
+        page body or errback with a description of the error.
+        """
+
+        startTime = seconds()
+
+        def responseReceived(response):
+            self.observePhaseDuration('ttfb', seconds() - startTime)
+            return response
+
+        d = self.agent.request(method, url,
+                               Headers({'User-Agent': [self.USER_AGENT]}))
+        d.addCallback(responseReceived)
+        d.addCallback(self._readAgentResponse, status,
+                      match=self.match,
+                      regex=self.matchRegex,
+                      maxSize=self.maxBodySize)
+        d.addErrback(self._unwrapCancelled)
+        if timeout:
+            d.addTimeout(timeout, self.reactor)
+        return d
+
+    @staticmethod
+    def _unwrapCancelled(failure):
+        """
+        Agent wraps the cancellation of in-flight requests in a
+        ResponseFailed failure; unwrap it, so cancellations and timeouts
+        are recognized as such.
+        """
+
+        if (failure.check(client.ResponseNeverReceived, client.ResponseFailed)
+                and any(r.check(defer.CancelledError)
+                        for r in failure.value.reasons)):
+            raise defer.CancelledError()
+        return failure
+
+    @staticmethod
+    def _readAgentResponse(response, status=None, match=None, regex=None,
+                           maxSize=None):
+        """
+        Reads and validates the response body, so the connection can be
+        reused, and checks the response status the same way getProxyPage
+        does. The body of an unexpected response status is discarded
+        without validation.
+        """
+
+        if status > 300 and status < 304:
+            acceptable = (301, 302, 303)
+        else:
+            acceptable = (200, 201, 202)
+        statusOK = response.code in acceptable
+
+        def cancel(deferred):
+            validator.finished = None
+            abort = getattr(validator.transport, 'abortConnection', None)
+            if abort is not None:
+                abort()
+
+        d = defer.Deferred(cancel)
+        if statusOK:
+            validator = ResponseBodyValidator(d, match, regex, maxSize)
+        else:
+            validator = ResponseBodyValidator(d, maxSize=maxSize)
+        response.deliverBody(validator)
+
+        def checkStatus(length):
+            if not statusOK:
+                from twisted.web import error as weberror
+                raise weberror.Error(str(response.code), response.phrase)
+            return length
+
+        return d.addCallback(checkStatus)
+
     @staticmethod
     def getProxyPage(url, contextFactory=None, host=None, port=None,
-                     status=None, reactor=twisted.internet.reactor, *args, **kwargs):
+                     status=None, reactor=twisted.internet.reactor,
+                     phaseCallback=None, *args, **kwargs):
         """Download a web page as a string. (modified from twisted.web.client.getPage)
 
         Download a page. Return a deferred, which will callback with a
         page (as a string) or errback with a description of the error.
+        phaseCallback is called with the name and duration of the connect
+        and ttfb phases.
 
         See HTTPClientFactory to see what extra args can be passed.
         """
         if status > 300 and status < 304:
             factory = RedirHTTPClientFactory(url, *args, **kwargs)
         else:
-            factory = client.HTTPClientFactory(url, *args, **kwargs)
+            factory = TimedHTTPClientFactory(url, *args, **kwargs)
+        factory.phaseCallback = phaseCallback
+        factory.startTime = seconds()
 
         host = host or factory.host
         port = port or factory.port
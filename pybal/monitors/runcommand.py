@@ -7,17 +7,17 @@ Monitor class implementations for PyBal
 
 # Python imports
 import os, sys, signal, errno
-import logging
+import collections, logging
 
 # Twisted imports
-from twisted.internet import process, error, defer
+from twisted.internet import process, error, defer, protocol
 from twisted.python.runtime import seconds
 import twisted.internet.reactor
 
 # Pybal imports
 from pybal import monitor
-from pybal.util import log
-from pybal.metrics import Gauge
+from pybal.util import PerReactor, log
+from pybal.metrics import Counter, Gauge, Histogram
 
 
 class ProcessGroupProcess(process.Process, object):
@@ -86,6 +86,160 @@ class ProcessGroupProcess(process.Process, object):
     def signalProcessGroup(self, signal, pgid=None):
         os.kill(pgid or -self.pid, signal)
 
+class RunCommandExecutor(PerReactor):
+    """
+    Process-wide executor for RunCommand checks, which limits the number
+    of concurrently running check processes (the fork budget). Checks
+    waiting for a slot are queued per service, and services take turns,
+    so a service with many servers can't starve the others.
+    """
+
+    metric_keywords = {
+        'namespace': 'pybal',
+        'subsystem': 'runcommand_executor'
+    }
+
+    metrics = {
+        'children': Gauge('children', 'Running check processes', **metric_keywords),
+        'queue_depth': Gauge('queue_depth', 'Checks waiting for a process slot', **metric_keywords),
+        'queue_wait_seconds': Histogram(
+            'queue_wait_seconds', 'Time checks waited for a process slot',
+            buckets=(.01, .1, .5, 1, 2.5, 5, 10, 30, 60),
+            **metric_keywords),
+        'spawn_duration_seconds': Histogram(
+            'spawn_duration_seconds', 'Time taken to spawn a check process',
+            buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25),
+            **metric_keywords)
+    }
+
+    def __init__(self, reactor, maxChildren=None):
+        self.reactor = reactor
+        # None means unlimited
+        self.maxChildren = maxChildren
+
+        self.children = 0
+        # Queues of [Deferred, enqueue time] entries, per service, in
+        # the order in which the services take turns
+        self.queues = collections.OrderedDict()
+
+    def acquire(self, service):
+        """
+        Requests a process slot for a check of service. Returns a Deferred
+        that fires when the check may spawn its process, after which
+        release() must be called when the process has ended. Cancelling
+        the Deferred removes the check from the queue.
+        """
+
+        if not self.queues and self._hasRoom():
+            self.children += 1
+            self._updateMetrics()
+            return defer.succeed(None)
+
+        entry = [None, self.reactor.seconds()]
+        d = entry[0] = defer.Deferred(lambda d: self._cancel(service, entry))
+        self.queues.setdefault(service, collections.deque()).append(entry)
+        self._updateMetrics()
+        return d
+
+    def release(self):
+        """Releases the process slot of an ended check"""
+
+        self.children -= 1
+        self._runQueued()
+        self._updateMetrics()
+
+    def _hasRoom(self):
+        return self.maxChildren is None or self.children < self.maxChildren
+
+    def _runQueued(self):
+        """Starts queued checks while there is room, one service at a time"""
+
+        while self.queues and self._hasRoom():
+            service, queue = self.queues.popitem(last=False)
+            d, enqueueTime = queue.popleft()
+            if queue:
+                # To the back of the line
+                self.queues[service] = queue
+            self.children += 1
+            self.metrics['queue_wait_seconds'].observe(self.reactor.seconds() - enqueueTime)
+            d.callback(None)
+
+    def _cancel(self, service, entry):
+        queue = self.queues.get(service)
+        if queue is not None and entry in queue:
+            queue.remove(entry)
+            if not queue:
+                del self.queues[service]
+        self._updateMetrics()
+
+    def _updateMetrics(self):
+        self.metrics['children'].set(self.children)
+        self.metrics['queue_depth'].set(sum(len(q) for q in self.queues.itervalues()))
+
+
+class CoprocessProtocol(protocol.ProcessProtocol):
+    """
+    Process protocol for a long-lived check program (coprocess), which
+    answers check requests over a line based protocol on stdin/stdout.
+
+    For every check, PyBal writes the line "check" to the coprocess, which
+    answers with a line "up" or "down", optionally followed by a space and
+    a reason. Requests are sent one at a time.
+    """
+
+    MAX_LINE_LENGTH = 4096
+
+    def __init__(self, monitor):
+        self.monitor = monitor
+        self.buffer = ''
+        self.pending = None
+
+    def request(self):
+        """
+        Sends a check request. Returns a Deferred that fires with the
+        response line, or errbacks when the coprocess exits first.
+        """
+
+        assert self.pending is None, "Coprocess request already outstanding."
+
+        def cancel(d):
+            self.pending = None
+
+        self.pending = defer.Deferred(cancel)
+        self.transport.write("check\n")
+        return self.pending
+
+    def outReceived(self, data):
+        self.buffer += data
+        while '\n' in self.buffer:
+            line, self.buffer = self.buffer.split('\n', 1)
+            self.lineReceived(line.rstrip('\r'))
+        if len(self.buffer) > self.MAX_LINE_LENGTH:
+            self.buffer = ''
+            self.lineReceived(None)
+
+    def errReceived(self, data):
+        self.monitor.childDataReceived(2, data)
+
+    def lineReceived(self, line):
+        """Called with a response line, or None if it was too long"""
+
+        if self.pending is None:
+            # Unsolicited, or the request has timed out
+            return
+        d, self.pending = self.pending, None
+        d.callback(line)
+
+    def processEnded(self, reason):
+        self.monitor.coprocessEnded(self, reason)
+        if self.pending is not None:
+            d, self.pending = self.pending, None
+            d.errback(reason)
+
+    def leftoverProcesses(self, allKilled):
+        self.monitor.leftoverProcesses(allKilled)
+
+
 class RunCommandMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
     """
     Monitor that checks server uptime by repeatedly fetching a certain URL
@@ -96,6 +250,7 @@ class RunCommandMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
     INTV_CHECK = 60
 
     TIMEOUT_RUN = 20
+    MAX_OUTPUT = 4096
 
     metric_labelnames = ('service', 'host', 'monitor')
     metric_keywords = {
@@ -108,6 +263,11 @@ class RunCommandMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
             'run_duration_seconds',
             'Command duration',
             labelnames=metric_labelnames + ('result', 'exitcode'),
+            **metric_keywords),
+        'leftover_processes_total': Counter(
+            'leftover_processes_total',
+            'Commands that left child processes behind',
+            labelnames=metric_labelnames + ('killed',),
             **metric_keywords)
     }
 
@@ -134,29 +294,170 @@ class RunCommandMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
             self.arguments = [""]
 
         self.logOutput = self._getConfigBool('log-output', True)
+        self.maxOutput = self._getConfigInt('max-output', self.MAX_OUTPUT)
+
+        # Keep the command running, and send it check requests
+        self.coprocess = self._getConfigBool('coprocess', False)
 
         self.runningProcess = None
         self.runningProcessDeferred = None
+        self.executorDeferred = None
+        self.processSlot = False
+        self.coprocessProtocol = None
+        self.outputSize = 0
 
     def stop(self):
         """Stop all running and/or upcoming checks"""
 
         super(RunCommandMonitoringProtocol, self).stop()
 
+        # Drop a check waiting for a process slot
+        if self.executorDeferred is not None:
+            self.executorDeferred.cancel()
+
         # Try to kill any running check
         if self.runningProcess is not None:
             try: self.runningProcess.signalProcess(signal.SIGKILL)
             except error.ProcessExitedAlready: pass
 
-    def runCommand(self):
+    def check(self):
         """Periodically called method that does a single uptime check."""
 
-        self.checkStartTime = seconds()
-        self.runningProcess = self._spawnProcess(self, self.command, [self.command] + self.arguments,
-                                                 sessionLeader=True, timeout=(self.timeout or None))
+        if self.coprocess:
+            return self.queryCoprocess()
+        return self.runCommand()
+
+    def runCommand(self):
+        """
+        Runs the command once the executor has a process slot for it, and
+        reports the result when it exits
+        """
+
+        executor = RunCommandExecutor.forReactor(self.reactor)
+
+        def cancelled(failure):
+            failure.trap(defer.CancelledError)
+            self.executorDeferred = None
+            # The check is over without a result
+            self.runningProcessDeferred.callback(None)
+
         self.runningProcessDeferred = defer.Deferred()
+        self.executorDeferred = executor.acquire(self.server.lvsservice.name)
+        self.executorDeferred.addCallbacks(self._spawnCommand, cancelled)
         return self.runningProcessDeferred
-    check = runCommand
+
+    def _spawnCommand(self, _):
+        """Spawns the command in a process slot of the executor"""
+
+        self.executorDeferred = None
+        self.processSlot = True
+        self.outputSize = 0
+        self.checkStartTime = seconds()
+        try:
+            self.runningProcess = self._spawnProcess(self, self.command, [self.command] + self.arguments,
+                                                     sessionLeader=True, timeout=(self.timeout or None))
+        except Exception:
+            self._releaseSlot()
+            self.runningProcessDeferred.errback()
+            return
+        RunCommandExecutor.metrics['spawn_duration_seconds'].observe(
+            seconds() - self.checkStartTime)
+
+    def _releaseSlot(self):
+        """Releases the process slot of the executor, if held"""
+
+        if self.processSlot:
+            self.processSlot = False
+            RunCommandExecutor.forReactor(self.reactor).release()
+
+    def queryCoprocess(self):
+        """
+        Sends a check request to the coprocess, (re)starting it if needed,
+        and reports the result of the response. Coprocesses are long-lived,
+        and don't count against the fork budget of the executor.
+        """
+
+        if self.coprocessProtocol is None:
+            self.coprocessProtocol = CoprocessProtocol(self)
+            self.runningProcess = self._spawnProcess(
+                self.coprocessProtocol, self.command,
+                [self.command] + self.arguments, sessionLeader=True)
+
+        self.checkStartTime = seconds()
+        self.outputSize = 0
+        d = self.coprocessProtocol.request()
+        if self.timeout:
+            d.addTimeout(self.timeout, self.reactor)
+        return d.addCallbacks(self._coprocessResponse, self._coprocessFailed)
+
+    def _coprocessResponse(self, line):
+        """Called with the response line of the coprocess"""
+
+        duration = seconds() - self.checkStartTime
+        status, _, reason = (line or '').partition(' ')
+        if status == 'up':
+            self._resultUp()
+            result = 'successful'
+        elif status == 'down':
+            self._resultDown(reason or None)
+            result = 'failed'
+        else:
+            # The coprocess is confused; start over
+            self._killCoprocess()
+            self._resultDown("Invalid coprocess response: %r" % line)
+            result = 'failed'
+
+        if reason and self.logOutput:
+            self.report("Coprocess: " + reason)
+
+        self.runcommand_metrics['run_duration_seconds'].labels(
+            result=result, exitcode=None,
+            **self.metric_labels
+            ).set(duration)
+        self.observeCheckDuration(duration, result)
+
+    def _coprocessFailed(self, failure):
+        """Called when the coprocess exited or hung during a request"""
+
+        if not self.active:
+            return
+
+        duration = seconds() - self.checkStartTime
+        if failure.check(defer.TimeoutError):
+            # Consider the coprocess hung, and restart it on the next check
+            self._killCoprocess()
+            self._resultDown("Coprocess request timed out")
+        else:
+            failure.trap(error.ProcessDone, error.ProcessTerminated)
+            self._resultDown("Coprocess exited: " + failure.getErrorMessage())
+
+        self.runcommand_metrics['run_duration_seconds'].labels(
+            result='failed', exitcode=None,
+            **self.metric_labels
+            ).set(duration)
+        self.observeCheckDuration(duration, 'failed')
+
+    def coprocessEnded(self, coprocessProtocol, reason):
+        """Called when a coprocess has exited"""
+
+        if coprocessProtocol is not self.coprocessProtocol:
+            # Killed and replaced already
+            return
+
+        self.coprocessProtocol = None
+        self.runningProcess = None
+        if self.active:
+            self.report("Coprocess %s exited: %s" % (self.command, reason.getErrorMessage()),
+                        level=logging.WARN)
+
+    def _killCoprocess(self):
+        """Kills the coprocess, which is restarted on the next check"""
+
+        self.coprocessProtocol = None
+        if self.runningProcess is not None:
+            try: self.runningProcess.signalProcess(signal.SIGKILL)
+            except error.ProcessExitedAlready: pass
+            self.runningProcess = None
 
     def makeConnection(self, process):
         pass
@@ -164,6 +465,13 @@ class RunCommandMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
     def childDataReceived(self, childFD, data):
         if not self.logOutput: return
 
+        # Only log up to maxOutput bytes per run, or coprocess request
+        if self.outputSize >= self.maxOutput:
+            return
+        self.outputSize += len(data)
+        if self.outputSize > self.maxOutput:
+            data = data[:len(data) - (self.outputSize - self.maxOutput)] + " (truncated)"
+
         # Escape control chars
         map = {'\n': r'\n',
                '\r': r'\r',
@@ -181,6 +489,8 @@ class RunCommandMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
         Called when the process has ended
         """
 
+        self._releaseSlot()
+
         duration = seconds() - self.checkStartTime
         if reason.check(error.ProcessDone):
             self._resultUp()
@@ -198,6 +508,8 @@ class RunCommandMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
             result=result, exitcode=exitcode,
             **self.metric_labels
             ).set(duration)
+        if result is not None:
+            self.observeCheckDuration(duration, result)
 
         self.runningProcessDeferred.callback(reason.type)
         reason.trap(error.ProcessDone, error.ProcessTerminated)
@@ -214,6 +526,10 @@ class RunCommandMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
             msg = "Command %s %s left child processes behind, and not all could be killed!"
         self.report(msg % (self.command, str(self.arguments)),
                     level=logging.WARN)
+        self.runcommand_metrics['leftover_processes_total'].labels(
+            killed=allKilled,
+            **self.metric_labels
+            ).inc()
 
     def _spawnProcess(self, processProtocol, executable, args=(),
                      env={}, path=None,
@@ -0,0 +1,143 @@
+"""
+tcpconnect.py
+
+TCP connect monitor class implementation for PyBal
+"""
+
+# Python imports
+import logging, socket, struct
+
+# Twisted imports
+from twisted.internet import defer, endpoints, error, protocol
+from twisted.python.runtime import seconds
+
+# Pybal imports
+from pybal import monitor
+from pybal.metrics import Histogram
+
+
+class TCPConnectMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
+    """
+    Monitor that checks whether the server accepts TCP connections, by
+    repeatedly opening a connection with a tight timeout. The connection
+    is closed with SO_LINGER 0 right away, which resets it rather than
+    leaving it in TIME_WAIT on the load balancer.
+    """
+
+    __name__ = 'TCPConnect'
+
+    INTV_CHECK = 5
+    TIMEOUT_CONNECT = 2.0
+
+    # struct linger: l_onoff, l_linger
+    LINGER_RESET = struct.pack('ii', 1, 0)
+
+    metric_labelnames = ('service', 'host', 'monitor')
+    metric_keywords = {
+        'namespace': 'pybal',
+        'subsystem': 'monitor_' + __name__.lower()
+    }
+
+    tcpconnect_metrics = {
+        'connect_duration_seconds': Histogram(
+            'connect_duration_seconds',
+            'TCP connect duration',
+            labelnames=metric_labelnames + ('result',),
+            buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5),
+            **metric_keywords)
+    }
+
+    def __init__(self, coordinator, server, configuration, reactor=None):
+        """Constructor"""
+
+        # Call ancestor constructor
+        super(TCPConnectMonitoringProtocol, self).__init__(
+            coordinator,
+            server,
+            configuration,
+            reactor=reactor)
+
+        self.toConnect = self._getConfigFloat('timeout', self.TIMEOUT_CONNECT)
+
+        self.connectDeferred = None
+        self.checkStartTime = None
+
+    def stop(self):
+        """Stop the monitoring"""
+
+        super(TCPConnectMonitoringProtocol, self).stop()
+
+        if self.connectDeferred is not None:
+            self.connectDeferred.cancel()
+
+    def check(self):
+        """Periodically called method that does a single uptime check."""
+
+        if ':' in self.server.ip:
+            endpoint = endpoints.TCP6ClientEndpoint(
+                self.reactor, self.server.ip, self.server.port, timeout=self.toConnect)
+        else:
+            endpoint = endpoints.TCP4ClientEndpoint(
+                self.reactor, self.server.ip, self.server.port, timeout=self.toConnect)
+
+        self.checkStartTime = seconds()
+        self.connectDeferred = endpoints.connectProtocol(endpoint, protocol.Protocol())
+        self.connectDeferred.addCallbacks(self._connected, self._connectFailed
+            ).addBoth(self._checkFinished)
+        return self.connectDeferred
+
+    def _connected(self, proto):
+        """Called when the connection has been established"""
+
+        duration = seconds() - self.checkStartTime
+        self._reset(proto.transport)
+
+        self.report('Connected, %.3f s' % duration, level=logging.DEBUG)
+        self._resultUp()
+
+        self.tcpconnect_metrics['connect_duration_seconds'].labels(
+            result='successful',
+            **self.metric_labels
+            ).observe(duration)
+        self.observeCheckDuration(duration, 'successful')
+
+    def _connectFailed(self, failure):
+        """Called when the connection attempt failed"""
+
+        # Don't act as if the check failed if we cancelled it
+        if failure.check(defer.CancelledError, error.ConnectingCancelledError):
+            return None
+
+        duration = seconds() - self.checkStartTime
+        self.report('Connect failed, %.3f s: %s' % (duration, failure.getErrorMessage()),
+                    level=logging.WARN)
+        self._resultDown(failure.getErrorMessage())
+
+        self.tcpconnect_metrics['connect_duration_seconds'].labels(
+            result='failed',
+            **self.metric_labels
+            ).observe(duration)
+        self.observeCheckDuration(duration, 'failed')
+
+        failure.trap(error.ConnectError)
+
+    def _checkFinished(self, result):
+        """
+        Called when the check finished with either success or failure,
+        to do after-check cleanups.
+        """
+
+        self.connectDeferred = None
+        self.checkStartTime = None
+
+        return result
+
+    def _reset(self, transport):
+        """Closes the connection with a reset, avoiding TIME_WAIT"""
+
+        try:
+            transport.getHandle().setsockopt(
+                socket.SOL_SOCKET, socket.SO_LINGER, self.LINGER_RESET)
+        except socket.error:
+            pass
+        transport.abortConnection()
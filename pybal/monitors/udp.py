@@ -6,14 +6,222 @@ UDP Monitor class implementation for PyBal
 """
 
 # Python imports
-import logging
+import ctypes, ctypes.util, errno, logging, socket, struct, sys
 
 # Twisted imports
-from twisted.internet import protocol
+from twisted.internet import protocol, task
 from twisted.python import runtime
 
 # Pybal imports
 from pybal import monitor
+from pybal.util import PerReactor, log
+
+
+class _iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(_iovec)), ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+def _loadRecvmsg():
+    """Returns libc's recvmsg, or None if unavailable"""
+
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        recvmsg = libc.recvmsg
+    except (OSError, AttributeError):
+        return None
+    recvmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_msghdr), ctypes.c_int]
+    recvmsg.restype = ctypes.c_ssize_t
+    return recvmsg
+
+
+class UDPProbeEngine(PerReactor):
+    """
+    Sends the zero-length probes of all UDP monitors from a single
+    unconnected socket per address family, and demultiplexes the ICMP
+    errors they trigger to the monitors of the probed servers, using the
+    IP_RECVERR/IPV6_RECVERR error queues of the sockets (Linux).
+
+    The error queues can't be watched by the reactor, as it treats
+    POLLERR as a lost connection, so they are drained before every probe
+    and every DRAIN_INTERVAL seconds. Replies of servers are discarded
+    at the same time, as they take from the receive buffer the errors
+    are queued in.
+    """
+
+    DRAIN_INTERVAL = 1
+
+    # Linux socket options and flags
+    IP_RECVERR = 11
+    IPV6_RECVERR = 25
+    MSG_ERRQUEUE = 0x2000
+    SO_EE_ORIGIN_ICMP = 2
+    SO_EE_ORIGIN_ICMP6 = 3
+
+    # struct sock_extended_err: ee_errno, ee_origin, ee_type, ee_code
+    EXTENDED_ERR = struct.Struct('=IBBBx')
+    # struct cmsghdr: cmsg_len (size_t, an unsigned long on Linux),
+    # cmsg_level, cmsg_type
+    CMSGHDR = struct.Struct('Lii')
+
+    recvmsg = staticmethod(_loadRecvmsg())
+
+    def __init__(self, reactor):
+        self.reactor = reactor
+        # Sockets by address family, opened on first use
+        self.sockets = {}
+        # Monitors by probed (ip, port)
+        self.monitors = {}
+        self.drainCall = None
+
+    @classmethod
+    def supported(cls):
+        """Returns whether the error queues can be read on this platform"""
+
+        return cls.recvmsg is not None
+
+    def register(self, monitor):
+        """Starts demultiplexing ICMP errors for the server of monitor"""
+
+        address = (monitor.server.ip, monitor.server.port)
+        self.monitors.setdefault(address, set()).add(monitor)
+        if self.drainCall is None:
+            # Housekeeping rather than a check, so it doesn't take from
+            # the check rate budget of the CheckScheduler
+            self.drainCall = task.LoopingCall(self.drain)
+            self.drainCall.clock = self.reactor
+            self.drainCall.start(self.DRAIN_INTERVAL, now=False)
+
+    def unregister(self, monitor):
+        """Stops demultiplexing ICMP errors for the server of monitor"""
+
+        address = (monitor.server.ip, monitor.server.port)
+        monitors = self.monitors.get(address, set())
+        monitors.discard(monitor)
+        if not monitors:
+            self.monitors.pop(address, None)
+        if not self.monitors:
+            if self.drainCall is not None:
+                self.drainCall.stop()
+                self.drainCall = None
+            for sock in self.sockets.values():
+                sock.close()
+            self.sockets.clear()
+
+    def probe(self, monitor):
+        """Sends a zero-length probe to the server of monitor"""
+
+        address = (monitor.server.ip, monitor.server.port)
+        sock = self._socket(socket.AF_INET6 if ':' in address[0] else socket.AF_INET)
+        self._drain(sock)
+        try:
+            sock.sendto("", address)
+        except socket.error:
+            # A pending error of an earlier probe, to any server, is
+            # reported by the next send on the socket instead of sending.
+            # The error itself is in the error queue.
+            self._drain(sock)
+            try:
+                sock.sendto("", address)
+            except socket.error, e:
+                log.warn("Could not send UDP probe to {}: {}".format(address, e))
+
+    def drain(self):
+        """Drains the error queues of all sockets"""
+
+        for sock in self.sockets.values():
+            self._drain(sock)
+
+    def _socket(self, family):
+        try:
+            return self.sockets[family]
+        except KeyError:
+            sock = socket.socket(family, socket.SOCK_DGRAM)
+            if family == socket.AF_INET6:
+                sock.setsockopt(socket.IPPROTO_IPV6, self.IPV6_RECVERR, 1)
+            else:
+                sock.setsockopt(socket.IPPROTO_IP, self.IP_RECVERR, 1)
+            sock.setblocking(False)
+            self.sockets[family] = sock
+            return sock
+
+    def _drain(self, sock):
+        """
+        Reads all queued errors of sock and dispatches them, and discards
+        the datagrams received on it
+        """
+
+        while True:
+            error = self._readError(sock)
+            if error is None:
+                break
+            address, errorCode, origin = error
+            if origin not in (self.SO_EE_ORIGIN_ICMP, self.SO_EE_ORIGIN_ICMP6):
+                continue
+            for monitor in list(self.monitors.get(address, ())):
+                monitor.connectionRefused()
+
+        while True:
+            try:
+                sock.recv(1)
+            except socket.error, e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                # A pending error is reported once, and is in the error
+                # queue as well
+
+    def _readError(self, sock):
+        """
+        Reads one error from the error queue of sock. Returns a tuple of
+        (destination address, errno, origin) of the probe that caused it,
+        or None if the queue is empty.
+        """
+
+        name = ctypes.create_string_buffer(128)
+        control = ctypes.create_string_buffer(512)
+        data = ctypes.create_string_buffer(1)
+        iov = _iovec(ctypes.cast(data, ctypes.c_void_p), 1)
+        msg = _msghdr(ctypes.cast(name, ctypes.c_void_p), len(name),
+                      ctypes.pointer(iov), 1,
+                      ctypes.cast(control, ctypes.c_void_p), len(control), 0)
+        if self.recvmsg(sock.fileno(), ctypes.byref(msg),
+                        self.MSG_ERRQUEUE | socket.MSG_DONTWAIT) < 0:
+            return None
+
+        address = self._parseAddress(name.raw[:msg.msg_namelen])
+        control = control.raw[:msg.msg_controllen]
+        offset = 0
+        while offset + self.CMSGHDR.size <= len(control):
+            length, level, type = self.CMSGHDR.unpack_from(control, offset)
+            if length < self.CMSGHDR.size:
+                break
+            if ((level, type) in ((socket.IPPROTO_IP, self.IP_RECVERR),
+                                  (socket.IPPROTO_IPV6, self.IPV6_RECVERR))):
+                errorCode, origin, icmpType, icmpCode = self.EXTENDED_ERR.unpack_from(
+                    control, offset + self.CMSGHDR.size)
+                return address, errorCode, origin
+            # Control messages are aligned to the size of size_t
+            align = ctypes.sizeof(ctypes.c_size_t)
+            offset += (length + align - 1) & ~(align - 1)
+        return address, None, None
+
+    @staticmethod
+    def _parseAddress(sockaddr):
+        """Parses a struct sockaddr_in or sockaddr_in6 into (ip, port)"""
+
+        family, = struct.unpack_from('=H', sockaddr)
+        port, = struct.unpack_from('!H', sockaddr, 2)
+        if family == socket.AF_INET6:
+            return socket.inet_ntop(socket.AF_INET6, sockaddr[8:24]), port
+        return socket.inet_ntop(socket.AF_INET, sockaddr[4:8]), port
 
 
 class UDPMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol, protocol.DatagramProtocol):
@@ -21,6 +229,9 @@ class UDPMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol, protocol.Dat
     Monitor that sends a Len=0 UDP packet to the server.
     As long as it doesn't get an ICMP destination unreachable it will
     keep the state set to up.
+
+    Probes are sent through the shared UDPProbeEngine where supported,
+    and from a connected socket per monitor otherwise.
     """
 
     __name__ = 'UDP'
@@ -34,8 +245,10 @@ class UDPMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol, protocol.Dat
         super(UDPMonitoringProtocol, self).__init__(coordinator, server, configuration)
 
         self.port = None
+        self.engine = None
         self.last_down_timestamp = 0
         self.icmp_timeout = self._getConfigInt('icmp-timeout', self.ICMP_TIMEOUT)
+        self.sharedSocket = self._getConfigBool('shared-socket', True)
 
     def __report_prefix(self):
         return '{}:{}:'.format(self.server.ip, self.server.port)
@@ -48,13 +261,20 @@ class UDPMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol, protocol.Dat
 
         super(UDPMonitoringProtocol, self).run()
 
-        self.port = self.reactor.listenUDP(0, self)
+        if self.sharedSocket and UDPProbeEngine.supported():
+            self.engine = UDPProbeEngine.forReactor(self.reactor)
+            self.engine.register(self)
+        else:
+            self.port = self.reactor.listenUDP(0, self)
 
     def stop(self):
         """Stop the monitoring"""
 
         super(UDPMonitoringProtocol, self).stop()
 
+        if self.engine is not None:
+            self.engine.unregister(self)
+            self.engine = None
         if self.port:
             self.port.loseConnection()
 
@@ -64,7 +284,10 @@ class UDPMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol, protocol.Dat
         if not self.active:
             return
 
-        self.transport.write("")
+        if self.engine is not None:
+            self.engine.probe(self)
+        else:
+            self.transport.write("")
         self.is_up()
 
     def is_up(self):
@@ -0,0 +1,414 @@
+"""
+scheduler.py
+
+Central check scheduler and admission control for PyBal monitors
+"""
+
+# Python imports
+import collections, heapq, itertools, random
+
+# Twisted imports
+from twisted.internet import defer
+
+# Pybal imports
+from pybal.metrics import Gauge, Histogram
+from pybal.util import PerReactor
+
+
+class CheckScheduler(PerReactor):
+    """
+    Drives the periodic checks of all monitors from a single heap of
+    deadlines and a single reactor timer, instead of a LoopingCall per
+    monitor.
+
+    Every ScheduledCall is assigned a phase offset within its interval
+    when it starts, taken from a low-discrepancy (golden ratio) sequence,
+    so monitors started together are spread evenly over the interval
+    rather than checking in lockstep. On top of that, every run gets a
+    random jitter of up to JITTER times the interval.
+
+    The scheduler keeps track of the total check rate of all running
+    calls. If a rate budget is set, calls that want to speed up (see
+    grantInterval) are only allowed to as far as the budget permits.
+    """
+
+    # Maximum jitter, as a fraction of the check interval
+    JITTER = 0.1
+
+    # Fractional part of the golden ratio
+    PHI = 0.6180339887498949
+
+    def __init__(self, reactor):
+        self.reactor = reactor
+        # Heap of [deadline, sequence, ScheduledCall] entries
+        self.heap = []
+        self.sequence = itertools.count()
+        self.phase = 0.0
+        self.timer = None
+
+        # Total rate of all running calls, in checks per second
+        self.rate = 0.0
+        # Maximum total rate to speed up to, None for unlimited
+        self.rateBudget = None
+
+    def nextPhase(self):
+        """
+        Returns the next phase offset, in the range (0, 1). Consecutive
+        phases are evenly spread over the range.
+        """
+
+        self.phase = (self.phase + self.PHI) % 1.0
+        return self.phase or self.PHI
+
+    def jitter(self, interval):
+        """Returns a random jitter for a run of a call with interval"""
+
+        return random.uniform(0, self.JITTER * interval)
+
+    def grantInterval(self, call, interval):
+        """
+        Returns the interval closest to the requested interval that the
+        running call can switch to, without the total check rate
+        exceeding the rate budget. Slowing down is always granted.
+        """
+
+        if self.rateBudget is None or interval >= call.interval:
+            return interval
+
+        available = self.rateBudget - (self.rate - 1.0 / call.interval)
+        if available <= 1.0 / call.interval:
+            # No room to speed up at all
+            return call.interval
+        return max(interval, 1.0 / available)
+
+    def schedule(self, call, deadline):
+        """
+        Schedules call to be run at deadline (reactor time). Returns the
+        heap entry, which can be passed to cancel().
+        """
+
+        entry = [deadline, next(self.sequence), call]
+        heapq.heappush(self.heap, entry)
+        if self.heap[0] is entry:
+            self._resetTimer()
+        return entry
+
+    def cancel(self, entry):
+        """Cancels a scheduled run"""
+
+        # Entries are removed lazily when they reach the top of the heap
+        entry[2] = None
+        if self.heap and self.heap[0] is entry:
+            self._resetTimer()
+
+    def _resetTimer(self):
+        """(Re)sets the reactor timer to the earliest deadline"""
+
+        while self.heap and self.heap[0][2] is None:
+            heapq.heappop(self.heap)
+
+        if not self.heap:
+            if self.timer is not None and self.timer.active():
+                self.timer.cancel()
+            self.timer = None
+            return
+
+        delay = max(0, self.heap[0][0] - self.reactor.seconds())
+        if self.timer is not None and self.timer.active():
+            self.timer.reset(delay)
+        else:
+            self.timer = self.reactor.callLater(delay, self._runDue)
+
+    def _runDue(self):
+        """Runs all calls that are due"""
+
+        self.timer = None
+        now = self.reactor.seconds()
+        while self.heap and self.heap[0][0] <= now:
+            deadline, sequence, call = heapq.heappop(self.heap)
+            if call is not None:
+                call._run()
+        self._resetTimer()
+
+
+class ScheduledCall(object):
+    """
+    Calls a function repeatedly from a CheckScheduler, with the interface
+    of task.LoopingCall.
+
+    The first run takes place at a phase offset within the interval (or
+    immediately, if now is True), and subsequent runs at whole intervals
+    from it, plus jitter. Runs of which the deadline has passed while a
+    Deferred returned by the function was still outstanding are skipped.
+    """
+
+    def __init__(self, f, scheduler, *a, **kw):
+        self.f = f
+        self.a = a
+        self.kw = kw
+        self.scheduler = scheduler
+
+        self.running = False
+        self.interval = None
+        self.deferred = None
+        self.entry = None
+        self.slot = None
+
+    def start(self, interval, now=True):
+        """
+        Starts running the function every interval seconds. Returns a
+        Deferred that fires when the call is stopped, or errbacks when
+        the function raises or returns a failing Deferred.
+        """
+
+        assert not self.running, ("Tried to start an already running "
+                                  "ScheduledCall.")
+        if interval <= 0:
+            raise ValueError("interval must be > 0")
+
+        self.running = True
+        self.interval = interval
+        self.deferred = d = defer.Deferred()
+        self.scheduler.rate += 1.0 / interval
+
+        currentTime = self.scheduler.reactor.seconds()
+        if now:
+            self.slot = currentTime
+            self._run()
+        else:
+            # The first slot is at the phase offset within the interval
+            self.slot = (currentTime - interval
+                         + self.scheduler.nextPhase() * interval)
+            self._scheduleNext()
+        return d
+
+    def stop(self):
+        """Stops running the function"""
+
+        assert self.running, ("Tried to stop a ScheduledCall that was "
+                              "not running.")
+        self.running = False
+        self.scheduler.rate -= 1.0 / self.interval
+        if self.entry is not None:
+            self.scheduler.cancel(self.entry)
+            self.entry = None
+        d, self.deferred = self.deferred, None
+        d.callback(self)
+
+    def setInterval(self, interval):
+        """
+        Changes the interval. The next run is rescheduled at the new
+        interval from the previous one.
+        """
+
+        if interval <= 0:
+            raise ValueError("interval must be > 0")
+        if not self.running:
+            self.interval = interval
+            return
+
+        self.scheduler.rate += 1.0 / interval - 1.0 / self.interval
+        if self.entry is not None:
+            self.scheduler.cancel(self.entry)
+            self.entry = None
+            self.slot -= self.interval
+            self.interval = interval
+            self._scheduleNext()
+        else:
+            # A run is in progress, and will schedule the next one
+            self.interval = interval
+
+    def reset(self):
+        """
+        Skips the next scheduled run, and schedules the one after it
+        instead
+        """
+
+        assert self.running, ("Tried to reset a ScheduledCall that was "
+                              "not running.")
+        if self.entry is not None:
+            self.scheduler.cancel(self.entry)
+            self.entry = None
+            self.slot = self.scheduler.reactor.seconds()
+            self._scheduleNext()
+
+    def __call__(self):
+        return self.f(*self.a, **self.kw)
+
+    def _scheduleNext(self):
+        """Schedules the first upcoming slot"""
+
+        currentTime = self.scheduler.reactor.seconds()
+        self.slot += self.interval
+        if self.slot <= currentTime:
+            # Skip the slots that have passed
+            missed = (currentTime - self.slot) // self.interval + 1
+            self.slot += missed * self.interval
+        deadline = self.slot + self.scheduler.jitter(self.interval)
+        self.entry = self.scheduler.schedule(self, deadline)
+
+    def _run(self):
+        """Called by the scheduler when the call is due"""
+
+        self.entry = None
+
+        def cb(result):
+            if self.running and self.entry is None:
+                self._scheduleNext()
+            return result
+
+        def eb(failure):
+            if self.deferred is None:
+                # Stopped in the meantime
+                return failure
+            self.running = False
+            self.scheduler.rate -= 1.0 / self.interval
+            d, self.deferred = self.deferred, None
+            d.errback(failure)
+
+        defer.maybeDeferred(self).addCallbacks(cb, eb)
+
+    def __repr__(self):
+        if hasattr(self.f, '__qualname__'):
+            func = self.f.__qualname__
+        elif hasattr(self.f, '__name__'):
+            func = self.f.__name__
+            if hasattr(self.f, 'im_class'):
+                func = self.f.im_class.__name__ + '.' + func
+        else:
+            func = repr(self.f)
+
+        return 'ScheduledCall<%r>(%s, *%r, **%r)' % (
+            self.interval, func, self.a, self.kw)
+
+
+class CheckAdmission(PerReactor):
+    """
+    Admission controller that limits the number of checks in flight,
+    globally and per (backend) server. Checks that can't be admitted
+    right away are queued until a slot frees up, rather than dropped.
+    Queued checks are admitted in FIFO order per server, and servers
+    take turns.
+    """
+
+    metric_keywords = {
+        'namespace': 'pybal',
+        'subsystem': 'check_admission'
+    }
+
+    metrics = {
+        'in_flight': Gauge('in_flight', 'Checks in flight', **metric_keywords),
+        'queue_depth': Gauge('queue_depth', 'Checks waiting for admission', **metric_keywords),
+        'queue_wait_seconds': Histogram(
+            'queue_wait_seconds', 'Time checks waited for admission',
+            buckets=(.01, .1, .5, 1, 2.5, 5, 10, 30, 60),
+            **metric_keywords)
+    }
+
+    def __init__(self, reactor, maxInFlight=None, maxPerServer=None):
+        self.reactor = reactor
+        # None means unlimited
+        self.maxInFlight = maxInFlight
+        self.maxPerServer = maxPerServer
+
+        self.inFlight = 0
+        self.inFlightPerServer = collections.defaultdict(int)
+        # Queues of [key, Deferred, enqueue time] entries, per server, in
+        # the order in which the servers take turns
+        self.queues = collections.OrderedDict()
+        # Queues of the servers at their limit, which don't get a turn
+        self.blockedQueues = {}
+        self.queued = 0
+
+    def acquire(self, key):
+        """
+        Requests admission of a check of the server identified by key.
+        Returns a Deferred that fires when the check is admitted, after
+        which release() must be called when it finishes. Cancelling the
+        Deferred removes the check from the queue.
+        """
+
+        if self._hasRoom(key):
+            self._admit(key)
+            return defer.succeed(None)
+
+        entry = [key, None, self.reactor.seconds()]
+        d = entry[1] = defer.Deferred(lambda d: self._cancel(entry))
+        queue = self.queues.get(key, self.blockedQueues.get(key))
+        if queue is None:
+            queues = self.queues if self._serverHasRoom(key) else self.blockedQueues
+            queue = queues[key] = collections.deque()
+        queue.append(entry)
+        self.queued += 1
+        self._updateMetrics()
+        return d
+
+    def release(self, key):
+        """Releases the admission of a finished check"""
+
+        self.inFlight -= 1
+        self.inFlightPerServer[key] -= 1
+        if self.inFlightPerServer[key] <= 0:
+            del self.inFlightPerServer[key]
+        if key in self.blockedQueues:
+            # The server gets its turn again
+            self.queues[key] = self.blockedQueues.pop(key)
+        self._admitQueued()
+        self._updateMetrics()
+
+    def _hasRoom(self, key):
+        return ((self.maxInFlight is None or self.inFlight < self.maxInFlight)
+                and self._serverHasRoom(key))
+
+    def _serverHasRoom(self, key):
+        return (self.maxPerServer is None
+                or self.inFlightPerServer[key] < self.maxPerServer)
+
+    def _admit(self, key):
+        self.inFlight += 1
+        self.inFlightPerServer[key] += 1
+        self._updateMetrics()
+
+    def _admitQueued(self):
+        """
+        Admits queued checks while there is room, one server at a time
+        """
+
+        admitted = []
+        while self.queues and (self.maxInFlight is None
+                               or self.inFlight < self.maxInFlight):
+            key, queue = self.queues.popitem(last=False)
+            if not self._serverHasRoom(key):
+                # Reached its limit since it queued; wait for a release
+                self.blockedQueues[key] = queue
+                continue
+
+            _, d, enqueueTime = queue.popleft()
+            self.queued -= 1
+            self._admit(key)
+            self.metrics['queue_wait_seconds'].observe(
+                self.reactor.seconds() - enqueueTime)
+            admitted.append(d)
+            if queue:
+                # To the back of the line
+                self.queues[key] = queue
+
+        # Checks may finish synchronously, and admit more checks
+        for d in admitted:
+            d.callback(None)
+
+    def _cancel(self, entry):
+        key = entry[0]
+        for queues in (self.queues, self.blockedQueues):
+            queue = queues.get(key)
+            if queue is not None and entry in queue:
+                queue.remove(entry)
+                self.queued -= 1
+                if not queue:
+                    del queues[key]
+                break
+        self._updateMetrics()
+
+    def _updateMetrics(self):
+        self.metrics['in_flight'].set(self.inFlight)
+        self.metrics['queue_depth'].set(self.queued)
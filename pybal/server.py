@@ -15,6 +15,7 @@ from twisted.names.error import AuthoritativeDomainError
 from twisted.python import failure
 
 from pybal import util
+from pybal.worker import MonitorWorkerPool, RemoteMonitor
 
 log = util.log
 
@@ -30,6 +31,9 @@ class Server:
     # Set of attributes allowed to be overridden in a server list
     allowedConfigKeys = { ('host', str), ('weight', int), ('enabled', bool) }
 
+    # Policies for aggregating monitor results into a server status
+    AGGREGATION_POLICIES = ('all', 'any', 'quorum', 'weighted')
+
     def __init__(self, host, lvsservice, addressFamily=None):
         """Constructor"""
 
@@ -61,6 +65,12 @@ class Server:
         self.ready = False
         self.modified = None
 
+        # Monitor aggregation policy, see calcStatus()
+        self.aggregation = 'all'
+        self.quorum = None
+        self.monitorWeights = {}
+        self.scoreThreshold = 1.0
+
     def __eq__(self, other):
         return isinstance(other, Server) and self.host == other.host and self.lvsservice == other.lvsservice
 
@@ -202,7 +212,12 @@ class Server:
             # checks are green, while in fact no check is being
             # performed.
             reactor.stop()
+        elif not self._parseAggregationConfig(lvsservice):
+            # An invalid aggregation policy could pool servers that are
+            # down. Stop PyBal rather than guessing what was meant.
+            reactor.stop()
         else:
+            workerPool = MonitorWorkerPool.forReactor(reactor)
             for monitorname in monitorlist:
                 try:
                     monitormodule = importlib.import_module(
@@ -218,16 +233,71 @@ class Server:
                     # performed.
                     reactor.stop()
                 else:
-                    monitorclass = getattr(monitormodule, monitorname + 'MonitoringProtocol')
-                    monitor = monitorclass(coordinator, self, lvsservice.configuration)
+                    if workerPool.workers:
+                        # Run the monitor in a worker process
+                        monitor = RemoteMonitor(coordinator, self, lvsservice.configuration,
+                                                monitorname)
+                    else:
+                        monitorclass = getattr(monitormodule, monitorname + 'MonitoringProtocol')
+                        monitor = monitorclass(coordinator, self, lvsservice.configuration)
                     self.addMonitor(monitor)
                     monitor.run()
 
+    def _parseAggregationConfig(self, lvsservice):
+        """
+        Reads the monitor aggregation policy of the LVS service. Returns
+        False if the configuration is invalid.
+        """
+
+        configuration = lvsservice.configuration
+        try:
+            aggregation = configuration.get('monitor-aggregation', 'all').strip().lower()
+            if aggregation not in self.AGGREGATION_POLICIES:
+                raise ValueError("unknown policy '{}'".format(aggregation))
+            quorum = configuration.getint('monitor-quorum', 0) or None
+            weights = eval(configuration.get('monitor-weights', '{}'))
+            if not isinstance(weights, dict):
+                raise ValueError("option 'monitor-weights' is not a python dict")
+            scoreThreshold = configuration.getfloat('monitor-score-threshold', 1.0)
+        except Exception as e:
+            msg = "Invalid monitor aggregation configuration in LVS service section {}: {}"
+            log.critical(msg.format(lvsservice.name, e))
+            return False
+
+        self.aggregation = aggregation
+        self.quorum = quorum
+        self.monitorWeights = weights
+        self.scoreThreshold = scoreThreshold
+        return True
+
     def calcStatus(self):
-        """AND quantification of monitor.up over all monitoring instances of a single Server"""
+        """
+        Quantification of monitor.up over all monitoring instances of a
+        single Server, according to the aggregation policy of the service:
+
+        all:      up iff all monitors report up (default)
+        any:      up iff at least one monitor reports up
+        quorum:   up iff at least monitor-quorum monitors report up
+        weighted: up iff the summed weights of the monitors reporting up
+                  reach monitor-score-threshold of the total weight
+        """
 
-        # Global status is up iff all monitors report up
-        return reduce(lambda b,monitor: b and monitor.up, self.monitors, len(self.monitors) != 0)
+        # Currently, no monitors implies a down status
+        if not self.monitors:
+            return False
+
+        if self.aggregation == 'any':
+            return self.calcPartialStatus()
+        elif self.aggregation == 'quorum':
+            upCount = len([m for m in self.monitors if m.up])
+            return upCount >= min(self.quorum or len(self.monitors), len(self.monitors))
+        elif self.aggregation == 'weighted':
+            weights = {m: self.monitorWeights.get(m.name(), 1) for m in self.monitors}
+            score = sum(weight for m, weight in weights.iteritems() if m.up)
+            return score > 0 and score >= self.scoreThreshold * sum(weights.itervalues())
+        else:
+            # Global status is up iff all monitors report up
+            return all(m.up for m in self.monitors)
 
     def calcPartialStatus(self):
         """OR quantification of monitor.up over all monitoring instances of a single Server"""
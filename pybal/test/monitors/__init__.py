@@ -10,9 +10,11 @@
 
 __all__ = [
     'test_dnsquery',
+    'test_icmpreachability',
     'test_idleconnection',
     'test_proxyfetch',
     'test_runcommand',
     'test_skeleton',
+    'test_tcpconnect',
     'test_udp'
 ]
@@ -6,17 +6,22 @@
   This module contains tests for `pybal.monitors.dnsquery`.
 """
 
+# Python imports
+import mock
+
 # Twisted imports
-from twisted.internet import defer, reactor
+from twisted.internet import defer, reactor, task
 from twisted.names.common import ResolverBase
 from twisted.names import dns, error
 
 # Pybal imports
 import pybal.monitor
-from pybal.monitors.dnsquery import DNSQueryMonitoringProtocol
+from pybal.monitors.dnsquery import (DNSQueryMonitoringProtocol,
+                                     DNSQueryEngine, SharedResolver)
 
 # Testing imports
 from .. import test_monitor
+from ..fixtures import PyBalTestCase
 
 
 class FakeResolverOK(ResolverBase):
@@ -35,6 +40,21 @@ class FakeResolverOK(ResolverBase):
         return defer.succeed((results, authority, additional))
 
 
+class FakeResolverPartialTimeoutError(FakeResolverOK):
+    def _lookup(self, name, cls, qtype, timeout):
+        if name == 'en.wikipedia.org':
+            return defer.fail(error.DNSQueryTimeoutError([]))
+        return FakeResolverOK._lookup(self, name, cls, qtype, timeout)
+
+
+class FakeDatagramTransport(object):
+    def __init__(self):
+        self.written = []
+
+    def write(self, data, addr):
+        self.written.append((data, addr))
+
+
 class FakeResolverTimeoutError(ResolverBase):
     def _lookup(self, name, cls, qtype, timeout):
         return defer.fail(error.DNSQueryTimeoutError([]))
@@ -85,12 +105,17 @@ class DNSQueryMonitoringProtocolTestCase(test_monitor.BaseLoopingCheckMonitoring
         self.assertEquals(monitor.toQuery, monitor.TIMEOUT_QUERY)
         self.assertEquals(monitor.hostnames, ['en.wikipedia.org'])
         self.assertFalse(monitor.failOnNXDOMAIN)
+        self.assertEquals(monitor.queriesPerCheck, monitor.QUERIES_PER_CHECK)
 
     def testRun(self):
         """Test `DNSQueryMonitoringProtocol.run`."""
         self.assertIsNone(self.monitor.resolver)
         self.monitor.run()
-        self.assert_(len(self.monitor.resolver.resolvers) > 0)
+        self.assertIsInstance(self.monitor.resolver, SharedResolver)
+        self.assertIs(self.monitor.resolver.engine,
+                      DNSQueryEngine.forReactor(self.reactor))
+        self.assertEqual(self.monitor.resolver.servers,
+                         [(ip, 53) for ip in self.server.ip4_addresses])
 
     def __testQuery(self, expectSuccess, fakeResolver):
         """Install a mocked resolver to test different lookup results"""
@@ -140,3 +165,139 @@ class DNSQueryMonitoringProtocolTestCase(test_monitor.BaseLoopingCheckMonitoring
     def testQueryFailedUnknownError(self):
         self.__testQuery(expectSuccess=False,
                          fakeResolver=FakeResolverUnknownError)
+
+    def testDNSPhaseDuration(self):
+        for fakeResolver, observed in ((FakeResolverOK, True),
+                                       (FakeResolverNameError, True),
+                                       (FakeResolverTimeoutError, False)):
+            self.monitor.resolver = fakeResolver()
+            with mock.patch.object(self.monitor, 'observePhaseDuration') as mock_observe:
+                self.monitor.check()
+            if observed:
+                mock_observe.assert_called_once_with('dns', mock.ANY)
+            else:
+                # No response, the check duration covers it
+                mock_observe.assert_not_called()
+
+    def testQueriesPerCheck(self):
+        self.config['dnsquery.hostnames'] = '["en.wikipedia.org", "www.wikipedia.org"]'
+        self.config['dnsquery.queries-per-check'] = '2'
+        self.monitor = DNSQueryMonitoringProtocol(
+                self.coordinator, self.server, self.config)
+        self.monitor.resolver = FakeResolverOK()
+        with mock.patch.object(self.monitor.resolver, '_lookup',
+                               wraps=self.monitor.resolver._lookup) as mock_lookup:
+            results = self.successResultOf(self.monitor.check())
+        self.assertEqual(len(results), 2)
+        self.assertEqual(set(c[0][0] for c in mock_lookup.call_args_list),
+                         set(['en.wikipedia.org', 'www.wikipedia.org']))
+        self.assertTrue(self.monitor.up)
+
+    def testQueriesPerCheckFailure(self):
+        self.config['dnsquery.hostnames'] = '["en.wikipedia.org", "www.wikipedia.org"]'
+        self.config['dnsquery.queries-per-check'] = '2'
+        self.monitor = DNSQueryMonitoringProtocol(
+                self.coordinator, self.server, self.config)
+        self.monitor.up = True
+        self.__testQuery(expectSuccess=False,
+                         fakeResolver=FakeResolverPartialTimeoutError)
+
+
+class DNSQueryEngineTestCase(PyBalTestCase):
+    """Test case for `pybal.monitors.dnsquery.DNSQueryEngine`."""
+
+    address = ('192.0.2.53', 53)
+
+    def setUp(self):
+        super(DNSQueryEngineTestCase, self).setUp()
+        self.reactor = task.Clock()
+        self.engine = DNSQueryEngine(self.reactor, poolSize=2)
+        for protocol in self.engine.protocols:
+            protocol.transport = FakeDatagramTransport()
+            protocol.startProtocol()
+        self.resolver = SharedResolver(self.engine, [self.address])
+
+    def respond(self, protocol, index=0, **kwargs):
+        """Answers a query written to the transport of protocol"""
+        data, address = protocol.transport.written[index]
+        message = dns.Message()
+        message.fromStr(data)
+        response = dns.Message(id=message.id, answer=1, **kwargs)
+        response.queries = message.queries
+        if not kwargs:
+            response.answers = [dns.RRHeader(
+                name=message.queries[0].name.name,
+                payload=dns.Record_A(address='192.0.2.1'))]
+        protocol.datagramReceived(response.toStr(), address)
+
+    def testForReactor(self):
+        engine = DNSQueryEngine.forReactor(self.reactor)
+        self.assertIs(DNSQueryEngine.forReactor(self.reactor), engine)
+        self.assertEqual(len(engine.protocols), DNSQueryEngine.POOL_SIZE)
+
+    def testMultiplexing(self):
+        """Queries are spread over the pool, and multiplexed by query ID"""
+        d1 = self.resolver.lookupAddress('a.example.org', timeout=[5])
+        d2 = self.resolver.lookupAddress('b.example.org', timeout=[5])
+        d3 = self.resolver.lookupAddress('c.example.org', timeout=[5])
+        first, second = self.engine.protocols
+        self.assertEqual(len(first.transport.written), 2)
+        self.assertEqual(len(second.transport.written), 1)
+        self.assertEqual(first.transport.written[0][1], self.address)
+
+        # Responses are matched out of order
+        self.respond(first, index=1)
+        answers, authority, additional = self.successResultOf(d3)
+        self.assertEqual(answers[0].name.name, 'c.example.org')
+        self.assertNoResult(d1)
+        self.respond(second)
+        self.assertEqual(self.successResultOf(d2)[0][0].name.name, 'b.example.org')
+        self.respond(first)
+        self.successResultOf(d1)
+        self.assertEqual(self.reactor.getDelayedCalls(), [])
+
+    def testTimeout(self):
+        d = self.resolver.lookupAddress('a.example.org', timeout=[5])
+        self.reactor.advance(5)
+        self.failureResultOf(d, error.DNSQueryTimeoutError)
+
+    def testRetry(self):
+        resolver = SharedResolver(self.engine, [self.address, ('192.0.2.54', 53)])
+        d = resolver.lookupAddress('a.example.org', timeout=[1, 3])
+        self.reactor.advance(1)
+        # The retry goes to the next address, on the next socket
+        second = self.engine.protocols[1]
+        self.assertEqual(second.transport.written[0][1], ('192.0.2.54', 53))
+        self.respond(second)
+        self.successResultOf(d)
+
+    def testCancel(self):
+        d = self.resolver.lookupAddress('a.example.org', timeout=[5])
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        protocol = self.engine.protocols[0]
+        self.assertEqual(protocol.liveMessages, {})
+        self.assertEqual(self.reactor.getDelayedCalls(), [])
+        # A late response is ignored
+        self.respond(protocol)
+
+    def testErrorCode(self):
+        d = self.resolver.lookupAddress('a.example.org', timeout=[5])
+        self.respond(self.engine.protocols[0], rCode=dns.ENAME)
+        self.failureResultOf(d, error.DNSNameError)
+
+    def testTruncated(self):
+        """Truncated responses are retried over TCP"""
+        full = dns.Message(answer=1)
+        full.answers = [dns.RRHeader(name='a.example.org',
+                                     payload=dns.Record_A(address='192.0.2.1'))]
+        with mock.patch.object(self.engine, 'queryTCP',
+                               return_value=defer.succeed(full)) as mock_queryTCP:
+            d = self.resolver.lookupAddress('a.example.org', timeout=[5])
+            self.respond(self.engine.protocols[0], trunc=1)
+        answers, authority, additional = self.successResultOf(d)
+        self.assertEqual(answers, full.answers)
+        address, query, timeout = mock_queryTCP.call_args[0]
+        self.assertEqual(address, self.address)
+        self.assertEqual(query.name.name, 'a.example.org')
+        self.assertEqual(timeout, 5)
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+  PyBal unit tests
+  ~~~~~~~~~~~~~~~~
+
+  This module contains tests for `pybal.monitors.icmpreachability`.
+"""
+
+# Python imports
+import mock
+import socket
+import struct
+import time
+import unittest
+
+# Twisted imports
+from twisted.internet import task
+
+# Testing imports
+from .. import test_monitor
+
+# Pybal imports
+from pybal.monitors.icmpreachability import (
+    ICMPReachabilityMonitoringProtocol, ICMPEchoEngine, EchoSocket, _checksum)
+
+
+class ICMPReachabilityMonitoringProtocolTestCase(test_monitor.BaseMonitoringProtocolTestCase):
+    """Test case for `pybal.monitors.ICMPReachabilityMonitoringProtocol`."""
+
+    monitorClass = ICMPReachabilityMonitoringProtocol
+
+    def setUp(self):
+        patcher = mock.patch('pybal.monitors.icmpreachability.EchoSocket')
+        self.mockEchoSocket = patcher.start()
+        self.addCleanup(patcher.stop)
+        super(ICMPReachabilityMonitoringProtocolTestCase, self).setUp()
+
+    def testInit(self):
+        """Test `ICMPReachabilityMonitoringProtocol.__init__`."""
+        self.assertEqual(self.monitor.interval, ICMPReachabilityMonitoringProtocol.INTERVAL)
+        self.assertEqual(self.monitor.timeout, ICMPReachabilityMonitoringProtocol.TIMEOUT)
+        self.assertEqual(self.monitor.maxLost, ICMPReachabilityMonitoringProtocol.MAX_LOST)
+
+        self.config['icmpreachability.interval'] = '0.2'
+        self.config['icmpreachability.timeout'] = '1'
+        self.config['icmpreachability.max-lost'] = '5'
+        monitor = ICMPReachabilityMonitoringProtocol(
+            self.coordinator, self.server, self.config)
+        self.assertEqual(monitor.interval, 0.2)
+        # The timeout doesn't exceed the interval
+        self.assertEqual(monitor.timeout, 0.2)
+        self.assertEqual(monitor.maxLost, 5)
+
+    def testRunRegisters(self):
+        self.monitor.run()
+        engine = ICMPEchoEngine.forReactor(self.reactor)
+        self.assertIs(self.monitor.engine, engine)
+        group = (self.monitor.interval, self.monitor.timeout)
+        self.assertIn(self.monitor, engine.groups[group][self.server.ip])
+
+        self.monitor.stop()
+        self.assertIsNone(self.monitor.engine)
+        self.assertEqual(engine.groups, {})
+
+    def testRunNoSocket(self):
+        self.mockEchoSocket.side_effect = socket.error(1, "Operation not permitted")
+        with mock.patch.object(self.monitor, 'report') as mock_report:
+            self.monitor.run()
+        self.assertTrue(self.monitor.active)
+        self.assertIsNone(self.monitor.engine)
+        mock_report.assert_called_once()
+
+    def testEchoReply(self):
+        self.monitor.active = True
+        with mock.patch.object(self.monitor, 'observeCheckDuration') as mock_observe:
+            self.monitor.echoReply(0.001)
+        self.assertTrue(self.monitor.up)
+        mock_observe.assert_called_once_with(0.001, 'successful')
+
+    def testEchoLost(self):
+        self.monitor.active = True
+        self.monitor.up = True
+        for i in range(self.monitor.maxLost - 1):
+            self.monitor.echoLost()
+        self.assertTrue(self.monitor.up)
+        self.monitor.echoLost()
+        self.assertFalse(self.monitor.up)
+
+        # A single reply brings it back up
+        self.monitor.echoReply(0.001)
+        self.assertTrue(self.monitor.up)
+        self.assertEqual(self.monitor.lost, 0)
+
+    def testLossRatio(self):
+        self.monitor.active = True
+        gauge = mock.Mock()
+        with mock.patch.dict(self.monitor.icmpreachability_metrics,
+                             {'loss_ratio': gauge}):
+            self.monitor.echoReply(0.001)
+            gauge.labels.return_value.set.assert_called_with(0.0)
+            self.monitor.echoLost()
+            gauge.labels.return_value.set.assert_called_with(0.5)
+
+    def testInactive(self):
+        self.monitor.echoLost()
+        self.monitor.echoReply(0.001)
+        self.assertEqual(self.monitor.lost, 0)
+        self.assertEqual(len(self.monitor.results), 0)
+
+
+class ICMPEchoEngineTestCase(unittest.TestCase):
+    """Test case for `pybal.monitors.icmpreachability.ICMPEchoEngine`."""
+
+    def setUp(self):
+        self.reactor = task.Clock()
+        self.reactor.addReader = mock.Mock()
+        self.reactor.removeReader = mock.Mock()
+        self.engine = ICMPEchoEngine(self.reactor)
+        patcher = mock.patch('pybal.monitors.icmpreachability.EchoSocket')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def mockMonitor(self, ip, interval=1.0, timeout=0.5):
+        monitor = mock.Mock(spec=ICMPReachabilityMonitoringProtocol)
+        monitor.server = mock.Mock(ip=ip)
+        monitor.interval = interval
+        monitor.timeout = timeout
+        return monitor
+
+    def runRound(self, group=(1.0, 0.5)):
+        """Runs a round of group, and returns the sequences sent by IP"""
+        self.engine._round(group)
+        return dict((self.engine._unpack(packedIP), sequence)
+                    for sequence, (packedIP, sendTime, g)
+                    in self.engine.pending.items())
+
+    def testForReactor(self):
+        engine = ICMPEchoEngine.forReactor(self.reactor)
+        self.assertIs(ICMPEchoEngine.forReactor(self.reactor), engine)
+
+    def testRegister(self):
+        monitors = [self.mockMonitor('192.0.2.1'), self.mockMonitor('192.0.2.2'),
+                    self.mockMonitor('192.0.2.1', interval=0.5)]
+        for monitor in monitors:
+            self.engine.register(monitor)
+        # Grouped by interval and timeout, with one round call per group
+        self.assertEqual(set(self.engine.groups), set([(1.0, 0.5), (0.5, 0.5)]))
+        self.assertEqual(len(self.engine.rounds), 2)
+        # One socket per address family
+        self.assertEqual(self.reactor.addReader.call_count, 1)
+
+        for monitor in monitors:
+            self.engine.unregister(monitor)
+        self.assertEqual(self.engine.groups, {})
+        self.assertEqual(self.engine.rounds, {})
+        self.assertEqual(self.engine.sockets, {})
+        self.reactor.removeReader.assert_called_once()
+
+    def testBatchedRound(self):
+        up = [self.mockMonitor('192.0.2.1'), self.mockMonitor('192.0.2.1')]
+        down = self.mockMonitor('192.0.2.2')
+        for monitor in up + [down]:
+            self.engine.register(monitor)
+
+        sequences = self.runRound()
+        # One echo request per host
+        echoSocket = self.engine.sockets[socket.AF_INET]
+        self.assertEqual(echoSocket.sendEcho.call_count, 2)
+
+        self.reactor.advance(0.01)
+        self.engine.echoReplyReceived('192.0.2.1', None, sequences['192.0.2.1'])
+        for monitor in up:
+            monitor.echoReply.assert_called_once_with(0.01)
+        down.echoReply.assert_not_called()
+
+        self.reactor.advance(0.5)
+        down.echoLost.assert_called_once()
+        for monitor in up:
+            monitor.echoLost.assert_not_called()
+        self.assertEqual(self.engine.pending, {})
+
+    def testIgnoredReplies(self):
+        monitor = self.mockMonitor('192.0.2.1')
+        self.engine.register(monitor)
+        sequence = self.runRound()['192.0.2.1']
+
+        # From another host, for another process, or unknown
+        self.engine.echoReplyReceived('192.0.2.9', None, sequence)
+        self.engine.echoReplyReceived('192.0.2.1', self.engine.identifier + 1, sequence)
+        self.engine.echoReplyReceived('192.0.2.1', None, sequence + 1)
+        monitor.echoReply.assert_not_called()
+
+        # Duplicates are reported once
+        self.engine.echoReplyReceived('192.0.2.1', self.engine.identifier, sequence)
+        self.engine.echoReplyReceived('192.0.2.1', self.engine.identifier, sequence)
+        monitor.echoReply.assert_called_once()
+
+    def testSendError(self):
+        monitor = self.mockMonitor('192.0.2.1')
+        self.engine.register(monitor)
+        self.engine.sockets[socket.AF_INET].sendEcho.side_effect = socket.error(
+            101, "Network is unreachable")
+        self.runRound()
+        self.reactor.advance(0.5)
+        monitor.echoLost.assert_called_once()
+
+
+class EchoSocketTestCase(unittest.TestCase):
+    """Test case for `pybal.monitors.icmpreachability.EchoSocket`."""
+
+    def setUp(self):
+        self.engine = mock.Mock()
+        try:
+            self.echoSocket = EchoSocket(self.engine, socket.AF_INET)
+        except socket.error:
+            raise unittest.SkipTest("ICMP sockets not permitted")
+        self.addCleanup(self.echoSocket.sock.close)
+
+    def testChecksum(self):
+        header = EchoSocket.HEADER.pack(8, 0, 0, 1, 1)
+        packet = EchoSocket.HEADER.pack(8, 0, _checksum(header + 'ab'), 1, 1) + 'ab'
+        self.assertEqual(_checksum(packet), 0)
+        # Odd lengths are padded
+        self.assertEqual(_checksum('\x01'), ~0x0100 & 0xffff)
+
+    def testParseReply(self):
+        reply = EchoSocket.HEADER.pack(0, 0, 0, 1234, 42) + EchoSocket.PAYLOAD
+        request = EchoSocket.HEADER.pack(8, 0, 0, 1234, 42) + EchoSocket.PAYLOAD
+        if self.echoSocket.raw:
+            ipHeader = struct.pack('!B19x', 0x45)
+            reply, request = ipHeader + reply, ipHeader + request
+            self.assertEqual(self.echoSocket.parseReply(reply), (1234, 42))
+        else:
+            self.assertEqual(self.echoSocket.parseReply(reply), (None, 42))
+        self.assertIsNone(self.echoSocket.parseReply(request))
+        self.assertIsNone(self.echoSocket.parseReply('\0' * 4))
+
+    def testLoopback(self):
+        self.echoSocket.sendEcho('127.0.0.1', 4321, 7)
+        time.sleep(0.05)
+        self.echoSocket.doRead()
+        identifier = 4321 if self.echoSocket.raw else None
+        self.engine.echoReplyReceived.assert_called_once_with('127.0.0.1', identifier, 7)
@@ -14,6 +14,7 @@ import mock
 # Pybal imports
 import pybal.monitor
 from pybal.monitors.idleconnection import IdleConnectionMonitoringProtocol
+from pybal.scheduler import CheckAdmission, CheckScheduler
 
 # Twisted imports
 import twisted.internet.tcp
@@ -42,6 +43,9 @@ class IdleConnectionMonitoringProtocolTestCase(test_monitor.BaseMonitoringProtoc
         self.assertEqual(monitor.keepAliveRetries, IC.KEEPALIVE_RETRIES)
         self.assertEqual(monitor.keepAliveIdle, IC.KEEPALIVE_IDLE)
         self.assertEqual(monitor.keepAliveInterval, IC.KEEPALIVE_INTERVAL)
+        self.assertEqual(monitor.tcpInfoInterval, IC.TCP_INFO_INTERVAL)
+        self.assertEqual(monitor.maxRetransmits, IC.MAX_RETRANSMITS)
+        self.assertEqual(monitor.userTimeout, IC.USER_TIMEOUT)
 
         self.config.update({
             'idleconnection.max-delay': '123',
@@ -147,7 +151,9 @@ class IdleConnectionMonitoringProtocolTestCase(test_monitor.BaseMonitoringProtoc
         testSocket.setsockopt.assert_called()
         setsockopt_args = {args[0] for args in testSocket.setsockopt.call_args_list}
         expected_args = {
-            (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+            (socket.SOL_TCP, IdleConnectionMonitoringProtocol.TCP_USER_TIMEOUT,
+             self.monitor.userTimeout * 1000)
         }
         try:
             expected_args.update({
@@ -180,3 +186,142 @@ class IdleConnectionMonitoringProtocolTestCase(test_monitor.BaseMonitoringProtoc
             self.monitor.server.port,
             self.monitor,
             mock.sentinel.arg1)
+
+    def testConnectAdmission(self):
+        """
+        Test that connection attempts wait for check admission, and
+        release it when they finish.
+        """
+        admission = CheckAdmission.forReactor(self.reactor)
+        admission.maxPerServer = 1
+        self.successResultOf(admission.acquire(self.server.host))
+
+        self.monitor._connect()
+        self.assertEqual(self.reactor.tcpClients, [])
+        admission.release(self.server.host)
+        self.assertEqual(len(self.reactor.tcpClients), 1)
+        self.assertTrue(self.monitor.admitted)
+
+        self.monitor.active = True
+        self.monitor.buildProtocol(None)
+        self.assertFalse(self.monitor.admitted)
+        self.assertEqual(admission.inFlight, 0)
+
+    def testConnectDuration(self):
+        self.monitor.active = True
+        with mock.patch.object(self.monitor, 'observePhaseDuration') as mock_observe:
+            self.monitor._connect()
+            self.reactor.advance(0.25)
+            self.monitor.buildProtocol(None)
+            mock_observe.assert_called_once_with('connect', 0.25)
+
+            # Failed attempts too
+            mock_observe.reset_mock()
+            self.monitor._connect()
+            self.reactor.advance(1)
+            with mock.patch.object(self.monitor, 'retry'):
+                self.monitor.clientConnectionFailed(
+                    mock.Mock(spec=twisted.internet.tcp.Connector),
+                    failure.Failure(twisted.internet.error.ConnectionRefusedError()))
+            mock_observe.assert_called_once_with('connect', 1)
+
+    def testStopWhileQueued(self):
+        admission = CheckAdmission.forReactor(self.reactor)
+        admission.maxPerServer = 1
+        self.successResultOf(admission.acquire(self.server.host))
+
+        self.monitor.run()
+        self.monitor.stop()
+        self.assertEqual(admission.queued, 0)
+        admission.release(self.server.host)
+        self.assertEqual(self.reactor.tcpClients, [])
+
+    def tcpInfo(self, retransmits=0, probes=0, unacked=0, rtt=1500):
+        """Returns a packed struct tcp_info"""
+        fields = [0] * 25
+        fields[0] = 1   # TCP_ESTABLISHED
+        fields[2], fields[3], fields[12], fields[23] = retransmits, probes, unacked, rtt
+        return IdleConnectionMonitoringProtocol.TCP_INFO.pack(*fields)
+
+    def connect(self):
+        self.monitor.transport = mock.Mock(spec=twisted.internet.tcp.Connection)
+        self.monitor.active = True
+        self.monitor.clientConnectionMade()
+        return self.monitor.transport.getHandle()
+
+    def testUserTimeout(self):
+        self.monitor.userTimeout = 20
+        testSocket = self.connect()
+        testSocket.setsockopt.assert_any_call(
+            socket.SOL_TCP, IdleConnectionMonitoringProtocol.TCP_USER_TIMEOUT, 20000)
+
+    def testTCPInfoPolling(self):
+        testSocket = self.connect()
+        testSocket.getsockopt.return_value = self.tcpInfo(rtt=1500)
+        self.assertTrue(self.monitor.tcpInfoCall.running)
+        # Polling doesn't count against the check rate budget
+        self.assertEqual(CheckScheduler.forReactor(self.reactor).rate, 0.0)
+
+        metric = mock.Mock()
+        with mock.patch.dict(IdleConnectionMonitoringProtocol.idleconnection_metrics,
+                             {'rtt_seconds': metric}):
+            self.reactor.advance(self.monitor.tcpInfoInterval * 2)
+        testSocket.getsockopt.assert_called_with(
+            socket.SOL_TCP, socket.TCP_INFO, IdleConnectionMonitoringProtocol.TCP_INFO.size)
+        metric.labels.return_value.set.assert_called_with(0.0015)
+        self.monitor.transport.abortConnection.assert_not_called()
+
+        # Polling stops when the connection is lost
+        testConnector = mock.Mock(spec=twisted.internet.tcp.Connector)
+        with mock.patch.object(self.monitor, 'retry'):
+            self.monitor.clientConnectionLost(testConnector, failure.Failure(
+                twisted.internet.error.ConnectionLost("Testing lost connection")))
+        self.assertIsNone(self.monitor.tcpInfoCall)
+
+    def testTCPInfoDegraded(self):
+        testSocket = self.connect()
+        testSocket.getsockopt.return_value = self.tcpInfo(
+            retransmits=self.monitor.maxRetransmits, unacked=2)
+        with mock.patch.object(self.monitor, 'report') as mock_report:
+            self.reactor.advance(self.monitor.tcpInfoInterval * 2)
+        self.monitor.transport.abortConnection.assert_called_once()
+        self.assertIsNone(self.monitor.tcpInfoCall)
+        self.assertIn("degraded", mock_report.call_args[0][0])
+
+    def testTCPInfoProbeUnacked(self):
+        # With the default configuration, a dead path is detected soon
+        # after the first keepalive probe, not once all have gone unanswered
+        testSocket = self.connect()
+        testSocket.setsockopt.assert_any_call(
+            socket.SOL_TCP, IdleConnectionMonitoringProtocol.TCP_USER_TIMEOUT, 20000)
+        startTime = self.reactor.seconds()
+        testSocket.getsockopt.side_effect = lambda *args: self.tcpInfo(
+            probes=int(self.reactor.seconds() - startTime > self.monitor.keepAliveIdle))
+        deadline = (self.monitor.keepAliveIdle
+                    + self.monitor.keepAliveRetries * self.monitor.keepAliveInterval)
+        while (not self.monitor.transport.abortConnection.called
+               and self.reactor.seconds() - startTime < deadline):
+            self.reactor.advance(self.monitor.tcpInfoInterval)
+        self.monitor.transport.abortConnection.assert_called_once()
+        self.assertLessEqual(self.reactor.seconds() - startTime,
+                             self.monitor.keepAliveIdle + 2 * self.monitor.tcpInfoInterval)
+
+        # A probe that is answered doesn't count
+        self.monitor.transport.abortConnection.reset_mock()
+        self.monitor._startTCPInfoPolling()
+        probes = iter([1, 0, 1, 0])
+        testSocket.getsockopt.side_effect = lambda *args: self.tcpInfo(probes=next(probes))
+        self.reactor.advance(self.monitor.tcpInfoInterval * 4)
+        self.monitor.transport.abortConnection.assert_not_called()
+
+    def testTCPInfoUnsupported(self):
+        testSocket = self.connect()
+        testSocket.getsockopt.side_effect = socket.error("Testing")
+        self.reactor.advance(self.monitor.tcpInfoInterval * 2)
+        self.assertIsNone(self.monitor.tcpInfoCall)
+        self.monitor.transport.abortConnection.assert_not_called()
+
+    def testTCPInfoDisabled(self):
+        self.monitor.tcpInfoInterval = 0
+        self.connect()
+        self.assertIsNone(self.monitor.tcpInfoCall)
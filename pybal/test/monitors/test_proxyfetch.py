@@ -7,20 +7,26 @@
 """
 
 # Python imports
-import unittest, mock
+import gc, re, unittest, mock
 
 # Twisted imports
 import twisted.internet.base
-from twisted.internet import defer, reactor, task
+from twisted.internet import defer, reactor, task, protocol
+from twisted.protocols.tls import TLSMemoryBIOFactory
+from twisted.test import iosim
 from twisted.python import failure
 from twisted.python.runtime import seconds
+from twisted.test.proto_helpers import StringTransport
 
 # Pybal imports
 import pybal.monitor
-from pybal.monitors.proxyfetch import ProxyFetchMonitoringProtocol
+from pybal.monitors.proxyfetch import (ProxyFetchMonitoringProtocol,
+                                       TLSClientContext, BodyValidationError,
+                                       ResponseBodyValidator)
 
 # Testing imports
 from .. import test_monitor
+from ..fixtures import PyBalTestCase
 
 
 class ProxyFetchMonitoringProtocolTestCase(test_monitor.BaseLoopingCheckMonitoringProtocolTestCase):
@@ -79,6 +85,7 @@ class ProxyFetchMonitoringProtocolTestCase(test_monitor.BaseLoopingCheckMonitori
         self.assertEqual(kwargs['status'], self.monitor.expectedStatus)
         self.assertEqual(kwargs['timeout'], self.monitor.toGET)
         self.assertFalse(kwargs['followRedirect'])
+        self.assertEqual(kwargs['phaseCallback'], self.monitor.observePhaseDuration)
 
         # Check whether the callback works
         testResult = "Test page"
@@ -220,6 +227,531 @@ class ProxyFetchMonitoringProtocolTestCase(test_monitor.BaseLoopingCheckMonitori
         self.assertIsInstance(sslClient[2], twisted.web.client.HTTPClientFactory)
         self.assertEqual(sslClient[2].url, testURL)
 
+    def testGetProxyPagePhaseDurations(self):
+        phaseCallback = mock.Mock()
+        r = ProxyFetchMonitoringProtocol.getProxyPage(
+            "http://en.wikipedia.org/",
+            host="cp1001.eqiad.wmnet",
+            port=80,
+            reactor=self.reactor,
+            phaseCallback=phaseCallback)
+        factory = self.reactor.tcpClients[0][2]
+        protocol = factory.buildProtocol(None)
+        phaseCallback.assert_called_once_with('connect', mock.ANY)
+        protocol.makeConnection(StringTransport())
+        protocol.dataReceived(
+            "HTTP/1.0 200 OK\r\nContent-Length: 2\r\n\r\nok")
+        self.assertEqual([c[0][0] for c in phaseCallback.call_args_list],
+                         ['connect', 'ttfb'])
+
+
+class ProxyFetchAgentTestCase(PyBalTestCase):
+    """
+    Test case for the Agent based (keep-alive/HEAD) mode of
+    `pybal.monitors.ProxyFetchMonitoringProtocol`.
+    """
+
+    def setUp(self):
+        super(ProxyFetchAgentTestCase, self).setUp()
+        self.config['proxyfetch.url'] = '["http://en.wikipedia.org/test.php"]'
+        self.config['proxyfetch.keepalive'] = 'true'
+        self.monitor = ProxyFetchMonitoringProtocol(
+            self.coordinator, self.server, self.config, reactor=self.reactor)
+
+    def tearDown(self):
+        self.monitor.stop()
+
+    def connect(self, index=0):
+        """Completes a pending (memory reactor) connection attempt"""
+        host, port, factory = self.reactor.tcpClients[index][:3]
+        self.assertEqual((host, port), (self.server.ip, self.server.port))
+        protocol = factory.buildProtocol(None)
+        transport = StringTransport()
+        protocol.makeConnection(transport)
+        return protocol, transport
+
+    def testInit(self):
+        self.assertTrue(self.monitor.keepAlive)
+        self.assertEqual(self.monitor.method, 'GET')
+        self.assertTrue(self.monitor.pool.persistent)
+        self.assertEqual(self.monitor.pool.maxPersistentPerHost, 1)
+        self.assertIsNotNone(self.monitor.agent)
+
+    def testInitLegacy(self):
+        del self.config['proxyfetch.keepalive']
+        monitor = ProxyFetchMonitoringProtocol(None, self.server, self.config)
+        self.assertIsNone(monitor.pool)
+        self.assertIsNone(monitor.agent)
+
+    def testInitHEAD(self):
+        del self.config['proxyfetch.keepalive']
+        self.config['proxyfetch.method'] = 'head'
+        monitor = ProxyFetchMonitoringProtocol(None, self.server, self.config)
+        self.assertEqual(monitor.method, 'HEAD')
+        self.assertFalse(monitor.pool.persistent)
+
+    def testInitBadMethod(self):
+        self.config['proxyfetch.method'] = 'POST'
+        with self.assertRaises(ValueError):
+            ProxyFetchMonitoringProtocol(None, self.server, self.config)
+
+    def testCheckUsesAgent(self):
+        self.monitor.active = True
+        with mock.patch.multiple(self.monitor,
+                                 getProxyPage=mock.DEFAULT,
+                                 getAgentPage=mock.DEFAULT) as mocks:
+            mocks['getAgentPage'].return_value = defer.Deferred()
+            self.monitor.check()
+        mocks['getProxyPage'].assert_not_called()
+        mocks['getAgentPage'].assert_called_once_with(
+            "http://en.wikipedia.org/test.php",
+            method='GET',
+            status=self.monitor.expectedStatus,
+            timeout=self.monitor.toGET)
+
+    def testConnectionReused(self):
+        for i in range(2):
+            d = self.monitor.getAgentPage(
+                "http://en.wikipedia.org/test.php", status=200, timeout=5)
+            if i == 0:
+                protocol, transport = self.connect()
+            # Only a single connection should have been made
+            self.assertEqual(len(self.reactor.tcpClients), 1)
+            request = transport.value()
+            transport.clear()
+            self.assertTrue(request.startswith("GET /test.php HTTP/1.1\r\n"))
+            self.assertIn("Host: en.wikipedia.org", request)
+            protocol.dataReceived(
+                "HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok")
+            self.assertEqual(self.successResultOf(d), 2)
+
+    def testPhaseDurations(self):
+        with mock.patch.object(self.monitor, 'observePhaseDuration') as mock_observe:
+            d = self.monitor.getAgentPage(
+                "http://en.wikipedia.org/test.php", status=200)
+            protocol, transport = self.connect()
+            mock_observe.assert_called_once_with('connect', mock.ANY)
+            protocol.dataReceived(
+                "HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok")
+        self.successResultOf(d)
+        self.assertEqual([c[0][0] for c in mock_observe.call_args_list],
+                         ['connect', 'ttfb'])
+
+    def testFetchObservesCheckDuration(self):
+        self.monitor.checkStartTime = seconds()
+        with mock.patch.multiple(self.monitor,
+                                 _resultUp=mock.DEFAULT,
+                                 _resultDown=mock.DEFAULT,
+                                 observeCheckDuration=mock.DEFAULT) as mocks:
+            self.monitor._fetchSuccessful(None)
+            mocks['observeCheckDuration'].assert_called_once_with(
+                mock.ANY, 'successful')
+            mocks['observeCheckDuration'].reset_mock()
+            self.monitor._fetchFailed(failure.Failure(defer.TimeoutError()))
+            mocks['observeCheckDuration'].assert_called_once_with(
+                mock.ANY, 'failed')
+
+    def testHEAD(self):
+        d = self.monitor.getAgentPage(
+            "http://en.wikipedia.org/test.php", method='HEAD', status=200)
+        protocol, transport = self.connect()
+        self.assertTrue(transport.value().startswith("HEAD /test.php HTTP/1.1"))
+        # No body is sent in response to HEAD, despite Content-Length
+        protocol.dataReceived(
+            "HTTP/1.1 200 OK\r\nContent-Length: 1234\r\n\r\n")
+        self.assertEqual(self.successResultOf(d), 0)
+
+    def testUnexpectedStatus(self):
+        d = self.monitor.getAgentPage(
+            "http://en.wikipedia.org/test.php", status=200)
+        protocol, transport = self.connect()
+        protocol.dataReceived(
+            "HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n")
+        f = self.failureResultOf(d, twisted.web.error.Error)
+        self.assertEqual(f.value.status, "404")
+
+    def testRedirectStatus(self):
+        d = self.monitor.getAgentPage(
+            "http://en.wikipedia.org/test.php", status=301)
+        protocol, transport = self.connect()
+        protocol.dataReceived(
+            "HTTP/1.1 302 Found\r\nContent-Length: 0\r\n\r\n")
+        self.successResultOf(d)
+
+        d = self.monitor.getAgentPage(
+            "http://en.wikipedia.org/test.php", status=301)
+        protocol.dataReceived(
+            "HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n")
+        self.failureResultOf(d, twisted.web.error.Error)
+
+    def testTimeout(self):
+        d = self.monitor.getAgentPage(
+            "http://en.wikipedia.org/test.php", status=200, timeout=5)
+        self.connect()
+        self.reactor.advance(5)
+        self.failureResultOf(d, defer.TimeoutError)
+
+    def testCancel(self):
+        d = self.monitor.getAgentPage(
+            "http://en.wikipedia.org/test.php", status=200)
+        self.connect()
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+
+    def testBodyMatch(self):
+        self.config['proxyfetch.match'] = 'needle'
+        monitor = ProxyFetchMonitoringProtocol(
+            self.coordinator, self.server, self.config, reactor=self.reactor)
+        self.assertIsNotNone(monitor.agent)
+        d = monitor.getAgentPage("http://en.wikipedia.org/test.php", status=200)
+        protocol, transport = self.connect()
+        protocol.dataReceived(
+            "HTTP/1.1 200 OK\r\nContent-Length: 100\r\n\r\nhaystack nee")
+        self.assertNoResult(d)
+        # Matches across chunk boundaries, and stops reading early
+        protocol.dataReceived("dle hay")
+        self.assertEqual(self.successResultOf(d), 19)
+        self.assertEqual(transport.producerState, 'stopped')
+
+    def testBodyMatchNotFound(self):
+        self.config['proxyfetch.match'] = 'needle'
+        monitor = ProxyFetchMonitoringProtocol(
+            self.coordinator, self.server, self.config, reactor=self.reactor)
+        d = monitor.getAgentPage("http://en.wikipedia.org/test.php", status=200)
+        protocol, transport = self.connect()
+        protocol.dataReceived(
+            "HTTP/1.1 200 OK\r\nContent-Length: 8\r\n\r\nhaystack")
+        self.failureResultOf(d, BodyValidationError)
+
+    def testBodyRegex(self):
+        self.config['proxyfetch.match-regex'] = r'status: (ok|degraded)\n'
+        monitor = ProxyFetchMonitoringProtocol(
+            self.coordinator, self.server, self.config, reactor=self.reactor)
+        d = monitor.getAgentPage("http://en.wikipedia.org/test.php", status=200)
+        protocol, transport = self.connect()
+        protocol.dataReceived(
+            "HTTP/1.1 200 OK\r\nContent-Length: 100\r\n\r\nstatus: ok")
+        self.assertNoResult(d)
+        # A match at the end of the data read so far waits for more
+        protocol.dataReceived("\n")
+        self.assertNoResult(d)
+        protocol.dataReceived("more")
+        self.assertEqual(self.successResultOf(d), 15)
+
+    def testMaxBodySize(self):
+        self.config['proxyfetch.match'] = 'needle'
+        self.config['proxyfetch.max-body-size'] = '10'
+        monitor = ProxyFetchMonitoringProtocol(
+            self.coordinator, self.server, self.config, reactor=self.reactor)
+        d = monitor.getAgentPage("http://en.wikipedia.org/test.php", status=200)
+        protocol, transport = self.connect()
+        protocol.dataReceived(
+            "HTTP/1.1 200 OK\r\nContent-Length: 1000\r\n\r\nhaystack needle")
+        # The needle is beyond the size limit
+        self.failureResultOf(d, BodyValidationError)
+        self.assertEqual(transport.producerState, 'stopped')
+
+    def testMaxBodySizeErrorStatus(self):
+        self.config['proxyfetch.match'] = 'needle'
+        self.config['proxyfetch.max-body-size'] = '10'
+        monitor = ProxyFetchMonitoringProtocol(
+            self.coordinator, self.server, self.config, reactor=self.reactor)
+        d = monitor.getAgentPage("http://en.wikipedia.org/test.php", status=200)
+        protocol, transport = self.connect()
+        protocol.dataReceived(
+            "HTTP/1.1 500 Internal Server Error\r\n"
+            "Content-Length: 1000\r\n\r\n" + "needle" * 10)
+        f = self.failureResultOf(d, twisted.web.error.Error)
+        self.assertEqual(f.value.status, "500")
+        self.assertEqual(transport.producerState, 'stopped')
+
+    def testCancelDuringBody(self):
+        d = self.monitor.getAgentPage(
+            "http://en.wikipedia.org/test.php", status=200)
+        protocol, transport = self.connect()
+        protocol.dataReceived(
+            "HTTP/1.1 200 OK\r\nContent-Length: 100\r\n\r\npartial")
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+
+    def testBodyValidationHEAD(self):
+        self.config['proxyfetch.match'] = 'needle'
+        self.config['proxyfetch.method'] = 'HEAD'
+        with self.assertRaises(ValueError):
+            ProxyFetchMonitoringProtocol(None, self.server, self.config)
+
+    def testStopClosesCachedConnections(self):
+        with mock.patch.object(self.monitor.pool,
+                               'closeCachedConnections') as mock_close:
+            self.monitor.stop()
+        mock_close.assert_called_once()
+
+
+class ResponseBodyValidatorTestCase(unittest.TestCase):
+    """Test case for `pybal.monitors.proxyfetch.ResponseBodyValidator`."""
+
+    def validator(self, regex):
+        self.finished = defer.Deferred()
+        validator = ResponseBodyValidator(self.finished, regex=re.compile(regex))
+        validator.REGEX_OVERLAP = 8
+        validator.makeConnection(StringTransport())
+        return validator
+
+    def result(self):
+        results = []
+        self.finished.addBoth(results.append)
+        return results[0] if results else None
+
+    def bodyDone(self, validator):
+        validator.connectionLost(failure.Failure(twisted.web.client.ResponseDone()))
+
+    def testRegexAcrossChunks(self):
+        validator = self.validator(r'status: ok')
+        for chunk in ('xxxxxxxx', 'xstat', 'us: ', 'ok\n'):
+            validator.dataReceived(chunk)
+        self.assertEqual(self.result(), 20)
+
+    def testRegexEndOfChunk(self):
+        # The end of a chunk is not the end of the body
+        validator = self.validator(r'^status: (ok|degraded)$')
+        validator.REGEX_OVERLAP = 64
+        validator.dataReceived('status: ok')
+        self.assertFalse(self.finished.called)
+        validator.dataReceived('-but-actually-broken')
+        self.bodyDone(validator)
+        self.assertIsInstance(self.result().value, BodyValidationError)
+
+        validator = self.validator(r'^status: (ok|degraded)$')
+        validator.REGEX_OVERLAP = 64
+        validator.dataReceived('status: ok')
+        self.assertFalse(self.finished.called)
+        self.bodyDone(validator)
+        self.assertEqual(self.result(), 10)
+
+    def testRegexBufferBounded(self):
+        validator = self.validator(r'needle')
+        for i in range(100):
+            validator.dataReceived('haystack')
+            self.assertLessEqual(len(validator.buffer), 9)
+        validator.connectionLost(failure.Failure(twisted.web.client.ResponseDone()))
+        self.assertIsInstance(self.result().value, BodyValidationError)
+
+    def testRegexAnchor(self):
+        # The start of the search window is not the start of the body
+        validator = self.validator(r'^ok')
+        validator.dataReceived('xxxxxxxxxxxx')
+        validator.dataReceived('ok')
+        validator.connectionLost(failure.Failure(twisted.web.client.ResponseDone()))
+        self.assertIsInstance(self.result().value, BodyValidationError)
+
+        validator = self.validator(r'(?m)^ok')
+        validator.dataReceived('xxxxxxxxxxx\n')
+        validator.dataReceived('ok\n')
+        self.assertEqual(self.result(), 15)
+
+
+class TLSClientContextTestCase(PyBalTestCase):
+    """Test case for `pybal.monitors.proxyfetch.TLSClientContext`."""
+
+    hostname = 'en.wikipedia.org'
+
+    def setUp(self):
+        super(TLSClientContextTestCase, self).setUp()
+        from OpenSSL import crypto
+        from twisted.internet import ssl
+
+        key, cert = self.makeCertificate(self.hostname)
+        self.caFile = self.mktemp()
+        with open(self.caFile, 'w') as f:
+            f.write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
+
+        self.serverOptions = ssl.CertificateOptions(privateKey=key,
+                                                    certificate=cert)
+        self.handshakes = []
+        # OpenSSL drops the session of a server connection that is freed
+        # without a TLS shutdown, so keep the server connections around
+        self.serverConnections = []
+
+    @staticmethod
+    def makeCertificate(hostname):
+        """Returns a key and self-signed certificate for hostname"""
+        from OpenSSL import crypto
+
+        key = crypto.PKey()
+        key.generate_key(crypto.TYPE_RSA, 2048)
+        cert = crypto.X509()
+        cert.set_version(2)
+        cert.get_subject().CN = hostname
+        cert.set_serial_number(1)
+        cert.gmtime_adj_notBefore(0)
+        cert.gmtime_adj_notAfter(3600)
+        cert.set_issuer(cert.get_subject())
+        cert.set_pubkey(key)
+        cert.add_extensions([
+            crypto.X509Extension(b"basicConstraints", True, b"CA:TRUE"),
+            crypto.X509Extension(b"subjectAltName", False, b"DNS:" + hostname)])
+        cert.sign(key, 'sha256')
+        return key, cert
+
+    def connect(self, tlsContext, hostname=None, key='cp1001', shutdown=False):
+        """
+        Connects a TLS client and server in memory, and closes the
+        connection with a TLS shutdown if requested
+        """
+        creator = tlsContext.connectionCreator(
+            key, hostname or self.hostname,
+            lambda resumed, duration: self.handshakes.append(resumed))
+        serverFactory = TLSMemoryBIOFactory(
+            self.serverOptions, False,
+            protocol.Factory.forProtocol(protocol.Protocol))
+        clientFactory = TLSMemoryBIOFactory(
+            creator, True, protocol.Factory.forProtocol(protocol.Protocol))
+        client, server, pump = iosim.connectedServerAndClient(
+            lambda: serverFactory.buildProtocol(None),
+            lambda: clientFactory.buildProtocol(None))
+        self.serverConnections.append(server._tlsConnection)
+        if shutdown:
+            client.loseConnection()
+        else:
+            client.transport.loseConnection()
+        pump.flush()
+        return client
+
+    def testSessionResumption(self):
+        tlsContext = TLSClientContext()
+        for i in range(3):
+            self.connect(tlsContext)
+        self.assertEqual(self.handshakes, [False, True, True])
+        self.assertIn(('cp1001', self.hostname), tlsContext.sessions)
+
+        # Sessions are per server
+        self.connect(tlsContext, key='cp1002')
+        self.assertEqual(self.handshakes[-1], False)
+
+        tlsContext.forget('cp1001')
+        self.assertNotIn(('cp1001', self.hostname), tlsContext.sessions)
+        self.assertIn(('cp1002', self.hostname), tlsContext.sessions)
+        self.connect(tlsContext)
+        self.assertEqual(self.handshakes[-1], False)
+
+    def testSessionWithoutConnection(self):
+        from OpenSSL import SSL
+        tlsContext = TLSClientContext()
+        # OpenSSL invalidates the session of a connection that is freed
+        # without a TLS shutdown
+        self.connect(tlsContext, shutdown=True)
+        gc.collect()
+        # Only the session is kept, not the closed connection
+        self.assertIsInstance(tlsContext.sessions[('cp1001', self.hostname)],
+                              SSL.Session)
+        self.connect(tlsContext)
+        self.assertEqual(self.handshakes, [False, True])
+
+    def testVerify(self):
+        tlsContext = TLSClientContext(verify=True, caFile=self.caFile)
+        self.connect(tlsContext)
+        self.assertEqual(self.handshakes, [False])
+
+    def testVerifyHostnameMismatch(self):
+        tlsContext = TLSClientContext(verify=True, caFile=self.caFile)
+        self.connect(tlsContext, hostname='www.example.com')
+        self.assertEqual(self.handshakes, [])
+        self.assertEqual(tlsContext.sessions, {})
+
+    def testVerifyUntrusted(self):
+        from OpenSSL import crypto
+        key, otherCert = self.makeCertificate(self.hostname)
+        with open(self.caFile, 'w') as f:
+            f.write(crypto.dump_certificate(crypto.FILETYPE_PEM, otherCert))
+        tlsContext = TLSClientContext(verify=True, caFile=self.caFile)
+        self.connect(tlsContext)
+        self.assertEqual(self.handshakes, [])
+
+
+class ProxyFetchTLSTestCase(PyBalTestCase):
+    """Test case for the TLS handling of `ProxyFetchMonitoringProtocol`."""
+
+    def setUp(self):
+        super(ProxyFetchTLSTestCase, self).setUp()
+        self.config['proxyfetch.url'] = '["https://en.wikipedia.org/test.php"]'
+        self.patcher = mock.patch.dict(ProxyFetchMonitoringProtocol.tlsContexts,
+                                       clear=True)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def testSharedTLSContext(self):
+        monitor = ProxyFetchMonitoringProtocol(None, self.server, self.config)
+        otherServer = mock.Mock(host='cp1002', ip='127.0.0.2', port=443,
+                                lvsservice=self.lvsservice)
+        otherMonitor = ProxyFetchMonitoringProtocol(None, otherServer,
+                                                    self.config)
+        self.assertIsNotNone(monitor.tlsContext)
+        self.assertIs(monitor.tlsContext, otherMonitor.tlsContext)
+        self.assertFalse(monitor.tlsContext.verify)
+
+        self.config['proxyfetch.tls-verify'] = 'true'
+        verifyingMonitor = ProxyFetchMonitoringProtocol(None, self.server,
+                                                        self.config)
+        self.assertIsNot(verifyingMonitor.tlsContext, monitor.tlsContext)
+        self.assertTrue(verifyingMonitor.tlsContext.verify)
+
+    def testTLSContextReleased(self):
+        monitor = ProxyFetchMonitoringProtocol(None, self.server, self.config)
+        key = (self.lvsservice.name, False, None)
+        self.assertIs(ProxyFetchMonitoringProtocol.tlsContexts[key],
+                      monitor.tlsContext)
+        del monitor
+        gc.collect()
+        self.assertNotIn(key, ProxyFetchMonitoringProtocol.tlsContexts)
+
+    def testStopForgetsSessions(self):
+        monitor = ProxyFetchMonitoringProtocol(None, self.server, self.config,
+                                               reactor=self.reactor)
+        monitor.active = True
+        with mock.patch.object(monitor.tlsContext, 'forget') as mock_forget:
+            monitor.stop()
+        mock_forget.assert_called_once_with(self.server.host)
+
+    def testNoTLSContextForHTTP(self):
+        self.config['proxyfetch.url'] = '["http://en.wikipedia.org/test.php"]'
+        monitor = ProxyFetchMonitoringProtocol(None, self.server, self.config)
+        self.assertIsNone(monitor.tlsContext)
+        self.assertIsNone(monitor._tlsConnectionCreator('en.wikipedia.org'))
+
+    def testCheckUsesTLSContext(self):
+        monitor = ProxyFetchMonitoringProtocol(None, self.server, self.config,
+                                               reactor=self.reactor)
+        monitor.active = True
+        monitor.check()
+        contextFactory = self.reactor.sslClients[0][3]
+        self.assertIs(contextFactory.tlsContext, monitor.tlsContext)
+        self.assertEqual(contextFactory.key, self.server.host)
+        self.assertEqual(contextFactory.hostname, 'en.wikipedia.org')
+        monitor.stop()
+
+    def testAgentUsesTLSContext(self):
+        self.config['proxyfetch.keepalive'] = 'true'
+        monitor = ProxyFetchMonitoringProtocol(None, self.server, self.config,
+                                               reactor=self.reactor)
+        monitor.getAgentPage("https://en.wikipedia.org/test.php")
+        host, port, factory, contextFactory = self.reactor.sslClients[0][:4]
+        self.assertEqual((host, port), (self.server.ip, self.server.port))
+        self.assertIs(contextFactory.tlsContext, monitor.tlsContext)
+        self.assertEqual(contextFactory.hostname, 'en.wikipedia.org')
+        monitor.stop()
+
+    def testTLSHandshakeDone(self):
+        monitor = ProxyFetchMonitoringProtocol(None, self.server, self.config)
+        metrics = ProxyFetchMonitoringProtocol.proxyfetch_metrics
+        with mock.patch.dict(metrics, {'tls_handshakes_total': mock.Mock()}), \
+                mock.patch.object(monitor, 'observePhaseDuration') as mock_observe:
+            monitor._tlsHandshakeDone(True, 0.01)
+            metrics['tls_handshakes_total'].labels.assert_called_once_with(
+                result='resumed', **monitor.metric_labels)
+        mock_observe.assert_called_once_with('tls_handshake', 0.01)
+
 
 class RedirHTTPPageGetterTestCase(unittest.TestCase):
     def setUp(self):
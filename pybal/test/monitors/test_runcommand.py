@@ -20,10 +20,13 @@ from twisted.python import runtime, failure
 
 # Testing imports
 from .. import test_monitor
+from ..fixtures import PyBalTestCase
 
 # Pybal imports
 import pybal.monitor
-from pybal.monitors.runcommand import RunCommandMonitoringProtocol, ProcessGroupProcess
+import pybal.scheduler
+from pybal.monitors.runcommand import (RunCommandMonitoringProtocol, ProcessGroupProcess,
+                                      CoprocessProtocol, RunCommandExecutor)
 
 
 class RunCommandMonitoringProtocolTestCase(test_monitor.BaseLoopingCheckMonitoringProtocolTestCase):
@@ -48,6 +51,8 @@ class RunCommandMonitoringProtocolTestCase(test_monitor.BaseLoopingCheckMonitori
         self.assertEqual(monitor.arguments, ["--help",])
 
         self.assertTrue(monitor.logOutput)
+        self.assertEqual(monitor.maxOutput, RunCommandMonitoringProtocol.MAX_OUTPUT)
+        self.assertFalse(monitor.coprocess)
 
         self.assertIsNone(monitor.runningProcess)
 
@@ -102,6 +107,16 @@ class RunCommandMonitoringProtocolTestCase(test_monitor.BaseLoopingCheckMonitori
             self.monitor.childDataReceived(1, "Testing\ttab")
         mock_report.assert_called_with(r"Cmd stdout: Testing\ttab")
 
+    def testChildDataReceivedTruncated(self):
+        self.monitor.maxOutput = 10
+        with mock.patch.object(self.monitor, 'report') as mock_report:
+            self.monitor.childDataReceived(1, "12345")
+            self.monitor.childDataReceived(1, "6789012345")
+            self.monitor.childDataReceived(1, "more")
+        self.assertEqual(mock_report.call_args_list, [
+            mock.call("Cmd stdout: 12345"),
+            mock.call("Cmd stdout: 67890 (truncated)")])
+
     def testChildDataReceivedNoLogging(self):
         self.monitor.logOutput = False
         with mock.patch.object(self.monitor, 'report') as mock_report:
@@ -137,6 +152,16 @@ class RunCommandMonitoringProtocolTestCase(test_monitor.BaseLoopingCheckMonitori
         mocks['_resultDown'].assert_called()
         mocks['_resultUp'].assert_not_called()
 
+    def testProcessEndedObservesCheckDuration(self):
+        self.monitor.checkStartTime = runtime.seconds()
+        self.monitor.runningProcessDeferred = twisted.internet.defer.Deferred()
+        reason = failure.Failure(twisted.internet.error.ProcessTerminated("Process returned error"))
+        with mock.patch.multiple(self.monitor,
+                                 _resultDown=mock.DEFAULT,
+                                 observeCheckDuration=mock.DEFAULT) as mocks:
+            self.monitor.processEnded(reason)
+        mocks['observeCheckDuration'].assert_called_once_with(mock.ANY, 'failed')
+
     def testProcessEndedProcessUnknownError(self):
         """Assert that any other (unknown) error also reports the monitor as down"""
 
@@ -153,6 +178,59 @@ class RunCommandMonitoringProtocolTestCase(test_monitor.BaseLoopingCheckMonitori
         self.assertIsNone(self.monitor.checkCall)
         self.reactor.advance(self.monitor.intvCheck)
 
+    @mock.patch('twisted.internet.process.Process.__init__')
+    def testRunCommandQueued(self, mock_processInit):
+        """A command waits for a process slot of the executor"""
+        executor = RunCommandExecutor.forReactor(self.reactor)
+        executor.maxChildren = 1
+        self.successResultOf(executor.acquire('other'))
+
+        d = self.monitor.runCommand()
+        mock_processInit.assert_not_called()
+        self.assertIsNone(self.monitor.runningProcess)
+
+        executor.release()
+        mock_processInit.assert_called_once()
+        self.assertEqual(executor.children, 1)
+
+        # The slot is released when the process ends
+        reason = failure.Failure(twisted.internet.error.ProcessDone("Process ended cleanly"))
+        self.monitor.processEnded(reason)
+        self.successResultOf(d)
+        self.assertEqual(executor.children, 0)
+
+    def testStopWhileWaitingForSlot(self):
+        executor = RunCommandExecutor.forReactor(self.reactor)
+        executor.maxChildren = 1
+        self.successResultOf(executor.acquire('other'))
+
+        self.monitor.run()
+        self.monitor.runCommand()
+        self.monitor.stop()
+        self.assertIsNone(self.monitor.executorDeferred)
+        self.assertEqual(executor.queues, {})
+
+    def testStopWhileWaitingForSlotReleasesAdmission(self):
+        executor = RunCommandExecutor.forReactor(self.reactor)
+        executor.maxChildren = 0
+        admission = pybal.scheduler.CheckAdmission.forReactor(self.reactor)
+
+        self.monitor.run()
+        d = self.monitor._admittedCheck(self.monitor.check)
+        self.assertEqual(admission.inFlight, 1)
+        self.monitor.stop()
+        self.successResultOf(d)
+        self.assertEqual(admission.inFlight, 0)
+        self.assertEqual(dict(admission.inFlightPerServer), {})
+
+    def testSpawnFailure(self):
+        executor = RunCommandExecutor.forReactor(self.reactor)
+        with mock.patch.object(self.monitor, '_spawnProcess',
+                               side_effect=OSError(errno.EAGAIN, "Testing")):
+            d = self.monitor.runCommand()
+        self.failureResultOf(d, OSError)
+        self.assertEqual(executor.children, 0)
+
     def testLeftoverProcesses(self):
         """Assert that leftoverProcesses has different output for the two cases"""
 
@@ -161,6 +239,226 @@ class RunCommandMonitoringProtocolTestCase(test_monitor.BaseLoopingCheckMonitori
             self.monitor.leftoverProcesses(False)
         self.assertNotEqual(mock_report.call_args[0], mock_report.call_args[1])
 
+    def testCheck(self):
+        with mock.patch.multiple(self.monitor,
+                                 runCommand=mock.DEFAULT,
+                                 queryCoprocess=mock.DEFAULT) as mocks:
+            self.monitor.check()
+            mocks['runCommand'].assert_called_once()
+            self.monitor.coprocess = True
+            self.monitor.check()
+            mocks['queryCoprocess'].assert_called_once()
+
+    def testLeftoverProcessesMetric(self):
+        metric = mock.Mock()
+        with mock.patch.dict(RunCommandMonitoringProtocol.runcommand_metrics,
+                             {'leftover_processes_total': metric}):
+            self.monitor.leftoverProcesses(True)
+        metric.labels.assert_called_once_with(killed=True, **self.monitor.metric_labels)
+        metric.labels.return_value.inc.assert_called_once()
+
+
+class RunCommandExecutorTestCase(unittest.TestCase):
+    """Test case for `pybal.monitors.runcommand.RunCommandExecutor`."""
+
+    def setUp(self):
+        self.reactor = twisted.internet.task.Clock()
+        self.executor = RunCommandExecutor(self.reactor, maxChildren=2)
+
+    def testForReactor(self):
+        executor = RunCommandExecutor.forReactor(self.reactor)
+        self.assertIs(RunCommandExecutor.forReactor(self.reactor), executor)
+        self.assertIsNone(executor.maxChildren)
+
+    def testUnlimited(self):
+        executor = RunCommandExecutor(self.reactor)
+        for i in range(100):
+            self.assertTrue(executor.acquire('service').called)
+        self.assertEqual(executor.children, 100)
+
+    def testFairQueue(self):
+        """Services take turns when process slots free up"""
+        self.assertTrue(self.executor.acquire('big').called)
+        self.assertTrue(self.executor.acquire('big').called)
+        started = []
+        for i in range(3):
+            self.executor.acquire('big').addCallback(lambda _, i=i: started.append(('big', i)))
+        self.executor.acquire('small').addCallback(lambda _: started.append(('small', 0)))
+        self.assertEqual(started, [])
+
+        self.reactor.advance(1)
+        self.executor.release()
+        self.executor.release()
+        self.assertEqual(started, [('big', 0), ('small', 0)])
+        self.assertEqual(self.executor.children, 2)
+
+        self.executor.release()
+        self.executor.release()
+        self.assertEqual(started[2:], [('big', 1), ('big', 2)])
+        self.assertEqual(self.executor.queues, {})
+
+    def testCancel(self):
+        self.executor.acquire('a')
+        self.executor.acquire('a')
+        d = self.executor.acquire('b')
+        d.cancel()
+        self.assertTrue(d.called)
+        d.addErrback(lambda f: f.trap(twisted.internet.defer.CancelledError))
+        self.assertEqual(self.executor.queues, {})
+        self.executor.release()
+        self.assertEqual(self.executor.children, 1)
+
+    def testMetrics(self):
+        metrics = {name: mock.Mock() for name in RunCommandExecutor.metrics}
+        with mock.patch.dict(RunCommandExecutor.metrics, metrics):
+            self.executor.acquire('a')
+            self.executor.acquire('a')
+            d = self.executor.acquire('b')
+            metrics['queue_depth'].set.assert_called_with(1)
+            metrics['children'].set.assert_called_with(2)
+            self.reactor.advance(3)
+            self.executor.release()
+            self.assertTrue(d.called)
+            metrics['queue_wait_seconds'].observe.assert_called_once_with(3)
+            metrics['queue_depth'].set.assert_called_with(0)
+
+
+class RunCommandCoprocessTestCase(PyBalTestCase):
+    """Test case for the coprocess mode of `RunCommandMonitoringProtocol`."""
+
+    def setUp(self):
+        super(RunCommandCoprocessTestCase, self).setUp()
+        self.config['runcommand.command'] = '/usr/local/bin/check'
+        self.config['runcommand.coprocess'] = 'true'
+        self.config['runcommand.timeout'] = '5'
+        self.monitor = RunCommandMonitoringProtocol(
+            self.coordinator, self.server, self.config, reactor=self.reactor)
+        self.monitor.active = True
+        self.spawn = mock.patch.object(self.monitor, '_spawnProcess',
+                                       side_effect=self.spawnProcess).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def spawnProcess(self, proto, *args, **kwargs):
+        process = mock.Mock(spec=ProcessGroupProcess)
+        proto.makeConnection(process)
+        return process
+
+    def query(self):
+        d = self.monitor.queryCoprocess()
+        return d, self.monitor.coprocessProtocol
+
+    def testQueryStartsCoprocess(self):
+        d, proto = self.query()
+        self.spawn.assert_called_once_with(
+            proto, self.monitor.command,
+            [self.monitor.command] + self.monitor.arguments,
+            sessionLeader=True)
+        proto.transport.write.assert_called_once_with("check\n")
+        self.assertIs(self.monitor.runningProcess, proto.transport)
+
+        # The coprocess is reused
+        proto.outReceived("up\n")
+        self.successResultOf(d)
+        d, proto2 = self.query()
+        self.assertIs(proto2, proto)
+        self.spawn.assert_called_once()
+
+    def testUp(self):
+        d, proto = self.query()
+        with mock.patch.object(self.monitor, 'observeCheckDuration') as mock_observe:
+            proto.outReceived("u")
+            self.assertNoResult(d)
+            proto.outReceived("p\r\n")
+        self.successResultOf(d)
+        self.assertTrue(self.monitor.up)
+        mock_observe.assert_called_once_with(mock.ANY, 'successful')
+
+    def testDown(self):
+        d, proto = self.query()
+        with mock.patch.object(self.monitor, '_resultDown') as mock_resultDown:
+            proto.outReceived("down backend overloaded\n")
+        self.successResultOf(d)
+        mock_resultDown.assert_called_once_with("backend overloaded")
+        self.assertIs(self.monitor.coprocessProtocol, proto)
+
+    def testInvalidResponse(self):
+        d, proto = self.query()
+        process = self.monitor.runningProcess
+        with mock.patch.object(self.monitor, '_resultDown') as mock_resultDown:
+            proto.outReceived("maybe\n")
+        self.successResultOf(d)
+        mock_resultDown.assert_called_once()
+        process.signalProcess.assert_called_once_with(signal.SIGKILL)
+        self.assertIsNone(self.monitor.coprocessProtocol)
+
+    def testLineTooLong(self):
+        d, proto = self.query()
+        with mock.patch.object(self.monitor, '_resultDown') as mock_resultDown:
+            proto.outReceived("x" * (CoprocessProtocol.MAX_LINE_LENGTH + 1))
+        self.successResultOf(d)
+        mock_resultDown.assert_called_once()
+        self.assertEqual(proto.buffer, '')
+
+    def testTimeout(self):
+        d, proto = self.query()
+        process = self.monitor.runningProcess
+        with mock.patch.object(self.monitor, '_resultDown') as mock_resultDown:
+            self.reactor.advance(5)
+        self.successResultOf(d)
+        mock_resultDown.assert_called_once_with("Coprocess request timed out")
+        process.signalProcess.assert_called_once_with(signal.SIGKILL)
+        self.assertIsNone(proto.pending)
+
+        # Restarted on the next check
+        d, proto2 = self.query()
+        self.assertIsNot(proto2, proto)
+        self.assertEqual(self.spawn.call_count, 2)
+
+        # The late end of the killed coprocess doesn't affect the new one
+        proto.processEnded(failure.Failure(
+            twisted.internet.error.ProcessTerminated(signal=signal.SIGKILL)))
+        self.assertIs(self.monitor.coprocessProtocol, proto2)
+
+    def testCrash(self):
+        d, proto = self.query()
+        with mock.patch.object(self.monitor, '_resultDown') as mock_resultDown:
+            proto.processEnded(failure.Failure(
+                twisted.internet.error.ProcessTerminated(exitCode=1)))
+        self.successResultOf(d)
+        mock_resultDown.assert_called_once()
+        self.assertIsNone(self.monitor.coprocessProtocol)
+        self.assertIsNone(self.monitor.runningProcess)
+
+    def testStop(self):
+        d, proto = self.query()
+        process = self.monitor.runningProcess
+        self.monitor.stop()
+        process.signalProcess.assert_called_once_with(signal.SIGKILL)
+        with mock.patch.object(self.monitor, '_resultDown') as mock_resultDown:
+            proto.processEnded(failure.Failure(
+                twisted.internet.error.ProcessTerminated(signal=signal.SIGKILL)))
+        self.assertIsNone(self.successResultOf(d))
+        mock_resultDown.assert_not_called()
+
+    def testStderr(self):
+        d, proto = self.query()
+        with mock.patch.object(self.monitor, 'report') as mock_report:
+            proto.errReceived("warning")
+        mock_report.assert_called_once_with("Cmd stdout: warning")
+
+    def testStderrLimitPerRequest(self):
+        self.monitor.maxOutput = 4
+        d, proto = self.query()
+        with mock.patch.object(self.monitor, 'report') as mock_report:
+            proto.errReceived("warning")
+            proto.outReceived("up\n")
+            # Logged again for the next request
+            self.query()
+            proto.errReceived("oops")
+        mock_report.assert_has_calls([
+            mock.call("Cmd stdout: warn (truncated)"),
+            mock.call("Cmd stdout: oops")])
+
 
 class ProcessGroupProcessTestCase(unittest.TestCase):
     @mock.patch('twisted.internet.process.Process.__init__')
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+  PyBal unit tests
+  ~~~~~~~~~~~~~~~~
+
+  This module contains tests for `pybal.monitors.tcpconnect`.
+"""
+
+# Python imports
+import mock
+import socket
+
+# Twisted imports
+from twisted.internet import defer, error, protocol, reactor
+from twisted.python import failure
+
+# Testing imports
+from .. import test_monitor
+
+# Pybal imports
+from pybal.monitors.tcpconnect import TCPConnectMonitoringProtocol
+
+
+class TCPConnectMonitoringProtocolTestCase(test_monitor.BaseLoopingCheckMonitoringProtocolTestCase):
+    """Test case for `pybal.monitors.TCPConnectMonitoringProtocol`."""
+
+    monitorClass = TCPConnectMonitoringProtocol
+
+    def testInit(self):
+        """Test `TCPConnectMonitoringProtocol.__init__`."""
+        self.assertEqual(self.monitor.intvCheck, TCPConnectMonitoringProtocol.INTV_CHECK)
+        self.assertEqual(self.monitor.toConnect, TCPConnectMonitoringProtocol.TIMEOUT_CONNECT)
+
+        self.config['tcpconnect.timeout'] = '0.5'
+        monitor = TCPConnectMonitoringProtocol(self.coordinator, self.server, self.config)
+        self.assertEqual(monitor.toConnect, 0.5)
+
+    def connect(self):
+        """Starts a check, and returns its Deferred and client factory"""
+        d = self.monitor.check()
+        host, port, factory, timeout, bindAddress = self.reactor.tcpClients[-1]
+        self.assertEqual((host, port), (self.server.ip, self.server.port))
+        self.assertEqual(timeout, self.monitor.toConnect)
+        return d, factory
+
+    def testCheckConnected(self):
+        self.monitor.active = True
+        d, factory = self.connect()
+        transport = mock.Mock()
+        with mock.patch.object(self.monitor, 'observeCheckDuration') as mock_observe:
+            factory.buildProtocol(None).makeConnection(transport)
+        self.successResultOf(d)
+        self.assertTrue(self.monitor.up)
+        mock_observe.assert_called_once_with(mock.ANY, 'successful')
+
+        # Closed with a reset
+        transport.getHandle().setsockopt.assert_called_once_with(
+            socket.SOL_SOCKET, socket.SO_LINGER, TCPConnectMonitoringProtocol.LINGER_RESET)
+        transport.abortConnection.assert_called_once()
+        self.assertIsNone(self.monitor.connectDeferred)
+
+    def testCheckFailed(self):
+        self.monitor.active = True
+        self.monitor.up = True
+        d, factory = self.connect()
+        with mock.patch.object(self.monitor, 'observeCheckDuration') as mock_observe:
+            factory.clientConnectionFailed(
+                mock.Mock(), failure.Failure(error.ConnectionRefusedError()))
+        self.successResultOf(d)
+        self.assertFalse(self.monitor.up)
+        mock_observe.assert_called_once_with(mock.ANY, 'failed')
+
+    def testCheckTimeout(self):
+        self.monitor.active = True
+        self.monitor.up = True
+        d, factory = self.connect()
+        factory.clientConnectionFailed(
+            mock.Mock(), failure.Failure(error.TimeoutError()))
+        self.successResultOf(d)
+        self.assertFalse(self.monitor.up)
+
+    def testStopDuringCheck(self):
+        self.monitor.run()
+        self.monitor.up = True
+        d, factory = self.connect()
+        self.monitor.stop()
+        self.assertIsNone(self.successResultOf(d))
+        self.assertTrue(self.monitor.up)
+
+    def testCheckIPv6(self):
+        self.server.ip = '::1'
+        self.monitor.check()
+        self.assertEqual(self.reactor.tcpClients[-1][0], '::1')
+
+    @defer.inlineCallbacks
+    def testResetOnLoopback(self):
+        """Connects to a real listening socket, and resets the connection"""
+        lost = defer.Deferred()
+
+        class ServerProtocol(protocol.Protocol):
+            def connectionLost(self, reason):
+                lost.callback(reason.type)
+
+        port = reactor.listenTCP(0, protocol.Factory.forProtocol(ServerProtocol),
+                                 interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        self.server.ip = '127.0.0.1'
+        self.server.port = port.getHost().port
+        monitor = TCPConnectMonitoringProtocol(
+            self.coordinator, self.server, self.config, reactor=reactor)
+        monitor.active = True
+        yield monitor.check()
+        self.assertTrue(monitor.up)
+        # Reset (ConnectionLost), rather than closed cleanly (ConnectionDone)
+        reason = yield lost
+        self.assertIs(reason, error.ConnectionLost)
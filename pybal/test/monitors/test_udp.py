@@ -8,9 +8,11 @@
 
 # Python imports
 import mock
+import socket, struct, time, unittest
 
 # Twisted imports
 import twisted.test.proto_helpers
+from twisted.internet import task
 
 # Testing imports
 from .. import test_monitor
@@ -18,7 +20,8 @@ from .. import test_monitor
 # Pybal imports
 import pybal.monitor
 import pybal.util
-from pybal.monitors.udp import UDPMonitoringProtocol
+from pybal.monitors.udp import UDPMonitoringProtocol, UDPProbeEngine
+from pybal.scheduler import CheckScheduler
 
 
 class UDPMonitoringProtocolTestCase(test_monitor.BaseLoopingCheckMonitoringProtocolTestCase):
@@ -46,12 +49,41 @@ class UDPMonitoringProtocolTestCase(test_monitor.BaseLoopingCheckMonitoringProto
             self.coordinator, self.server, config)
         self.assertEquals(monitor.intvCheck, 5)
         self.assertEquals(monitor.icmp_timeout, 2)
+        self.assertTrue(self.monitor.sharedSocket)
 
-    def testRun(self):
+    @mock.patch.object(UDPProbeEngine, 'supported', return_value=True)
+    def testRun(self, mock_supported):
         self.assertEquals(self.monitor.last_down_timestamp, 0)
         super(UDPMonitoringProtocolTestCase, self).testRun()
+        engine = UDPProbeEngine.forReactor(self.reactor)
+        self.assertIs(self.monitor.engine, engine)
+        self.assertIn(self.monitor,
+                      engine.monitors[(self.server.ip, self.server.port)])
+        self.reactor.listenUDP.assert_not_called()
+
+        self.monitor.stop()
+        self.assertEqual(engine.monitors, {})
+        self.assertIsNone(engine.drainCall)
+
+    def testRunUnshared(self):
+        self.monitor.sharedSocket = False
+        self.monitor.run()
+        self.assertIsNone(self.monitor.engine)
+        self.reactor.listenUDP.assert_called_with(0, self.monitor)
+
+    @mock.patch.object(UDPProbeEngine, 'supported', return_value=False)
+    def testRunUnsupported(self, mock_supported):
+        self.monitor.run()
+        self.assertIsNone(self.monitor.engine)
         self.reactor.listenUDP.assert_called_with(0, self.monitor)
 
+    def testCheckShared(self):
+        self.monitor.active = True
+        self.monitor.engine = mock.Mock(spec=UDPProbeEngine)
+        self.monitor.check()
+        self.monitor.engine.probe.assert_called_once_with(self.monitor)
+        self.assertTrue(self.monitor.up)
+
     def testCheck(self):
         self.monitor.active = True
         self.monitor.transport = mock.Mock()
@@ -65,3 +97,119 @@ class UDPMonitoringProtocolTestCase(test_monitor.BaseLoopingCheckMonitoringProto
         monitor.connectionRefused()
         self.assertFalse(monitor.up)
         self.assertNotEquals(monitor.last_down_timestamp, 0)
+
+
+@unittest.skipUnless(UDPProbeEngine.supported(), "IP_RECVERR requires Linux")
+class UDPProbeEngineTestCase(unittest.TestCase):
+    """Test case for `pybal.monitors.udp.UDPProbeEngine`."""
+
+    def setUp(self):
+        self.reactor = task.Clock()
+        self.engine = UDPProbeEngine(self.reactor)
+        self.addCleanup(lambda: [s.close() for s in self.engine.sockets.values()])
+
+    def closedPort(self, family=socket.AF_INET, host='127.0.0.1'):
+        """Returns a local UDP port nothing listens on"""
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+        sock.bind((host, 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return port
+
+    def mockMonitor(self, ip, port):
+        monitor = mock.Mock(spec=UDPMonitoringProtocol)
+        monitor.server = mock.Mock(ip=ip, port=port)
+        return monitor
+
+    def waitForErrors(self):
+        """Waits for ICMP errors to arrive on loopback, and drains them"""
+        time.sleep(0.05)
+        self.engine.drain()
+
+    def testRegister(self):
+        monitor = self.mockMonitor('127.0.0.1', 53)
+        self.engine.register(monitor)
+        self.assertEqual(self.engine.monitors, {('127.0.0.1', 53): set([monitor])})
+        self.assertTrue(self.engine.drainCall.running)
+        # Draining doesn't count against the check rate budget
+        self.assertEqual(CheckScheduler.forReactor(self.reactor).rate, 0.0)
+        self.engine.probe(monitor)
+        sock = self.engine.sockets[socket.AF_INET]
+        self.engine.unregister(monitor)
+        self.assertEqual(self.engine.monitors, {})
+        self.assertIsNone(self.engine.drainCall)
+        # The sockets are closed with the last monitor
+        self.assertEqual(self.engine.sockets, {})
+        self.assertRaises(socket.error, sock.fileno)
+
+    def testDemultiplexing(self):
+        closed = self.mockMonitor('127.0.0.1', self.closedPort())
+        other = self.mockMonitor('127.0.0.1', self.closedPort())
+        listening = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        listening.bind(('127.0.0.1', 0))
+        self.addCleanup(listening.close)
+        up = self.mockMonitor('127.0.0.1', listening.getsockname()[1])
+        for monitor in (closed, up):
+            self.engine.register(monitor)
+        self.addCleanup(self.engine.drainCall.stop)
+
+        self.engine.probe(closed)
+        self.engine.probe(up)
+        self.waitForErrors()
+        closed.connectionRefused.assert_called_once()
+        up.connectionRefused.assert_not_called()
+        # One socket per address family
+        self.assertEqual(len(self.engine.sockets), 1)
+
+        # An error pending from an earlier probe doesn't prevent sending
+        self.engine.probe(closed)
+        time.sleep(0.05)
+        self.engine.probe(up)
+        self.assertEqual(listening.recvfrom(1)[0], "")
+        other.connectionRefused.assert_not_called()
+
+    def testRepliesDiscarded(self):
+        """Replies of servers don't crowd out the errors"""
+
+        closed = self.mockMonitor('127.0.0.1', self.closedPort())
+        self.engine.register(closed)
+        self.addCleanup(self.engine.drainCall.stop)
+        sock = self.engine._socket(socket.AF_INET)
+        sock.bind(('127.0.0.1', 0))
+
+        # More replies than fit in the receive buffer
+        replier = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(replier.close)
+        for i in range(2000):
+            replier.sendto("reply", sock.getsockname())
+
+        for i in range(5):
+            self.engine.probe(closed)
+        self.waitForErrors()
+        self.assertEqual(closed.connectionRefused.call_count, 5)
+        self.assertRaises(socket.error, sock.recv, 1)
+
+    def testIPv6(self):
+        try:
+            port = self.closedPort(socket.AF_INET6, '::1')
+        except socket.error:
+            raise unittest.SkipTest("No IPv6 loopback")
+        monitor = self.mockMonitor('::1', port)
+        self.engine.register(monitor)
+        self.addCleanup(self.engine.drainCall.stop)
+        self.engine.probe(monitor)
+        self.waitForErrors()
+        monitor.connectionRefused.assert_called_once()
+        self.assertIn(socket.AF_INET6, self.engine.sockets)
+
+    def testDrainEmpty(self):
+        self.engine._socket(socket.AF_INET)
+        self.engine.drain()
+
+    def testParseAddress(self):
+        sockaddr = struct.pack('=H', socket.AF_INET) + struct.pack('!H', 53) + \
+            socket.inet_pton(socket.AF_INET, '192.0.2.1') + '\0' * 8
+        self.assertEqual(UDPProbeEngine._parseAddress(sockaddr), ('192.0.2.1', 53))
+        sockaddr6 = struct.pack('=H', socket.AF_INET6) + struct.pack('!H', 53) + \
+            '\0' * 4 + socket.inet_pton(socket.AF_INET6, '2001:db8::1') + '\0' * 4
+        self.assertEqual(UDPProbeEngine._parseAddress(sockaddr6), ('2001:db8::1', 53))
@@ -12,6 +12,7 @@ import pybal.util
 
 from pybal.bgp import bgp, ip as bgpip, attributes, peering
 
+from twisted.internet import task
 from twisted.internet.error import CannotListenError
 
 import mock
@@ -140,8 +141,383 @@ class TestBGPFailover(PyBalTestCase):
         mockPeering.manualStop = mock.MagicMock()
         self.bgpfailover.closeSession(mockPeering)
         mockPeering.setAdvertisements.assert_called()
+        # The withdrawals don't wait for the MRAI
+        mockPeering.flushUpdates.assert_called_once()
         mockPeering.manualStop.assert_called()
 
+    def testMRAIConfig(self):
+        self.assertEqual(self.bgpfailover.mrai, 0)
+        self.config['bgp-mrai'] = '5'
+        self.assertEqual(pybal.bgpfailover.BGPFailover(self.config).mrai, 5.0)
+        self.config['bgp-mrai'] = '-1'
+        self.assertRaises(ValueError, pybal.bgpfailover.BGPFailover, self.config)
+        self.config['bgp-mrai'] = '5'
+        self.config['bgp-peer-mrai'] = "{ '::1': -1 }"
+        self.assertRaises(ValueError, pybal.bgpfailover.BGPFailover, self.config)
+        self.config['bgp-peer-mrai'] = "[ 30 ]"
+        self.assertRaises(ValueError, pybal.bgpfailover.BGPFailover, self.config)
+
+    @mock.patch('pybal.bgpfailover.reactor.addSystemEventTrigger')
+    @mock.patch('pybal.bgpfailover.reactor.listenTCP')
+    @mock.patch('pybal.bgpfailover.bgppeering.NaiveBGPPeering')
+    def testMRAISetup(self, mock_peering, mock_listenTCP, mock_trigger):
+        self.config['bgp-mrai'] = '5'
+        bgpfailover = pybal.bgpfailover.BGPFailover(self.config)
+        bgpfailover.setup()
+        self.assertEqual(mock_peering.return_value.mrai, 5.0)
+
+    @mock.patch('pybal.bgpfailover.reactor.addSystemEventTrigger')
+    @mock.patch('pybal.bgpfailover.reactor.listenTCP')
+    @mock.patch('pybal.bgpfailover.bgppeering.NaiveBGPPeering')
+    def testPeerMRAISetup(self, mock_peering, mock_listenTCP, mock_trigger):
+        peerings = {}
+        mock_peering.side_effect = lambda asn, peerAddr: peerings.setdefault(
+            peerAddr, mock.MagicMock())
+        self.config['bgp-mrai'] = '5'
+        self.config['bgp-peer-mrai'] = "{ '::1': 30 }"
+        bgpfailover = pybal.bgpfailover.BGPFailover(self.config)
+        bgpfailover.setup()
+        self.assertEqual(peerings['127.255.255.255'].mrai, 5.0)
+        self.assertEqual(peerings['::1'].mrai, 30)
+
+    def testGracefulRestartConfig(self):
+        self.assertIsNone(self.bgpfailover.restartTime)
+        self.config['bgp-graceful-restart'] = 'yes'
+        self.assertEqual(pybal.bgpfailover.BGPFailover(self.config).restartTime, 120)
+        self.config['bgp-graceful-restart-time'] = '300'
+        self.assertEqual(pybal.bgpfailover.BGPFailover(self.config).restartTime, 300)
+        self.config['bgp-graceful-restart-time'] = '5000'
+        self.assertRaises(ValueError, pybal.bgpfailover.BGPFailover, self.config)
+
+    @mock.patch('pybal.bgpfailover.reactor.addSystemEventTrigger')
+    @mock.patch('pybal.bgpfailover.reactor.listenTCP')
+    @mock.patch('pybal.bgpfailover.bgppeering.NaiveBGPPeering')
+    def testGracefulRestartSetup(self, mock_peering, mock_listenTCP, mock_trigger):
+        self.config['bgp-graceful-restart'] = 'yes'
+        bgpfailover = pybal.bgpfailover.BGPFailover(self.config)
+        bgpfailover.setup()
+        self.assertEqual(mock_peering.return_value.restartTime, 120)
+
+    def testCloseSessionGracefulRestart(self):
+        self.config['bgp-graceful-restart'] = 'yes'
+        bgpfailover = pybal.bgpfailover.BGPFailover(self.config)
+        mockPeering = mock.MagicMock(spec=peering.NaiveBGPPeering)
+        mockPeering.peerAddr = "127.66.66.66"
+        bgpfailover.closeSession(mockPeering)
+        # The announcements stay with the peer
+        mockPeering.setAdvertisements.assert_not_called()
+        mockPeering.manualStop.assert_not_called()
+        mockPeering.gracefulStop.assert_called_once()
+
+    def testGracefulShutdownConfig(self):
+        self.assertIsNone(self.bgpfailover.drainTime)
+        self.config['bgp-graceful-shutdown'] = 'yes'
+        bgpfailover = pybal.bgpfailover.BGPFailover(self.config)
+        self.assertEqual(bgpfailover.drainTime, 30.0)
+        self.assertTrue(bgpfailover.drainCommunity)
+        self.assertIsNone(bgpfailover.drainMED)
+
+        self.config['bgp-graceful-shutdown-community'] = 'no'
+        self.assertRaises(ValueError, pybal.bgpfailover.BGPFailover, self.config)
+        self.config['bgp-graceful-shutdown-med'] = '1000'
+        self.assertEqual(pybal.bgpfailover.BGPFailover(self.config).drainMED, 1000)
+        self.config['bgp-graceful-shutdown-time'] = '-1'
+        self.assertRaises(ValueError, pybal.bgpfailover.BGPFailover, self.config)
+
+    def testGracefulShutdownWithGracefulRestart(self):
+        self.config['bgp-graceful-shutdown'] = 'yes'
+        self.config['bgp-graceful-restart'] = 'yes'
+        # Draining would shift the traffic away for the whole restart
+        self.assertRaises(ValueError, pybal.bgpfailover.BGPFailover, self.config)
+
+    def gracefulShutdownFailover(self, **config):
+        self.config['bgp-graceful-shutdown'] = 'yes'
+        self.config['bgp-nexthop-ipv4'] = '127.1.1.1'
+        self.config.update(config)
+        bgpfailover = pybal.bgpfailover.BGPFailover(self.config)
+        bgpfailover.associateService('127.0.0.1', None, med=None)
+        return bgpfailover
+
+    def testDrainAdvertisements(self):
+        bgpfailover = self.gracefulShutdownFailover(**{'bgp-graceful-shutdown-med': '1000'})
+        advertisement, = bgpfailover.buildAdvertisements()
+        drained, = bgpfailover.drainAdvertisements({advertisement})
+        self.assertEqual(drained.prefix, advertisement.prefix)
+        self.assertEqual(drained.attributes[attributes.CommunityAttribute].value,
+                         [attributes.COMMUNITY_GRACEFUL_SHUTDOWN])
+        self.assertEqual(drained.attributes[attributes.MEDAttribute].value, 1000)
+        self.assertEqual(drained.attributes[attributes.NextHopAttribute],
+                         advertisement.attributes[attributes.NextHopAttribute])
+
+        # Existing communities are kept
+        drained, = bgpfailover.drainAdvertisements({drained})
+        self.assertEqual(drained.attributes[attributes.CommunityAttribute].value,
+                         [attributes.COMMUNITY_GRACEFUL_SHUTDOWN])
+
+    def testDrainAdvertisementsMEDOnly(self):
+        bgpfailover = self.gracefulShutdownFailover(**{
+            'bgp-graceful-shutdown-med': '1000',
+            'bgp-graceful-shutdown-community': 'no'})
+        drained, = bgpfailover.drainAdvertisements(bgpfailover.buildAdvertisements())
+        self.assertNotIn(attributes.CommunityAttribute, drained.attributes)
+        self.assertEqual(drained.attributes[attributes.MEDAttribute].value, 1000)
+
+    def testCloseSessionGracefulShutdown(self):
+        bgpfailover = self.gracefulShutdownFailover()
+        advertisements = bgpfailover.buildAdvertisements()
+        mockPeering = mock.MagicMock(spec=peering.NaiveBGPPeering)
+        mockPeering.peerAddr = "127.66.66.66"
+        mockPeering.estabProtocol = mock.Mock()
+        mockPeering.toAdvertise = {(bgp.AFI_INET, bgp.SAFI_UNICAST): advertisements}
+
+        clock = task.Clock()
+        with mock.patch('pybal.bgpfailover.reactor', clock):
+            d = bgpfailover.closeSession(mockPeering)
+        # Drain first
+        drained, = mockPeering.setAdvertisements.call_args[0][0]
+        self.assertIn(attributes.CommunityAttribute, drained.attributes)
+        mockPeering.manualStop.assert_not_called()
+        self.assertNoResult(d)
+
+        # Then withdraw
+        clock.advance(bgpfailover.drainTime)
+        mockPeering.setAdvertisements.assert_called_with(set())
+        mockPeering.manualStop.assert_called_once()
+        self.successResultOf(d)
+
+    def testCloseSessionGracefulShutdownNotEstablished(self):
+        bgpfailover = self.gracefulShutdownFailover()
+        mockPeering = mock.MagicMock(spec=peering.NaiveBGPPeering)
+        mockPeering.peerAddr = "127.66.66.66"
+        mockPeering.estabProtocol = None
+        # Nothing to drain
+        self.successResultOf(bgpfailover.closeSession(mockPeering))
+        mockPeering.setAdvertisements.assert_called_once_with(set())
+        mockPeering.manualStop.assert_called_once()
+
+    @mock.patch('pybal.bgpfailover.reactor.addSystemEventTrigger')
+    @mock.patch('pybal.bgpfailover.BGPSpeakerProcess')
+    def testGracefulShutdownSpeakerTimeout(self, mock_speaker, mock_trigger):
+        mock_speaker.return_value.stopTimeout = 10.0
+        self.config['bgp-speaker-process'] = 'yes'
+        bgpfailover = self.gracefulShutdownFailover()
+        bgpfailover.setup()
+        # The speaker gets the time to drain its sessions
+        self.assertEqual(bgpfailover.speaker.stopTimeout, 40.0)
+
+    def healthFailover(self, **config):
+        self.config['bgp-health-threshold'] = '0.5'
+        self.config['bgp-nexthop-ipv4'] = '127.1.1.1'
+        self.config.update(config)
+        bgpfailover = pybal.bgpfailover.BGPFailover(self.config)
+        self.services = [mock.Mock(ip='127.0.0.1', capacity=None, capacityCallbacks=[])
+                         for i in range(2)]
+        for service in self.services:
+            bgpfailover.associateService(service.ip, service, None)
+        self.mockPeering = mock.MagicMock(spec=peering.NaiveBGPPeering)
+        self.mockPeering.peerAddr = '127.255.255.255'
+        bgpfailover.peerings['127.255.255.255'] = self.mockPeering
+        self.clock = task.Clock()
+        patcher = mock.patch('pybal.bgpfailover.reactor', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return bgpfailover
+
+    def setCapacity(self, bgpfailover, service, capacity):
+        service.capacity = capacity
+        bgpfailover.serviceCapacityChanged(service)
+
+    def testHealthConfig(self):
+        self.assertEqual(self.bgpfailover.healthThreshold, 0.0)
+        self.config['bgp-health-threshold'] = '1.5'
+        self.assertRaises(ValueError, pybal.bgpfailover.BGPFailover, self.config)
+
+    def testHealthSetup(self):
+        bgpfailover = self.healthFailover()
+        with mock.patch.object(bgpfailover, 'startPeerings'):
+            bgpfailover.setup()
+        for service in self.services:
+            self.assertEqual(service.capacityCallbacks,
+                             [bgpfailover.serviceCapacityChanged])
+
+    def testBuildAdvertisementsReused(self):
+        bgpfailover = self.healthFailover()
+        advertisement, = bgpfailover.buildAdvertisements()
+        # Unchanged advertisements don't get announced again
+        self.assertIs(bgpfailover.buildAdvertisements().pop(), advertisement)
+
+    def testHealthWithdraw(self):
+        bgpfailover = self.healthFailover()
+        advertisement, = bgpfailover.buildAdvertisements()
+
+        # Healthy as long as one of the services is
+        self.setCapacity(bgpfailover, self.services[0], 0.2)
+        self.setCapacity(bgpfailover, self.services[1], 0.6)
+        self.mockPeering.setAdvertisements.assert_not_called()
+        self.setCapacity(bgpfailover, self.services[1], 0.4)
+        self.mockPeering.setAdvertisements.assert_called_once_with(set())
+
+        # Announced again after the hold-down time
+        self.setCapacity(bgpfailover, self.services[0], 0.5)
+        self.clock.advance(bgpfailover.healthHoldDown - 1)
+        self.mockPeering.setAdvertisements.assert_called_once_with(set())
+        self.clock.advance(1)
+        self.mockPeering.setAdvertisements.assert_called_with({advertisement})
+
+    def testHealthFlap(self):
+        bgpfailover = self.healthFailover()
+        self.setCapacity(bgpfailover, self.services[0], 0.0)
+        self.setCapacity(bgpfailover, self.services[1], 0.0)
+        self.setCapacity(bgpfailover, self.services[0], 1.0)
+        # Unhealthy again during the hold-down time
+        self.setCapacity(bgpfailover, self.services[0], 0.0)
+        self.clock.advance(bgpfailover.healthHoldDown)
+        self.assertFalse(self.clock.getDelayedCalls())
+        self.mockPeering.setAdvertisements.assert_called_once_with(set())
+
+    def testHealthMED(self):
+        bgpfailover = self.healthFailover(**{'bgp-health-med': '1000'})
+        self.setCapacity(bgpfailover, self.services[0], 0.0)
+        self.setCapacity(bgpfailover, self.services[1], 0.0)
+        advertisement, = self.mockPeering.setAdvertisements.call_args[0][0]
+        self.assertEqual(advertisement.attributes[attributes.MEDAttribute].value, 1000)
+
+    def testHealthSpeaker(self):
+        bgpfailover = self.healthFailover()
+        bgpfailover.speaker = mock.Mock()
+        self.setCapacity(bgpfailover, self.services[0], 0.0)
+        self.setCapacity(bgpfailover, self.services[1], 0.0)
+        bgpfailover.speaker.setAdvertisements.assert_called_once_with(set())
+        self.mockPeering.setAdvertisements.assert_not_called()
+
+    def testHealthShutdown(self):
+        bgpfailover = self.healthFailover()
+        bgpfailover.closeSession(self.mockPeering)
+        self.mockPeering.reset_mock()
+        # Updates would undo the shutdown sequence
+        self.setCapacity(bgpfailover, self.services[0], 0.0)
+        self.setCapacity(bgpfailover, self.services[1], 0.0)
+        self.mockPeering.setAdvertisements.assert_not_called()
+
+    def dynamicMEDFailover(self, **config):
+        config.setdefault('bgp-health-threshold', '0')
+        config['bgp-dynamic-med'] = 'yes'
+        config['bgp-med'] = '10'
+        return self.healthFailover(**config)
+
+    def announcedMED(self):
+        advertisement, = self.mockPeering.setAdvertisements.call_args[0][0]
+        return advertisement.attributes[attributes.MEDAttribute].value
+
+    def testDynamicMEDConfig(self):
+        self.assertFalse(self.bgpfailover.dynamicMED)
+        self.config['bgp-dynamic-med-range'] = '-1'
+        self.assertRaises(ValueError, pybal.bgpfailover.BGPFailover, self.config)
+
+    def testDynamicMEDSetup(self):
+        bgpfailover = self.dynamicMEDFailover()
+        with mock.patch.object(bgpfailover, 'startPeerings'):
+            bgpfailover.setup()
+        self.assertEqual(self.services[0].capacityCallbacks,
+                         [bgpfailover.serviceCapacityChanged])
+
+    def testDynamicMED(self):
+        bgpfailover = self.dynamicMEDFailover()
+        self.assertEqual(bgpfailover.prefixMED(bgpip.IPv4IP('127.0.0.1')), 10)
+
+        # The lowest capacity counts
+        self.setCapacity(bgpfailover, self.services[0], 1.0)
+        self.mockPeering.setAdvertisements.assert_not_called()
+        self.setCapacity(bgpfailover, self.services[1], 0.5)
+        self.assertEqual(self.announcedMED(), 60)
+
+        # Hysteresis
+        self.mockPeering.reset_mock()
+        self.setCapacity(bgpfailover, self.services[1], 0.45)
+        self.mockPeering.setAdvertisements.assert_not_called()
+
+        # Rate limiting
+        self.setCapacity(bgpfailover, self.services[1], 0.3)
+        self.setCapacity(bgpfailover, self.services[1], 0.2)
+        self.mockPeering.setAdvertisements.assert_not_called()
+        self.clock.advance(bgpfailover.medInterval)
+        self.assertEqual(self.announcedMED(), 90)
+
+        # Back to the configured MED at full capacity
+        self.clock.advance(bgpfailover.medInterval)
+        self.setCapacity(bgpfailover, self.services[1], 1.0)
+        self.assertEqual(self.announcedMED(), 10)
+
+    def testDynamicMEDRecovery(self):
+        bgpfailover = self.dynamicMEDFailover()
+        self.setCapacity(bgpfailover, self.services[0], 1.0)
+        self.setCapacity(bgpfailover, self.services[1], 0.8)
+        self.assertEqual(self.announcedMED(), 30)
+        self.clock.advance(bgpfailover.medInterval)
+        self.setCapacity(bgpfailover, self.services[1], 0.95)
+        self.assertEqual(self.announcedMED(), 15)
+
+        # Within the hysteresis, but full capacity restores the configured MED
+        self.clock.advance(bgpfailover.medInterval)
+        self.setCapacity(bgpfailover, self.services[1], 1.0)
+        self.assertEqual(self.announcedMED(), 10)
+
+        # And no capacity always gets the end of the range
+        self.clock.advance(bgpfailover.medInterval)
+        self.setCapacity(bgpfailover, self.services[1], 0.05)
+        self.assertEqual(self.announcedMED(), 105)
+        self.clock.advance(bgpfailover.medInterval)
+        self.setCapacity(bgpfailover, self.services[1], 0.0)
+        self.assertEqual(self.announcedMED(), 110)
+
+    def testDynamicMEDUnhealthy(self):
+        bgpfailover = self.dynamicMEDFailover(**{
+            'bgp-health-threshold': '0.1',
+            'bgp-health-med': '1000'})
+        self.setCapacity(bgpfailover, self.services[0], 0.0)
+        self.setCapacity(bgpfailover, self.services[1], 0.0)
+        self.assertEqual(self.announcedMED(), 1000)
+
+    def testBFDConfig(self):
+        self.assertFalse(self.bgpfailover.bfd)
+        self.config['bgp-bfd'] = 'yes'
+        bgpfailover = pybal.bgpfailover.BGPFailover(self.config)
+        self.assertEqual(bgpfailover.bfdInterval, 300)
+        self.assertEqual(bgpfailover.bfdMultiplier, 3)
+        self.config['bgp-bfd-multiplier'] = '0'
+        self.assertRaises(ValueError, pybal.bgpfailover.BGPFailover, self.config)
+
+    @mock.patch('pybal.bgpfailover.reactor.addSystemEventTrigger')
+    @mock.patch('pybal.bgpfailover.reactor.listenUDP')
+    @mock.patch('pybal.bgpfailover.reactor.listenTCP')
+    @mock.patch('pybal.bgpfailover.bfd.BFDSession')
+    @mock.patch('pybal.bgpfailover.bgppeering.NaiveBGPPeering')
+    def testBFDSetup(self, mock_peering, mock_session, mock_listenTCP,
+                     mock_listenUDP, mock_trigger):
+        self.config['bgp-bfd'] = 'yes'
+        self.config['bgp-bfd-interval'] = '100'
+        bgpfailover = pybal.bgpfailover.BGPFailover(self.config)
+        bgpfailover.setup()
+
+        # Dual stack, as one of the peers is IPv6
+        self.assertEqual(mock_listenUDP.call_args[1]['interface'], '::')
+        self.assertEqual(mock_session.call_count, 2)
+        listener, peerAddr = mock_session.call_args[0]
+        self.assertEqual(peerAddr, '::1')
+        self.assertEqual(mock_session.call_args[1]['desiredMinTx'], 100000)
+        session = mock_session.return_value
+        session.start.assert_called()
+        self.assertEqual(session.stateCallbacks.append.call_args[0][0],
+                         mock_peering.return_value.bfdStateChanged)
+
+        # BFD goes down after BGP. NaiveBGPPeering is mocked already.
+        mockPeering = mock.MagicMock()
+        mockPeering.peerAddr = '::1'
+        mockPeering.manualStop.side_effect = lambda: session.stop.assert_not_called()
+        bgpfailover.closeSession(mockPeering)
+        mockPeering.manualStop.assert_called_once()
+        session.stop.assert_called_once()
+
     def testAssociateService(self):
         bgpfailover = self.bgpfailover
         mockService = mock.MagicMock()
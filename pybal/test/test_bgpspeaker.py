@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+"""
+  PyBal unit tests
+  ~~~~~~~~~~~~~~~~
+
+  This module contains tests for `pybal.bgpspeaker`.
+
+"""
+
+import json
+
+import mock
+
+from twisted.internet import defer, error, reactor
+from twisted.python import failure
+from twisted.test import proto_helpers
+
+import pybal.bgpfailover
+import pybal.util
+from pybal.bgp import bgp, ip as bgpip, peering
+from pybal.bgpspeaker import (BGPSpeakerControlProtocol, BGPSpeakerProcess,
+                              decodeAdvertisement, encodeAdvertisement)
+
+from .fixtures import PyBalTestCase
+
+
+class BGPSpeakerTestCase(PyBalTestCase):
+    """Base class for `pybal.bgpspeaker` test cases."""
+
+    def setUp(self):
+        super(BGPSpeakerTestCase, self).setUp()
+        # Reset class attributes
+        pybal.bgpfailover.BGPFailover.prefixes = {}
+        pybal.bgpfailover.BGPFailover.ipServices = {}
+        pybal.bgpfailover.BGPFailover.peerings = {}
+        self.config = pybal.util.ConfigDict({
+            'bgp': "yes",
+            'bgp-local-asn': "64666",
+            'bgp-peer-address': "[ \"127.255.255.255\" ]",
+            'bgp-nexthop-ipv4': "127.1.1.1",
+            'bgp-nexthop-ipv6': "::1"
+        })
+
+    def advertisements(self):
+        bgpfailover = pybal.bgpfailover.BGPFailover(self.config)
+        bgpfailover.associateService('192.168.1.1', None, med=None)
+        bgpfailover.associateService('2001:db8::1', None, med=20)
+        return bgpfailover.buildAdvertisements()
+
+
+class AdvertisementEncodingTestCase(BGPSpeakerTestCase):
+    """Test case for the encoding of advertisements."""
+
+    def testRoundTrip(self):
+        advertisements = self.advertisements()
+        for advertisement in advertisements:
+            # Survives JSON serialization
+            data = json.loads(json.dumps(encodeAdvertisement(advertisement)))
+            decoded = decodeAdvertisement(data)
+            self.assertEqual(decoded.prefix, advertisement.prefix)
+            self.assertEqual(type(decoded.prefix), type(advertisement.prefix))
+            self.assertEqual(decoded.addressfamily, advertisement.addressfamily)
+            self.assertEqual(decoded.attributes, advertisement.attributes)
+            self.assertEqual(set(decoded.attributes), set(advertisement.attributes))
+
+    def testPrefix(self):
+        prefix = bgpip.IPPrefix('10.0.0.0/8')
+        advertisement = bgp.Advertisement(prefix, self.advertisements().pop().attributes)
+        decoded = decodeAdvertisement(encodeAdvertisement(advertisement))
+        self.assertEqual(decoded.prefix, prefix)
+
+
+class BGPSpeakerProcessTestCase(BGPSpeakerTestCase):
+    """Test case for `pybal.bgpspeaker.BGPSpeakerProcess`."""
+
+    def setUp(self):
+        super(BGPSpeakerProcessTestCase, self).setUp()
+        self.reactor.spawnProcess = mock.Mock(
+            side_effect=lambda proto, *a, **kw: proto.makeConnection(mock.Mock()))
+        self.speaker = BGPSpeakerProcess(self.reactor, self.config,
+                                         set([(bgp.AFI_INET, bgp.SAFI_UNICAST)]))
+
+    def messages(self):
+        return [json.loads(call[0][0])
+                for call in self.speaker.transport.write.call_args_list]
+
+    def testStart(self):
+        advertisements = self.advertisements()
+        self.speaker.setAdvertisements(advertisements)
+        self.speaker.start()
+        self.assertTrue(self.speaker.running)
+        args = self.reactor.spawnProcess.call_args[0][2]
+        self.assertEqual(args[1:], ['-c', 'from pybal.bgpspeaker import main; main()'])
+
+        # The speaker starts with all advertisements
+        configure, = self.messages()
+        self.assertEqual(configure['op'], 'configure')
+        self.assertEqual(configure['configuration'], dict(self.config))
+        self.assertEqual(configure['addressFamilies'], [[1, 1]])
+        self.assertEqual(len(configure['advertisements']), len(advertisements))
+
+    def testSetAdvertisements(self):
+        self.speaker.start()
+        self.speaker.setAdvertisements(self.advertisements())
+        advertise = self.messages()[-1]
+        self.assertEqual(advertise['op'], 'advertise')
+        self.assertEqual(len(advertise['advertisements']), 2)
+
+    def testSessionState(self):
+        self.speaker.start()
+        gauge = mock.Mock()
+        with mock.patch.dict(peering.BGPPeering.metrics,
+                             {'bgp_session_established': gauge}):
+            self.speaker.outReceived('{"op": "session", "peer": "127.255.255.255", ')
+            self.speaker.outReceived('"established": true}\nnot json\n')
+            self.assertEqual(self.speaker.established, set(["127.255.255.255"]))
+            gauge.labels.assert_called_with(local_asn=64666, peer="127.255.255.255")
+            gauge.labels.return_value.set.assert_called_with(1)
+
+            # Sessions go with the speaker
+            self.speaker.processEnded(failure.Failure(error.ProcessTerminated(exitCode=1)))
+            self.assertEqual(self.speaker.established, set())
+            gauge.labels.return_value.set.assert_called_with(0)
+
+    def testRestart(self):
+        self.speaker.start()
+        self.speaker.setAdvertisements(self.advertisements())
+        self.speaker.processEnded(failure.Failure(error.ProcessTerminated(exitCode=1)))
+        self.assertFalse(self.speaker.running)
+        self.reactor.advance(BGPSpeakerProcess.RESTART_DELAY)
+        self.assertTrue(self.speaker.running)
+        self.assertEqual(self.reactor.spawnProcess.call_count, 2)
+        # The current advertisements are sent to the new speaker
+        configure = self.messages()[-1]
+        self.assertEqual(configure['op'], 'configure')
+        self.assertEqual(len(configure['advertisements']), 2)
+
+    def testStop(self):
+        self.speaker.start()
+        d = self.speaker.stop()
+        self.speaker.transport.closeStdin.assert_called_once()
+        self.assertNoResult(d)
+        self.speaker.processEnded(failure.Failure(error.ProcessDone(0)))
+        self.successResultOf(d)
+        # Not restarted
+        self.reactor.advance(BGPSpeakerProcess.STOP_TIMEOUT)
+        self.assertEqual(self.reactor.spawnProcess.call_count, 1)
+        self.speaker.transport.signalProcess.assert_not_called()
+
+    def testStopTimeout(self):
+        self.speaker.start()
+        d = self.speaker.stop()
+        self.reactor.advance(BGPSpeakerProcess.STOP_TIMEOUT)
+        self.speaker.transport.signalProcess.assert_called_once_with('KILL')
+        self.speaker.processEnded(failure.Failure(error.ProcessTerminated(signal=9)))
+        self.successResultOf(d)
+
+    def testStopping(self):
+        self.speaker.start()
+        self.speaker.stop()
+        self.speaker.transport.write.reset_mock()
+        # Nothing is sent after closing the speaker's stdin
+        self.speaker.setAdvertisements(self.advertisements())
+        self.speaker.transport.write.assert_not_called()
+
+    def testStopNotRunning(self):
+        self.successResultOf(self.speaker.stop())
+
+
+class BGPSpeakerControlProtocolTestCase(BGPSpeakerTestCase):
+    """Test case for `pybal.bgpspeaker.BGPSpeakerControlProtocol`."""
+
+    def setUp(self):
+        super(BGPSpeakerControlProtocolTestCase, self).setUp()
+        self.reactor.stop = mock.Mock()
+        self.protocol = BGPSpeakerControlProtocol(self.reactor)
+        self.transport = proto_helpers.StringTransport()
+        self.protocol.makeConnection(self.transport)
+
+    def send(self, message):
+        self.protocol.dataReceived(json.dumps(message) + '\n')
+
+    def configure(self, advertisements=[]):
+        def startPeerings(failover, addressFamilies, advertisements):
+            failover.peerings['127.255.255.255'] = mock.Mock(
+                spec=peering.NaiveBGPPeering, sessionCallbacks=[],
+                peerAddr='127.255.255.255')
+        with mock.patch.object(pybal.bgpfailover.BGPFailover, 'startPeerings',
+                               autospec=True, side_effect=startPeerings) as mock_start:
+            self.send({'op': 'configure', 'configuration': dict(self.config),
+                       'addressFamilies': [[1, 1], [2, 1]],
+                       'advertisements': [encodeAdvertisement(ad)
+                                          for ad in advertisements]})
+        return mock_start
+
+    def testConfigure(self):
+        mock_start = self.configure()
+        failover, addressFamilies, advertisements = mock_start.call_args[0]
+        self.assertEqual(failover.myASN, 64666)
+        self.assertEqual(failover.peerAddresses, ['127.255.255.255'])
+        self.assertEqual(addressFamilies, set([(1, 1), (2, 1)]))
+        self.assertEqual(advertisements, set())
+
+    def testConfigureAdvertisements(self):
+        mock_start = self.configure(self.advertisements())
+        advertisements = mock_start.call_args[0][2]
+        self.assertEqual(len(advertisements), 2)
+
+    def testAdvertise(self):
+        # Ignored before configuration
+        self.send({'op': 'advertise', 'advertisements': []})
+
+        self.configure()
+        advertisements = self.advertisements()
+        self.send({'op': 'advertise', 'advertisements': [
+            encodeAdvertisement(ad) for ad in advertisements]})
+        mockPeering = self.protocol.failover.peerings['127.255.255.255']
+        sent = mockPeering.setAdvertisements.call_args[0][0]
+        self.assertEqual(set(ad.prefix for ad in sent),
+                         set(ad.prefix for ad in advertisements))
+
+    def testAdvertiseIncremental(self):
+        advertisements = self.advertisements()
+        self.configure(advertisements)
+        mockPeering = self.protocol.failover.peerings['127.255.255.255']
+        current = set(self.protocol.advertisements.itervalues())
+
+        # Unchanged advertisements are reused, so only changes get sent
+        changed = set(ad for ad in self.advertisements()
+                      if ad.addressfamily == (bgp.AFI_INET6, bgp.SAFI_UNICAST))
+        self.config['bgp-med'] = '10'
+        changed |= set(ad for ad in self.advertisements()
+                       if ad.addressfamily == (bgp.AFI_INET, bgp.SAFI_UNICAST))
+        self.send({'op': 'advertise', 'advertisements': [
+            encodeAdvertisement(ad) for ad in changed]})
+        sent = mockPeering.setAdvertisements.call_args[0][0]
+        self.assertEqual(len(sent), 2)
+        self.assertEqual(len(sent & current), 1)
+        reused, = sent & current
+        self.assertEqual(reused.addressfamily, (bgp.AFI_INET6, bgp.SAFI_UNICAST))
+
+    def testSessionStateChanged(self):
+        self.configure()
+        mockPeering = self.protocol.failover.peerings['127.255.255.255']
+        callback, = mockPeering.sessionCallbacks
+        callback(mockPeering, True)
+        self.assertEqual(json.loads(self.transport.value()),
+                         {'op': 'session', 'peer': '127.255.255.255',
+                          'established': True})
+
+    def testInvalidMessage(self):
+        self.protocol.dataReceived('not json\n{"op": "unknown"}\n')
+        self.assertIsNone(self.protocol.failover)
+
+    def testConnectionLost(self):
+        self.protocol.connectionLost(failure.Failure(error.ConnectionDone()))
+        self.reactor.stop.assert_called_once()
+
+
+class BGPFailoverSpeakerTestCase(BGPSpeakerTestCase):
+    """Test case for `pybal.bgpfailover.BGPFailover` with a speaker process."""
+
+    @mock.patch('pybal.bgpfailover.reactor.addSystemEventTrigger')
+    @mock.patch('pybal.bgpfailover.BGPSpeakerProcess')
+    @mock.patch('pybal.bgpfailover.bgppeering.NaiveBGPPeering')
+    def testSetup(self, mock_peering, mock_speaker, mock_trigger):
+        self.config['bgp-speaker-process'] = 'yes'
+        bgpfailover = pybal.bgpfailover.BGPFailover(self.config)
+        bgpfailover.associateService('192.168.1.1', None, med=None)
+        bgpfailover.setup()
+
+        # No peerings in this process
+        mock_peering.assert_not_called()
+        speaker = mock_speaker.return_value
+        speaker.start.assert_called_once()
+        advertisements = speaker.setAdvertisements.call_args[0][0]
+        self.assertEqual(len(advertisements), 1)
+        mock_trigger.assert_called_once_with('before', 'shutdown', speaker.stop)
+
+
+class BGPSpeakerIntegrationTestCase(BGPSpeakerTestCase):
+    """Runs a real BGP speaker process."""
+
+    timeout = 30
+
+    def testStartStop(self):
+        self.config['bgp-local-ips'] = '["127.0.0.1"]'
+        self.config['bgp-local-port'] = '0'
+        speaker = BGPSpeakerProcess(reactor, self.config,
+                                    set([(bgp.AFI_INET, bgp.SAFI_UNICAST)]))
+        speaker.setAdvertisements(self.advertisements())
+        speaker.start()
+
+        ended = []
+        processEnded = speaker.processEnded
+        def recordEnded(reason):
+            ended.append(reason)
+            processEnded(reason)
+        speaker.processEnded = recordEnded
+
+        d = defer.Deferred()
+        reactor.callLater(1, d.callback, None)
+        d.addCallback(lambda _: speaker.stop())
+
+        def checkExited(result):
+            # The speaker exited by itself, after closing its sessions
+            ended[0].trap(error.ProcessDone)
+            self.assertFalse(speaker.running)
+        return d.addCallback(checkExited)
@@ -158,6 +158,32 @@ class CoordinatorTestCase(PyBalTestCase):
             self.assertFalse(cp1045.up)
             mockDepool.assert_called()
 
+    def testResultDownQuorum(self):
+        servers = {
+            'cp1045.eqiad.wmnet': {},
+        }
+        self.setServers(servers, up=True, enabled=True)
+        cp1045 = self.coordinator.servers['cp1045.eqiad.wmnet']
+        cp1045.pool = True
+        cp1045.aggregation = 'quorum'
+        cp1045.quorum = 1
+
+        monitors = [mock.MagicMock(up=True), mock.MagicMock(up=False)]
+        for m in monitors:
+            m.server = cp1045
+            cp1045.addMonitor(m)
+
+        with mock.patch.object(self.coordinator, 'depool') as mockDepool:
+            # The quorum is still met, so the server stays pooled
+            self.coordinator.resultDown(monitors[1], "fake down result")
+            self.assertTrue(cp1045.up)
+            mockDepool.assert_not_called()
+
+            monitors[0].up = False
+            self.coordinator.resultDown(monitors[0], "fake down result")
+            self.assertFalse(cp1045.up)
+            mockDepool.assert_called_once_with(cp1045)
+
     def testResultUp(self):
         servers = {
             'cp1045.eqiad.wmnet': {},
@@ -260,6 +286,32 @@ class CoordinatorTestCase(PyBalTestCase):
         self.assertFalse(cp1046.is_pooled)
         self.assertFalse(self.coordinator.pooledDownServers)
 
+    def testPooledCapacity(self):
+        self.assertEqual(self.coordinator.pooledCapacity(), 0.0)
+
+        servers = {
+            'cp1045.eqiad.wmnet': {'weight': 30},
+            'cp1046.eqiad.wmnet': {'weight': 10},
+        }
+        self.setServers(servers, up=True, enabled=True, pool=True, is_pooled=True)
+        self.assertEqual(self.coordinator.pooledCapacity(), 1.0)
+
+        # Down but still pooled servers don't count
+        cp1045 = self.coordinator.servers['cp1045.eqiad.wmnet']
+        cp1045.up = False
+        self.assertEqual(self.coordinator.pooledCapacity(), 0.25)
+
+        # Depooling hands over the new capacity
+        cp1046 = self.coordinator.servers['cp1046.eqiad.wmnet']
+        cp1046.up = False
+        self.coordinator.depool(cp1046)
+        self.coordinator.lvsservice.setCapacity.assert_called_with(0.0)
+
+        cp1046.up = True
+        cp1046.ready = True
+        self.coordinator.repool(cp1046)
+        self.coordinator.lvsservice.setCapacity.assert_called_with(0.25)
+
     def test2serversCanDepool(self):
         servers = {
             'cp1045.eqiad.wmnet': {},
@@ -7,6 +7,7 @@
 
 """
 import copy
+import mock
 import pybal.ipvs
 import pybal.util
 import pybal.bgpfailover
@@ -211,6 +212,19 @@ class LVSServiceTestCase(PyBalTestCase):
         lvs_service.initServer(self.server)
         self.assertEquals(self.server.port, 80)
 
+    def testSetCapacity(self):
+        """Test `LVSService.setCapacity`."""
+        lvs_service = pybal.ipvs.LVSService('http', self.service, self.config)
+        self.assertIsNone(lvs_service.capacity)
+        callback = mock.Mock()
+        lvs_service.capacityCallbacks.append(callback)
+        lvs_service.setCapacity(0.5)
+        self.assertEquals(lvs_service.capacity, 0.5)
+        callback.assert_called_once_with(lvs_service)
+        # Only changes are reported
+        lvs_service.setCapacity(0.5)
+        callback.assert_called_once_with(lvs_service)
+
     def testGetDepoolThreshold(self):
         """Test `LVSService.getDepoolThreshold`."""
         lvs = pybal.ipvs.LVSService('test', self.service, self.config)
@@ -3,6 +3,7 @@ import unittest
 from pybal.metrics import (
     DummyCounter,
     DummyGauge,
+    DummyHistogram,
 )
 
 
@@ -21,6 +22,10 @@ class BasicMetricsTestCase(unittest.TestCase):
             'dummy_counter': DummyCounter('dummy_counter',
                                           'A dummy counter',
                                           **metric_keywords),
+            'dummy_histogram': DummyHistogram('dummy_histogram',
+                                              'A dummy histogram',
+                                              buckets=(.1, 1),
+                                              **metric_keywords),
         }
         self.metric_labels = {
             'dummy_label': 'dummy_value',
@@ -32,3 +37,6 @@ class BasicMetricsTestCase(unittest.TestCase):
     def testCounter(self):
         self.metrics['dummy_counter'].labels(**self.metric_labels).inc()
         self.metrics['dummy_counter'].labels(**self.metric_labels).inc(2)
+
+    def testHistogram(self):
+        self.metrics['dummy_histogram'].labels(**self.metric_labels).observe(.5)
@@ -12,10 +12,11 @@ import unittest, mock
 
 # Twisted imports
 import twisted.test.proto_helpers
-from twisted.internet import task, defer
+from twisted.internet import defer
 
 # Pybal imports
 import pybal.monitor
+import pybal.scheduler
 import pybal.util
 
 # Testing imports
@@ -76,6 +77,10 @@ class BaseLoopingCheckMonitoringProtocolTestCase(BaseMonitoringProtocolTestCase)
 
     monitorClass = pybal.monitor.LoopingCheckMonitoringProtocol
 
+    def firstCheckDelay(self):
+        """Returns the delay until the first scheduled check"""
+        return self.monitor.checkCall.entry[0] - self.reactor.seconds()
+
     def testLoopingCheck(self):
         """
         Tests whether the looping call 'check' is actually invoked
@@ -84,23 +89,29 @@ class BaseLoopingCheckMonitoringProtocolTestCase(BaseMonitoringProtocolTestCase)
 
         with mock.patch.object(self.monitor, 'check') as mock_check:
             self.monitor.run()
-            self.assertIsInstance(self.monitor.checkCall, task.LoopingCall)
+            self.assertIsInstance(self.monitor.checkCall, pybal.scheduler.ScheduledCall)
             self.assertTrue(callable(self.monitor.checkCall))
             self.assertTrue(self.monitor.checkCall.running)
 
             interval = self.monitor.checkCall.interval
+            maxInterval = interval * (1 + pybal.scheduler.CheckScheduler.JITTER)
+
+            # The first check is at a phase offset within the interval
+            delay = self.firstCheckDelay()
+            self.assertGreater(delay, 0)
+            self.assertLessEqual(delay, maxInterval)
 
             mock_check.assert_not_called()
 
-            self.reactor.advance(interval / 2)
+            self.reactor.advance(delay / 2)
 
             mock_check.assert_not_called()
 
-            self.reactor.advance(interval / 2)
+            self.reactor.advance(delay / 2)
 
             mock_check.assert_called_once()
 
-            self.reactor.advance(interval)
+            self.reactor.advance(maxInterval)
 
             self.assertEqual(mock_check.call_count, 2)
 
@@ -113,24 +124,25 @@ class BaseLoopingCheckMonitoringProtocolTestCase(BaseMonitoringProtocolTestCase)
 
         with mock.patch.object(self.monitor, 'check') as mock_check:
             self.monitor.run()
-            self.assertIsInstance(self.monitor.checkCall, task.LoopingCall)
+            self.assertIsInstance(self.monitor.checkCall, pybal.scheduler.ScheduledCall)
             self.assertTrue(callable(self.monitor.checkCall))
             self.assertTrue(self.monitor.checkCall.running)
 
             interval = self.monitor.checkCall.interval
+            maxInterval = interval * (1 + pybal.scheduler.CheckScheduler.JITTER)
 
             # Make mocked f return a Deferred and wait longer than interval
             longDeferrer = defer.Deferred()
             mock_check.return_value = longDeferrer
 
-            self.reactor.advance(interval)
+            self.reactor.advance(self.firstCheckDelay())
 
             mock_check.assert_called_once()
 
             # At this point the Deferred returned by f hasn't fired yet,
-            # so LoopingCall should wait
+            # so ScheduledCall should wait
 
-            self.reactor.advance(interval)
+            self.reactor.advance(2 * maxInterval)
 
             mock_check.assert_called_once()     # not twice
 
@@ -139,7 +151,7 @@ class BaseLoopingCheckMonitoringProtocolTestCase(BaseMonitoringProtocolTestCase)
 
             mock_check.assert_called_once()     # not twice
 
-            self.reactor.advance(interval)
+            self.reactor.advance(maxInterval)
 
             self.assertEqual(mock_check.call_count, 2)
 
@@ -152,16 +164,56 @@ class BaseLoopingCheckMonitoringProtocolTestCase(BaseMonitoringProtocolTestCase)
 
             self.monitor.run()
 
-        self.assertIsInstance(self.monitor.checkCall, task.LoopingCall)
+        self.assertIsInstance(self.monitor.checkCall, pybal.scheduler.ScheduledCall)
         self.assertTrue(callable(self.monitor.checkCall))
         self.assertTrue(self.monitor.checkCall.running)
 
-        interval = self.monitor.checkCall.interval
-        self.reactor.advance(interval)
+        self.reactor.advance(self.firstCheckDelay())
 
         mocks['check'].assert_called_once()
         self.assertTrue(self.monitor.checkCall.running)
 
+    def testLoopingCheckAdmission(self):
+        """
+        Tests whether checks wait for admission by the check admission
+        controller, and release it when they finish.
+        """
+
+        admission = pybal.scheduler.CheckAdmission.forReactor(self.reactor)
+        admission.maxPerServer = 1
+        self.successResultOf(admission.acquire(self.server.host))
+
+        with mock.patch.object(self.monitor, 'check') as mock_check:
+            mock_check.return_value = defer.Deferred()
+            self.monitor.run()
+            self.reactor.advance(self.firstCheckDelay())
+
+            # Queued, not dropped
+            mock_check.assert_not_called()
+            self.assertEqual(admission.queued, 1)
+
+            admission.release(self.server.host)
+            mock_check.assert_called_once()
+            self.assertEqual(admission.inFlight, 1)
+
+            mock_check.return_value.callback(None)
+            self.assertEqual(admission.inFlight, 0)
+
+    def testStopWhileQueued(self):
+        admission = pybal.scheduler.CheckAdmission.forReactor(self.reactor)
+        admission.maxPerServer = 1
+        self.successResultOf(admission.acquire(self.server.host))
+
+        with mock.patch.object(self.monitor, 'check') as mock_check:
+            self.monitor.run()
+            self.reactor.advance(self.firstCheckDelay())
+            self.monitor.stop()
+            self.assertEqual(admission.queued, 0)
+            self.assertIsNone(self.monitor.admissionDeferred)
+
+            admission.release(self.server.host)
+            mock_check.assert_not_called()
+
 
 class MonitoringProtocolTestCase(PyBalTestCase):
     """
@@ -247,6 +299,24 @@ class MonitoringProtocolTestCase(PyBalTestCase):
         self.monitor._resultDown()
         self.assertIsNone(self.coordinator.up)
 
+    def testObserveCheckDuration(self):
+        """Test `MonitoringProtocol.observeCheckDuration`."""
+        metrics = {'check_duration_seconds': mock.Mock()}
+        with mock.patch.dict(self.monitor.metrics, metrics):
+            self.monitor.observeCheckDuration(0.25, 'successful')
+        metrics['check_duration_seconds'].labels.assert_called_once_with(
+            result='successful', **self.monitor.metric_labels)
+        metrics['check_duration_seconds'].labels().observe.assert_called_once_with(0.25)
+
+    def testObservePhaseDuration(self):
+        """Test `MonitoringProtocol.observePhaseDuration`."""
+        metrics = {'check_phase_duration_seconds': mock.Mock()}
+        with mock.patch.dict(self.monitor.metrics, metrics):
+            self.monitor.observePhaseDuration('connect', 0.01)
+        metrics['check_phase_duration_seconds'].labels.assert_called_once_with(
+            phase='connect', **self.monitor.metric_labels)
+        metrics['check_phase_duration_seconds'].labels().observe.assert_called_once_with(0.01)
+
     def testGetConfigString(self):
         """Test `MonitoringProtocol._getConfigString`."""
         self.config['testmonitor.strValue'] = 'abc'
@@ -256,6 +326,11 @@ class MonitoringProtocolTestCase(PyBalTestCase):
         with self.assertRaises(ValueError):
             self.monitor._getConfigString('badStrValue')
 
+        self.assertEquals(
+            self.monitor._getConfigString('missingStrValue', 'def'), 'def')
+        with self.assertRaises(KeyError):
+            self.monitor._getConfigString('missingStrValue')
+
     def testGetConfigInt(self):
         """Test `MonitoringProtocol._getConfigInt`."""
         self.config['testmonitor.intValue'] = 123
@@ -287,3 +362,89 @@ class MonitoringProtocolTestCase(PyBalTestCase):
         self.config['testmonitor.emptyStrListValue'] = '[]'
         with self.assertRaises(ValueError):
             self.monitor._getConfigStringList('emptyStrListValue')
+
+
+class AdaptiveIntervalTestCase(PyBalTestCase):
+    """
+    Test case for the adaptive check intervals of
+    `pybal.monitor.LoopingCheckMonitoringProtocol`.
+    """
+
+    class TestMonitor(pybal.monitor.LoopingCheckMonitoringProtocol):
+        __name__ = 'TestMonitor'
+
+        def check(self):
+            pass
+
+    def setUp(self):
+        super(AdaptiveIntervalTestCase, self).setUp()
+        self.config['testmonitor.interval'] = '10'
+        self.config['testmonitor.interval-fast'] = '2'
+        self.config['testmonitor.interval-slow'] = '60'
+        self.config['testmonitor.fast-count'] = '3'
+        self.config['testmonitor.stable-count'] = '5'
+        self.monitor = self.TestMonitor(
+            self.coordinator, self.server, self.config, reactor=self.reactor)
+        self.monitor.run()
+
+    def tearDown(self):
+        self.monitor.stop()
+
+    def testInit(self):
+        self.assertEqual(self.monitor.intvFast, 2)
+        self.assertEqual(self.monitor.intvSlow, 60)
+        self.assertEqual(self.monitor.fastCount, 3)
+        self.assertEqual(self.monitor.stableCount, 5)
+        self.assertEqual(self.monitor.checkCall.interval, 10)
+
+    def testDisabled(self):
+        del self.config['testmonitor.interval-fast']
+        del self.config['testmonitor.interval-slow']
+        monitor = self.TestMonitor(
+            self.coordinator, self.server, self.config, reactor=self.reactor)
+        monitor.run()
+        for i in range(10):
+            monitor._resultUp()
+        monitor._resultDown()
+        self.assertEqual(monitor.checkCall.interval, 10)
+        monitor.stop()
+
+    def testIntervals(self):
+        # The first result is not a change
+        self.monitor._resultUp()
+        self.assertEqual(self.monitor.checkCall.interval, 10)
+
+        # Back off after stable-count consistent results
+        for i in range(4):
+            self.monitor._resultUp()
+        self.assertEqual(self.monitor.checkCall.interval, 60)
+
+        # Speed up right after a failure...
+        self.monitor._resultDown()
+        self.assertEqual(self.monitor.checkCall.interval, 2)
+        self.monitor._resultDown()
+        self.monitor._resultDown()
+        self.assertEqual(self.monitor.checkCall.interval, 2)
+        self.monitor._resultDown()
+        self.assertEqual(self.monitor.checkCall.interval, 10)
+
+        # ...and after recovery
+        self.monitor._resultUp()
+        self.assertEqual(self.monitor.checkCall.interval, 2)
+
+    def testRescheduled(self):
+        for i in range(5):
+            self.monitor._resultUp()
+        self.assertEqual(self.monitor.checkCall.interval, 60)
+        self.monitor._resultDown()
+        # The pending check is rescheduled at the fast interval
+        delay = self.monitor.checkCall.entry[0] - self.reactor.seconds()
+        self.assertLessEqual(delay, 2 * (1 + pybal.scheduler.CheckScheduler.JITTER))
+
+    def testRateBudget(self):
+        scheduler = self.monitor.checkCall.scheduler
+        # Room for 0.25 checks/s for this monitor
+        scheduler.rateBudget = scheduler.rate - 0.1 + 0.25
+        self.monitor._resultUp()
+        self.monitor._resultDown()
+        self.assertEqual(self.monitor.checkCall.interval, 4)
@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+"""
+  PyBal unit tests
+  ~~~~~~~~~~~~~~~~
+
+  This module contains tests for `pybal.scheduler`.
+
+"""
+
+import mock
+
+from twisted.internet import defer, task
+
+from pybal.scheduler import CheckAdmission, CheckScheduler, ScheduledCall
+
+from .fixtures import PyBalTestCase
+
+
+class CheckSchedulerTestCase(PyBalTestCase):
+    """Test case for `pybal.scheduler.CheckScheduler`."""
+
+    def setUp(self):
+        super(CheckSchedulerTestCase, self).setUp()
+        self.reactor = task.Clock()
+        self.scheduler = CheckScheduler(self.reactor)
+
+    def testForReactor(self):
+        scheduler = CheckScheduler.forReactor(self.reactor)
+        self.assertIs(CheckScheduler.forReactor(self.reactor), scheduler)
+        self.assertIsNot(CheckScheduler.forReactor(task.Clock()), scheduler)
+
+    def testNextPhase(self):
+        phases = [self.scheduler.nextPhase() for i in range(100)]
+        self.assertTrue(all(0 < phase < 1 for phase in phases))
+        # Phases are spread evenly: every tenth of the range gets its share
+        for i in range(10):
+            count = len([p for p in phases if i / 10.0 <= p < (i + 1) / 10.0])
+            self.assertTrue(8 <= count <= 12)
+
+    def testJitter(self):
+        for i in range(100):
+            jitter = self.scheduler.jitter(10)
+            self.assertTrue(0 <= jitter <= CheckScheduler.JITTER * 10)
+
+    def testSingleTimer(self):
+        calls = [ScheduledCall(mock.Mock(), self.scheduler) for i in range(50)]
+        for call in calls:
+            call.start(10, now=False)
+        self.assertEqual(len(self.reactor.getDelayedCalls()), 1)
+
+        # All calls run at least once within an interval (plus jitter)
+        self.reactor.pump([0.1] * 110)
+        self.assertTrue(all(call.f.call_count >= 1 for call in calls))
+        self.assertEqual(len(self.reactor.getDelayedCalls()), 1)
+
+        for call in calls:
+            call.stop()
+        self.assertEqual(self.reactor.getDelayedCalls(), [])
+
+    def testSpread(self):
+        calls = [ScheduledCall(mock.Mock(), self.scheduler) for i in range(100)]
+        for call in calls:
+            call.start(10, now=False)
+
+        # No more than a fair share of the calls run in any one second
+        for i in range(11):
+            before = sum(call.f.call_count for call in calls)
+            self.reactor.advance(1)
+            after = sum(call.f.call_count for call in calls)
+            self.assertLessEqual(after - before, 15)
+
+
+class ScheduledCallTestCase(PyBalTestCase):
+    """Test case for `pybal.scheduler.ScheduledCall`."""
+
+    def setUp(self):
+        super(ScheduledCallTestCase, self).setUp()
+        self.reactor = task.Clock()
+        self.scheduler = CheckScheduler(self.reactor)
+        self.f = mock.Mock(return_value=None)
+        self.call = ScheduledCall(self.f, self.scheduler, 1, key='value')
+
+    def tearDown(self):
+        if self.call.running:
+            self.call.stop()
+
+    def testStartNow(self):
+        self.call.start(10, now=True)
+        self.f.assert_called_once_with(1, key='value')
+        self.assertTrue(self.call.running)
+        self.assertEqual(self.call.interval, 10)
+
+        deadline = self.call.entry[0]
+        self.assertTrue(10 <= deadline <= 10 * (1 + CheckScheduler.JITTER))
+
+    def testStartInterval(self):
+        with self.assertRaises(ValueError):
+            self.call.start(0)
+        self.assertFalse(self.call.running)
+
+    def testStartRunning(self):
+        self.call.start(10, now=False)
+        with self.assertRaises(AssertionError):
+            self.call.start(10, now=False)
+
+    def testPeriodic(self):
+        self.call.start(10, now=False)
+        first = self.call.entry[0]
+        self.assertTrue(0 < first <= 10 * (1 + CheckScheduler.JITTER))
+        self.reactor.advance(first)
+        self.assertEqual(self.f.call_count, 1)
+
+        # Subsequent runs are at whole intervals from the first slot
+        slot = self.call.slot
+        for i in range(5):
+            self.reactor.advance(self.call.entry[0] - self.reactor.seconds())
+            self.assertEqual(self.call.slot, slot + (i + 1) * 10)
+        self.assertEqual(self.f.call_count, 6)
+
+    def testStop(self):
+        d = self.call.start(10, now=False)
+        self.call.stop()
+        self.assertFalse(self.call.running)
+        self.assertIs(self.successResultOf(d), self.call)
+        self.reactor.advance(20)
+        self.f.assert_not_called()
+
+    def testStopWhileDeferred(self):
+        self.f.return_value = defer.Deferred()
+        self.call.start(10, now=True)
+        self.call.stop()
+        self.f.return_value.callback(None)
+        self.assertIsNone(self.call.entry)
+        self.reactor.advance(20)
+        self.f.assert_called_once()
+
+    def testSkipMissedSlots(self):
+        self.f.return_value = defer.Deferred()
+        self.call.start(10, now=True)
+        slot = self.call.slot
+
+        self.reactor.advance(35)
+        self.f.assert_called_once()
+        self.f.return_value.callback(None)
+
+        # The slots at 10, 20 and 30 have passed
+        self.assertEqual(self.call.slot, slot + 40)
+
+    def testFailure(self):
+        self.f.side_effect = Exception("Testing failure")
+        d = self.call.start(10, now=False)
+        self.reactor.advance(11)
+        self.failureResultOf(d, Exception)
+        self.assertFalse(self.call.running)
+        self.assertEqual(self.reactor.getDelayedCalls(), [])
+
+    def testFailingDeferred(self):
+        self.f.return_value = defer.fail(Exception("Testing failure"))
+        d = self.call.start(10, now=True)
+        self.failureResultOf(d, Exception)
+        self.assertFalse(self.call.running)
+
+    def testReset(self):
+        self.call.start(10, now=False)
+        self.call.reset()
+        self.assertTrue(10 <= self.call.entry[0] <= 10 * (1 + CheckScheduler.JITTER))
+        self.assertEqual(len(self.reactor.getDelayedCalls()), 1)
+
+    def testCall(self):
+        self.call()
+        self.f.assert_called_once_with(1, key='value')
+
+    def testSetInterval(self):
+        self.call.start(10, now=True)
+        self.assertAlmostEqual(self.scheduler.rate, 0.1)
+        self.reactor.advance(1)
+        self.call.setInterval(2)
+        self.assertAlmostEqual(self.scheduler.rate, 0.5)
+        # Rescheduled at the new interval from the previous run
+        self.assertTrue(2 <= self.call.entry[0] <= 2 * (1 + CheckScheduler.JITTER))
+
+        with self.assertRaises(ValueError):
+            self.call.setInterval(0)
+
+        self.call.stop()
+        self.assertAlmostEqual(self.scheduler.rate, 0)
+
+    def testSetIntervalDuringRun(self):
+        self.f.return_value = defer.Deferred()
+        self.call.start(10, now=True)
+        self.call.setInterval(5)
+        self.assertIsNone(self.call.entry)
+        self.f.return_value.callback(None)
+        self.assertTrue(5 <= self.call.entry[0] <= 5 * (1 + CheckScheduler.JITTER))
+
+    def testGrantInterval(self):
+        self.call.start(10, now=False)
+        other = ScheduledCall(mock.Mock(), self.scheduler)
+        other.start(1, now=False)
+        self.assertAlmostEqual(self.scheduler.rate, 1.1)
+
+        # Unlimited
+        self.assertEqual(self.scheduler.grantInterval(self.call, 2), 2)
+
+        self.scheduler.rateBudget = 1.5
+        self.assertAlmostEqual(self.scheduler.grantInterval(self.call, 1), 2)
+        self.assertEqual(self.scheduler.grantInterval(self.call, 5), 5)
+        # Slowing down is always granted
+        self.assertEqual(self.scheduler.grantInterval(self.call, 20), 20)
+
+        # No room to speed up
+        self.scheduler.rateBudget = 1.0
+        self.assertEqual(self.scheduler.grantInterval(self.call, 1), 10)
+        other.stop()
+
+
+class CheckAdmissionTestCase(PyBalTestCase):
+    """Test case for `pybal.scheduler.CheckAdmission`."""
+
+    def setUp(self):
+        super(CheckAdmissionTestCase, self).setUp()
+        self.reactor = task.Clock()
+        self.admission = CheckAdmission(self.reactor, maxInFlight=3,
+                                        maxPerServer=2)
+
+    def testForReactor(self):
+        admission = CheckAdmission.forReactor(self.reactor)
+        self.assertIs(CheckAdmission.forReactor(self.reactor), admission)
+        self.assertIsNone(admission.maxInFlight)
+        self.assertIsNone(admission.maxPerServer)
+
+    def testUnlimited(self):
+        admission = CheckAdmission(self.reactor)
+        for i in range(100):
+            self.successResultOf(admission.acquire('host1'))
+        self.assertEqual(admission.inFlight, 100)
+
+    def testPerServerLimit(self):
+        self.successResultOf(self.admission.acquire('host1'))
+        self.successResultOf(self.admission.acquire('host1'))
+        d = self.admission.acquire('host1')
+        self.assertNoResult(d)
+        # Other servers are not held up
+        self.successResultOf(self.admission.acquire('host2'))
+
+        self.reactor.advance(2)
+        self.admission.release('host1')
+        self.successResultOf(d)
+        self.assertEqual(self.admission.inFlightPerServer['host1'], 2)
+        self.assertEqual(self.admission.queued, 0)
+
+    def testGlobalLimit(self):
+        for host in ('host1', 'host2', 'host3'):
+            self.successResultOf(self.admission.acquire(host))
+        d1 = self.admission.acquire('host4')
+        d2 = self.admission.acquire('host5')
+        self.assertNoResult(d1)
+        self.assertNoResult(d2)
+        self.assertEqual(self.admission.queued, 2)
+
+        # Queued checks are admitted in FIFO order
+        self.admission.release('host1')
+        self.successResultOf(d1)
+        self.assertNoResult(d2)
+        self.admission.release('host4')
+        self.successResultOf(d2)
+        self.assertEqual(self.admission.inFlight, 3)
+
+    def testSkipBlockedServer(self):
+        self.successResultOf(self.admission.acquire('host1'))
+        self.successResultOf(self.admission.acquire('host1'))
+        self.successResultOf(self.admission.acquire('host2'))
+        d1 = self.admission.acquire('host1')
+        d2 = self.admission.acquire('host3')
+
+        # host1 is at its limit, so host3 gets the free slot
+        self.admission.release('host2')
+        self.assertNoResult(d1)
+        self.successResultOf(d2)
+
+    def testServersTakeTurns(self):
+        admission = CheckAdmission(self.reactor, maxInFlight=1)
+        self.successResultOf(admission.acquire('host0'))
+        d1 = admission.acquire('host1')
+        d2 = admission.acquire('host1')
+        d3 = admission.acquire('host2')
+
+        admission.release('host0')
+        self.successResultOf(d1)
+        admission.release('host1')
+        self.successResultOf(d3)
+        self.assertNoResult(d2)
+        admission.release('host2')
+        self.successResultOf(d2)
+        self.assertEqual(admission.queued, 0)
+
+    def testBlockedServerWaits(self):
+        self.successResultOf(self.admission.acquire('host1'))
+        self.successResultOf(self.admission.acquire('host1'))
+        blocked = [self.admission.acquire('host1') for i in range(1000)]
+        self.successResultOf(self.admission.acquire('host2'))
+        d = self.admission.acquire('host3')
+
+        # host1 doesn't get a turn until one of its checks finishes
+        self.assertEqual(len(self.admission.blockedQueues['host1']), 1000)
+        self.assertNotIn('host1', self.admission.queues)
+        self.admission.release('host2')
+        self.successResultOf(d)
+
+        self.admission.release('host1')
+        self.successResultOf(blocked[0])
+        self.assertNoResult(blocked[1])
+        self.assertEqual(self.admission.queued, 999)
+
+    def testCancel(self):
+        for host in ('host1', 'host2', 'host3'):
+            self.successResultOf(self.admission.acquire(host))
+        d = self.admission.acquire('host4')
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEqual(self.admission.queued, 0)
+        self.admission.release('host1')
+        self.assertEqual(self.admission.inFlight, 2)
+
+    def testSynchronousRelease(self):
+        for host in ('host1', 'host2', 'host3'):
+            self.successResultOf(self.admission.acquire(host))
+        d1 = self.admission.acquire('host4')
+        d2 = self.admission.acquire('host5')
+        # A check that finishes as soon as it is admitted
+        d1.addCallback(lambda _: self.admission.release('host4'))
+        self.admission.release('host1')
+        self.successResultOf(d2)
+        self.assertEqual(self.admission.inFlight, 3)
+        self.assertEqual(self.admission.queued, 0)
+
+    def testMetrics(self):
+        with mock.patch.dict(CheckAdmission.metrics,
+                             {'in_flight': mock.Mock(),
+                              'queue_depth': mock.Mock(),
+                              'queue_wait_seconds': mock.Mock()}):
+            metrics = CheckAdmission.metrics
+            for host in ('host1', 'host2', 'host3'):
+                self.admission.acquire(host)
+            d = self.admission.acquire('host4')
+            metrics['queue_depth'].set.assert_called_with(1)
+            self.reactor.advance(5)
+            self.admission.release('host1')
+            self.successResultOf(d)
+            metrics['queue_wait_seconds'].observe.assert_called_once_with(5)
+            metrics['queue_depth'].set.assert_called_with(0)
+            metrics['in_flight'].set.assert_called_with(3)
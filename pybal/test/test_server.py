@@ -178,6 +178,85 @@ class ServerTestCase(PyBalTestCase):
         self.assertFalse(self.server.calcStatus())
         self.assertTrue(self.server.calcPartialStatus())
 
+    def _addMonitors(self, *states):
+        self.server.removeMonitors()
+        monitors = []
+        for i, up in enumerate(states):
+            m = mock.MagicMock()
+            m.up = up
+            m.name.return_value = "Monitor%d" % i
+            self.server.addMonitor(m)
+            monitors.append(m)
+        return monitors
+
+    def testCalcStatusAny(self):
+        self.server.aggregation = 'any'
+        self._addMonitors(False, True, False)
+        self.assertTrue(self.server.calcStatus())
+        self._addMonitors(False, False)
+        self.assertFalse(self.server.calcStatus())
+
+    def testCalcStatusQuorum(self):
+        self.server.aggregation = 'quorum'
+        self.server.quorum = 2
+        monitors = self._addMonitors(True, True, False)
+        self.assertTrue(self.server.calcStatus())
+        monitors[1].up = False
+        self.assertFalse(self.server.calcStatus())
+
+        # A quorum larger than the number of monitors requires all of them
+        self.server.quorum = 5
+        self._addMonitors(True, True)
+        self.assertTrue(self.server.calcStatus())
+
+    def testCalcStatusWeighted(self):
+        self.server.aggregation = 'weighted'
+        self.server.monitorWeights = {'Monitor0': 3}
+        self.server.scoreThreshold = 0.6
+        monitors = self._addMonitors(True, False, False)
+        self.assertTrue(self.server.calcStatus())   # 3/5
+        monitors[0].up = False
+        monitors[1].up = monitors[2].up = True
+        self.assertFalse(self.server.calcStatus())  # 2/5
+
+    def testCalcStatusNoMonitors(self):
+        for policy in pybal.server.Server.AGGREGATION_POLICIES:
+            self.server.aggregation = policy
+            self.server.removeMonitors()
+            self.assertFalse(self.server.calcStatus())
+
+    def testParseAggregationConfig(self):
+        self.assertTrue(self.server._parseAggregationConfig(self.lvsservice))
+        self.assertEquals(self.server.aggregation, 'all')
+
+        self.config['monitor-aggregation'] = "weighted"
+        self.config['monitor-weights'] = "{'ProxyFetch': 2}"
+        self.config['monitor-score-threshold'] = "0.5"
+        self.assertTrue(self.server._parseAggregationConfig(self.lvsservice))
+        self.assertEquals(self.server.aggregation, 'weighted')
+        self.assertEquals(self.server.monitorWeights, {'ProxyFetch': 2})
+        self.assertEquals(self.server.scoreThreshold, 0.5)
+
+        self.config['monitor-aggregation'] = "quorum"
+        self.config['monitor-quorum'] = "2"
+        self.assertTrue(self.server._parseAggregationConfig(self.lvsservice))
+        self.assertEquals(self.server.quorum, 2)
+
+    @mock.patch('twisted.internet.reactor.stop')
+    def testInvalidAggregationConfig(self, mock_reactor):
+        self.config['monitor-aggregation'] = "majority"
+        self.assertFalse(self.server._parseAggregationConfig(self.lvsservice))
+
+        self.config['monitor-aggregation'] = "weighted"
+        self.config['monitor-weights'] = "[1, 2]"
+        self.assertFalse(self.server._parseAggregationConfig(self.lvsservice))
+
+        self.config['monitors'] = "[ \"Mock\" ]"
+        self.server.removeMonitors()
+        self.server.createMonitoringInstances(self.mockCoordinator)
+        self.assertFalse(self.server.monitors)
+        mock_reactor.assert_called()
+
     def testTextStatus(self):
         textStatus = self.server.textStatus()
         self.assertTrue(isinstance(textStatus, str))
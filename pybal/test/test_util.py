@@ -37,6 +37,26 @@ class MiscUtilTestCase(PyBalTestCase):
         subclasses.sort(key=lambda cls: cls.__name__)
         self.assertEqual(subclasses, [DummyChild, DummyGrandChild])
 
+    def testPerReactor(self):
+        """Test case for `pybal.util.PerReactor`."""
+
+        class DummyEngine(pybal.util.PerReactor):
+            def __init__(self, reactor):
+                self.reactor = reactor
+
+        class DummyOtherEngine(DummyEngine):
+            pass
+
+        reactor, otherReactor = mock.Mock(), mock.Mock()
+        engine = DummyEngine.forReactor(reactor)
+        self.assertIs(engine.reactor, reactor)
+        self.assertIs(DummyEngine.forReactor(reactor), engine)
+        self.assertIsNot(DummyEngine.forReactor(otherReactor), engine)
+        # Subclasses don't share their parent's instances
+        other = DummyOtherEngine.forReactor(reactor)
+        self.assertIsInstance(other, DummyOtherEngine)
+        self.assertIsNot(other, engine)
+
 
 class ConfigDictTestCase(PyBalTestCase):
     """Test case for `pybal.util.ConfigDict`."""
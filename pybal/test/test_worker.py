@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+"""
+  PyBal unit tests
+  ~~~~~~~~~~~~~~~~
+
+  This module contains tests for `pybal.worker`.
+
+"""
+
+import json
+
+import mock
+
+from twisted.internet import defer, error, protocol, reactor
+from twisted.python import failure
+from twisted.test import proto_helpers
+
+import pybal.util
+from pybal.monitors.tcpconnect import TCPConnectMonitoringProtocol
+from pybal.worker import (MonitorWorkerPool, RemoteMonitor,
+                          WorkerControlProtocol, WorkerProcessProtocol, _encode)
+
+from .fixtures import PyBalTestCase, ServerStub
+
+
+class MonitorWorkerPoolTestCase(PyBalTestCase):
+    """Test case for `pybal.worker.MonitorWorkerPool`."""
+
+    def setUp(self):
+        super(MonitorWorkerPoolTestCase, self).setUp()
+        self.reactor.spawnProcess = mock.Mock(side_effect=self.spawnProcess)
+        self.pool = MonitorWorkerPool(self.reactor, workers=2)
+        self.config['tcpconnect.timeout'] = '1'
+
+    def spawnProcess(self, processProtocol, executable, args, **kwargs):
+        processProtocol.makeConnection(mock.Mock())
+
+    def remoteMonitor(self, host='localhost'):
+        server = ServerStub(host, '127.0.0.1', 80, lvsservice=self.lvsservice)
+        monitor = RemoteMonitor(self.coordinator, server, self.config,
+                                'TCPConnect', reactor=self.reactor)
+        monitor.pool = self.pool
+        return monitor
+
+    def messages(self, worker):
+        """Returns the messages sent to a worker"""
+        return [json.loads(call[0][0])
+                for call in worker.transport.write.call_args_list]
+
+    def testForReactor(self):
+        pool = MonitorWorkerPool.forReactor(self.reactor)
+        self.assertIs(MonitorWorkerPool.forReactor(self.reactor), pool)
+        self.assertEqual(pool.workers, 0)
+
+    def testStartMonitor(self):
+        self.pool.configuration = {'max-checks-in-flight': '10'}
+        monitor = self.remoteMonitor()
+        monitor.run()
+        self.assertTrue(monitor.active)
+        # All workers are started
+        self.assertEqual(self.reactor.spawnProcess.call_count, 2)
+        args = self.reactor.spawnProcess.call_args[0][2]
+        self.assertEqual(args[1:], ['-c', 'from pybal.worker import main; main()'])
+
+        worker = self.pool.processes[0]
+        self.assertIs(monitor.worker, worker)
+        configure, start = self.messages(worker)
+        # Each worker gets its share of the global limits
+        self.assertEqual(configure, {'op': 'configure',
+                                     'configuration': {'max-checks-in-flight': '5'}})
+        self.assertEqual(start['op'], 'start')
+        self.assertEqual(start['id'], monitor.monitorID)
+        self.assertEqual(start['monitor'], 'TCPConnect')
+        self.assertEqual(start['server'], {'host': 'localhost', 'ip': '127.0.0.1',
+                                           'port': 80, 'weight': None,
+                                           'ip4_addresses': ['127.0.0.1'],
+                                           'ip6_addresses': []})
+        self.assertEqual(start['service']['name'], self.lvsservice.name)
+        self.assertEqual(start['configuration'], {'tcpconnect.timeout': '1'})
+
+        monitor.stop()
+        self.assertEqual(self.messages(worker)[-1],
+                         {'op': 'stop', 'id': monitor.monitorID})
+        self.assertEqual(worker.monitors, set())
+        self.assertEqual(self.pool.monitors, {})
+
+    def testSharding(self):
+        monitors = [self.remoteMonitor('host%d' % i) for i in range(4)]
+        for monitor in monitors:
+            monitor.run()
+        self.assertEqual([len(w.monitors) for w in self.pool.processes.values()],
+                         [2, 2])
+        self.assertEqual(self.reactor.spawnProcess.call_count, 2)
+
+    def testWorkerConfiguration(self):
+        self.pool.configuration = {'check-rate-budget': '100',
+                                   'max-checks-in-flight': '3',
+                                   'max-checks-per-server': '4',
+                                   'runcommand-max-children': '0',
+                                   'debug': True}
+        self.assertEqual(self.pool._workerConfiguration(),
+                         {'check-rate-budget': '50.0',
+                          'max-checks-in-flight': '1',
+                          'max-checks-per-server': '4',
+                          'runcommand-max-children': '0',
+                          'debug': True})
+
+    def testServerAffinity(self):
+        monitors = [self.remoteMonitor('host%d' % (i % 2)) for i in range(4)]
+        for monitor in monitors:
+            monitor.run()
+        # All monitors of a server run in the same worker
+        self.assertIs(monitors[0].worker, monitors[2].worker)
+        self.assertIs(monitors[1].worker, monitors[3].worker)
+        self.assertIsNot(monitors[0].worker, monitors[1].worker)
+
+        # ...also after a restart
+        worker = monitors[0].worker
+        worker.processEnded(failure.Failure(error.ProcessTerminated(exitCode=1)))
+        self.reactor.advance(MonitorWorkerPool.RESTART_DELAY)
+        self.assertIsNot(monitors[0].worker, worker)
+        self.assertIs(monitors[0].worker, monitors[2].worker)
+
+        for monitor in monitors:
+            monitor.stop()
+        self.assertEqual(self.pool.servers, {})
+
+    def testTransition(self):
+        monitor = self.remoteMonitor()
+        monitor.run()
+        worker = monitor.worker
+
+        worker.outReceived('{"id": %d, "up": true}\n{"id": %d, "up": false, '
+                           % (monitor.monitorID, monitor.monitorID))
+        self.assertTrue(monitor.up)
+        self.assertTrue(self.coordinator.up)
+
+        # The rest of the line arrives later
+        worker.outReceived('"reason": "Connection refused"}\n')
+        self.assertFalse(monitor.up)
+        self.assertFalse(self.coordinator.up)
+        self.assertEqual(self.coordinator.reason, "Connection refused")
+
+    def testInvalidMessages(self):
+        monitor = self.remoteMonitor()
+        monitor.run()
+        worker = monitor.worker
+        worker.outReceived('not json\n[]\n{"id": 12345, "up": true}\n')
+        self.assertIsNone(monitor.up)
+
+        worker.outReceived('x' * (WorkerProcessProtocol.MAX_LINE_LENGTH + 1))
+        self.assertEqual(worker.buffer, '')
+
+    def testStoppedMonitor(self):
+        monitor = self.remoteMonitor()
+        monitor.run()
+        worker = monitor.worker
+        monitor.stop()
+        self.pool.messageReceived(worker, {'id': monitor.monitorID, 'up': True})
+        self.assertIsNone(monitor.up)
+
+    def testWorkerRestart(self):
+        monitor = self.remoteMonitor()
+        monitor.run()
+        monitor.transition(True)
+        worker = monitor.worker
+
+        worker.processEnded(failure.Failure(error.ProcessTerminated(exitCode=1)))
+        self.assertNotIn(worker, self.pool.processes.values())
+        # The last reported state is kept until the monitor has restarted
+        self.assertTrue(monitor.up)
+        self.assertIs(monitor.worker, worker)
+
+        self.reactor.advance(MonitorWorkerPool.RESTART_DELAY)
+        self.assertEqual(self.reactor.spawnProcess.call_count, 3)
+        self.assertIsNot(monitor.worker, worker)
+        self.assertEqual(self.messages(monitor.worker)[-1]['id'], monitor.monitorID)
+
+        # Reports of the old worker are ignored
+        self.pool.messageReceived(worker, {'id': monitor.monitorID, 'up': False})
+        self.assertTrue(monitor.up)
+
+    def testStop(self):
+        monitor = self.remoteMonitor()
+        monitor.run()
+        workers = self.pool.processes.values()
+        self.pool.stop()
+        for worker in workers:
+            worker.transport.closeStdin.assert_called_once()
+            worker.processEnded(failure.Failure(error.ProcessDone(0)))
+        self.assertEqual(self.pool.processes, {})
+        # No restarts while stopping
+        self.reactor.advance(MonitorWorkerPool.RESTART_DELAY)
+        self.assertEqual(self.reactor.spawnProcess.call_count, 2)
+
+
+class WorkerControlProtocolTestCase(PyBalTestCase):
+    """Test case for `pybal.worker.WorkerControlProtocol`."""
+
+    def setUp(self):
+        super(WorkerControlProtocolTestCase, self).setUp()
+        self.reactor.stop = mock.Mock()
+        self.protocol = WorkerControlProtocol(self.reactor)
+        self.transport = proto_helpers.StringTransport()
+        self.protocol.makeConnection(self.transport)
+
+    def send(self, message):
+        self.protocol.dataReceived(json.dumps(message) + '\n')
+
+    def sent(self):
+        return [json.loads(line) for line in self.transport.value().splitlines()]
+
+    def start(self, monitorName='TCPConnect', configuration=None):
+        if configuration is None:
+            configuration = {'tcpconnect.timeout': '0.5'}
+        self.send({'op': 'start', 'id': 7, 'monitor': monitorName,
+                   'service': {'name': 'test', 'protocol': 'tcp',
+                               'ip': '192.0.2.1', 'port': 80},
+                   'server': {'host': 'localhost', 'ip': '127.0.0.1',
+                              'port': 80, 'weight': 10,
+                              'ip4_addresses': ['127.0.0.1'],
+                              'ip6_addresses': ['::1']},
+                   'configuration': configuration})
+
+    def testStart(self):
+        with mock.patch.object(TCPConnectMonitoringProtocol, 'run') as mock_run:
+            self.start()
+        monitor = self.protocol.monitors[7]
+        self.assertIsInstance(monitor, TCPConnectMonitoringProtocol)
+        mock_run.assert_called_once()
+        self.assertIs(monitor.coordinator, self.protocol)
+        self.assertEqual(monitor.server.lvsservice.name, 'test')
+        # Configuration values are str, as in the main process
+        self.assertEqual(monitor.toConnect, 0.5)
+        self.assertIsInstance(monitor.configuration, pybal.util.ConfigDict)
+        self.assertIsInstance(monitor.server.host, str)
+
+    def testResults(self):
+        with mock.patch.object(TCPConnectMonitoringProtocol, 'run'):
+            self.start()
+        monitor = self.protocol.monitors[7]
+        self.protocol.resultUp(monitor)
+        self.protocol.resultDown(monitor, "Connection refused")
+        self.assertEqual(self.sent(), [
+            {'id': 7, 'up': True},
+            {'id': 7, 'up': False, 'reason': "Connection refused"}])
+
+    def testStartDNSQuery(self):
+        self.start('DNSQuery', {'dnsquery.hostnames': '["example.com"]'})
+        monitor = self.protocol.monitors[7]
+        self.assertEqual(monitor.server.ip4_addresses, {'127.0.0.1'})
+        self.assertEqual(monitor.server.ip6_addresses, {'::1'})
+        self.assertEqual(monitor.resolver.servers, [('127.0.0.1', 53)])
+        self.assertEqual(self.sent(), [])
+        monitor.stop()
+
+    def testStartFailure(self):
+        with mock.patch.object(TCPConnectMonitoringProtocol, 'run',
+                               side_effect=RuntimeError("failed")):
+            self.start()
+        # The worker keeps running, and reports the monitor down
+        self.assertEqual(self.protocol.monitors, {})
+        self.assertEqual(self.sent(), [
+            {'id': 7, 'up': False, 'reason': "Could not start monitor in worker"}])
+        self.assertFalse(self.transport.disconnecting)
+        self.flushLoggedErrors(RuntimeError)
+
+    def testStartUnknownMonitor(self):
+        self.start('DoesNotExist')
+        self.assertEqual(self.protocol.monitors, {})
+        self.assertEqual(self.sent(), [
+            {'id': 7, 'up': False, 'reason': "Could not start monitor in worker"}])
+        self.flushLoggedErrors(ImportError)
+
+    def testStop(self):
+        self.start()
+        monitor = self.protocol.monitors[7]
+        self.assertTrue(monitor.active)
+        self.send({'op': 'stop', 'id': 7})
+        self.assertFalse(monitor.active)
+        self.assertEqual(self.protocol.monitors, {})
+
+    def testConfigure(self):
+        with mock.patch('pybal.main.configureChecks') as mock_configure:
+            self.send({'op': 'configure',
+                       'configuration': {'max-checks-in-flight': '10'}})
+        configuration, configuredReactor = mock_configure.call_args[0]
+        self.assertEqual(configuration, {'max-checks-in-flight': '10'})
+        self.assertIs(configuredReactor, self.reactor)
+
+    def testInvalidMessage(self):
+        self.protocol.dataReceived('not json\n{"op": "unknown"}\n')
+        self.assertEqual(self.transport.value(), '')
+
+    def testConnectionLost(self):
+        self.start()
+        monitor = self.protocol.monitors[7]
+        self.protocol.connectionLost(failure.Failure(error.ConnectionDone()))
+        self.assertFalse(monitor.active)
+        self.reactor.stop.assert_called_once()
+
+    def testEncode(self):
+        self.assertEqual(_encode({u'a': [u'b', 1, None]}), {'a': ['b', 1, None]})
+        self.assertIsInstance(_encode({u'a': u'b'}).keys()[0], str)
+
+
+class MonitorWorkerProcessTestCase(PyBalTestCase):
+    """Runs a monitor in a real worker process."""
+
+    timeout = 30
+
+    def setUp(self):
+        super(MonitorWorkerProcessTestCase, self).setUp()
+        self.pool = MonitorWorkerPool(reactor, workers=1)
+        self.port = reactor.listenTCP(
+            0, protocol.Factory.forProtocol(protocol.Protocol), interface='127.0.0.1')
+        self.addCleanup(self.port.stopListening)
+
+    def testRemoteCheck(self):
+        d = defer.Deferred()
+        self.coordinator.resultUp = lambda monitor: d.callback(monitor)
+        self.coordinator.resultDown = lambda monitor, reason=None: d.errback(
+            Exception(reason))
+
+        server = ServerStub('localhost', '127.0.0.1', self.port.getHost().port,
+                            lvsservice=self.lvsservice)
+        self.config['tcpconnect.interval'] = '1'
+        monitor = RemoteMonitor(self.coordinator, server, self.config,
+                                'TCPConnect', reactor=reactor)
+        monitor.pool = self.pool
+        monitor.run()
+
+        def stop(result):
+            monitor.stop()
+            ended = defer.Deferred()
+            worker = self.pool.processes[0]
+            worker.processEnded = lambda reason: ended.callback(None)
+            self.pool.stop()
+            return ended.addCallback(lambda _: result)
+
+        d.addBoth(stop)
+        return d.addCallback(self.assertIs, monitor)
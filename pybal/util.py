@@ -10,6 +10,7 @@ from twisted.python import log as tw_log
 from twisted.python import util
 import inspect
 import logging
+import weakref
 
 
 def get_subclasses(cls):
@@ -21,6 +22,28 @@ def get_subclasses(cls):
     return subclasses
 
 
+class PerReactor(object):
+    """
+    Mixin for classes of which a single instance is shared per reactor.
+    The instance is created by forReactor() on first use, with the
+    reactor as the only constructor argument.
+    """
+
+    @classmethod
+    def forReactor(cls, reactor):
+        """Returns the instance for a reactor, creating it if needed"""
+
+        # By reactor, for this class only
+        instances = cls.__dict__.get('_instances')
+        if instances is None:
+            instances = cls._instances = weakref.WeakKeyDictionary()
+        try:
+            return instances[reactor]
+        except KeyError:
+            instance = instances[reactor] = cls(reactor)
+            return instance
+
+
 class ConfigDict(dict):
 
     def getint(self, key, default=None):
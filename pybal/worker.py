@@ -0,0 +1,451 @@
+"""
+worker.py
+
+Monitor worker processes for PyBal
+
+With monitor-workers set, monitors are not run in the main PyBal
+process, but sharded over that many worker processes, each with its own
+reactor. The main process keeps a RemoteMonitor in place of every
+monitor, so the Coordinators, IPVS and BGP are unaware of where the
+checks run. All monitors of a server run in the same worker, and the
+global check limits are divided over the workers.
+
+The main process and a worker communicate over the worker's stdin and
+stdout, with one JSON object per line. The main process sends:
+
+    {"op": "configure", "configuration": {...}}
+    {"op": "start", "id": 1, "monitor": "ProxyFetch", "service": {...},
+     "server": {...}, "configuration": {...}}
+    {"op": "stop", "id": 1}
+
+and the worker reports monitor state transitions only:
+
+    {"id": 1, "up": true}
+    {"id": 1, "up": false, "reason": "..."}
+"""
+
+# Python imports
+import importlib, itertools, json, logging, os, sys
+
+# Twisted imports
+from twisted.internet import error, protocol
+from twisted.protocols import basic
+
+# Pybal imports
+from pybal import monitor, util
+from pybal.metrics import Counter, Gauge
+
+log = util.log
+
+
+class WorkerProcessProtocol(protocol.ProcessProtocol):
+    """
+    The main process side of the connection to a worker process
+    """
+
+    MAX_LINE_LENGTH = 65536
+
+    def __init__(self, pool, index):
+        self.pool = pool
+        self.index = index
+        # IDs of the monitors running in the worker
+        self.monitors = set()
+        self.buffer = ''
+        self.ended = False
+
+    def sendMessage(self, message):
+        """Sends a message (dict) to the worker"""
+
+        if not self.ended:
+            self.transport.write(json.dumps(message) + '\n')
+
+    def outReceived(self, data):
+        self.buffer += data
+        while '\n' in self.buffer:
+            line, self.buffer = self.buffer.split('\n', 1)
+            try:
+                message = json.loads(line)
+            except ValueError:
+                log.warn("Invalid message from monitor worker {}: {!r}".format(
+                    self.index, line[:80]))
+                continue
+            self.pool.messageReceived(self, message)
+        if len(self.buffer) > self.MAX_LINE_LENGTH:
+            log.warn("Discarding overlong message from monitor worker {}".format(
+                self.index))
+            self.buffer = ''
+
+    def processEnded(self, reason):
+        self.ended = True
+        self.pool.workerEnded(self, reason)
+
+
+class MonitorWorkerPool(util.PerReactor):
+    """
+    Runs monitors in a number of worker processes, and passes their
+    state transitions back to the RemoteMonitors in the main process.
+    Workers are started when the first monitor is assigned to them, and
+    restarted with their monitors after they exit unexpectedly.
+    """
+
+    # Delay before restarting a worker that exited
+    RESTART_DELAY = 1.0
+
+    # Global check limits, which are divided over the workers
+    SHARED_LIMITS = ('check-rate-budget', 'max-checks-in-flight',
+                     'runcommand-max-children')
+
+    metric_keywords = {
+        'namespace': 'pybal',
+        'subsystem': 'monitor_worker'
+    }
+
+    metrics = {
+        'processes': Gauge('processes', 'Running monitor worker processes',
+                           **metric_keywords),
+        'monitors': Gauge('monitors', 'Monitors running in a monitor worker',
+                          labelnames=('worker',), **metric_keywords),
+        'restarts_total': Counter('restarts_total', 'Monitor worker restarts',
+                                  **metric_keywords)
+    }
+
+    def __init__(self, reactor, workers=0):
+        self.reactor = reactor
+        # Number of worker processes, 0 to run monitors in-process
+        self.workers = workers
+        # Global configuration, passed on to the workers
+        self.configuration = {}
+
+        self.processes = {}
+        self.monitors = {}
+        # [worker index, monitor count] by server host, so all monitors
+        # of a server run in the same worker, which applies the
+        # per-server check limits
+        self.servers = {}
+        self.ids = itertools.count(1)
+        self.stopping = False
+        self._shutdownTriggerID = None
+
+    def startMonitor(self, monitor):
+        """Starts running a RemoteMonitor in a worker process"""
+
+        monitor.monitorID = next(self.ids)
+        self.monitors[monitor.monitorID] = monitor
+        worker = self._pickWorker(monitor.server.host)
+        self.servers.setdefault(monitor.server.host, [worker.index, 0])[1] += 1
+        self._assign(monitor, worker)
+
+    def stopMonitor(self, monitor):
+        """Stops running a RemoteMonitor"""
+
+        if self.monitors.pop(monitor.monitorID, None) is None:
+            return
+        server = self.servers[monitor.server.host]
+        server[1] -= 1
+        if not server[1]:
+            del self.servers[monitor.server.host]
+        worker = monitor.worker
+        monitor.worker = None
+        if worker is not None:
+            worker.monitors.discard(monitor.monitorID)
+            worker.sendMessage({'op': 'stop', 'id': monitor.monitorID})
+            self._updateMetrics(worker)
+
+    def messageReceived(self, worker, message):
+        """Called when a worker has reported a monitor state transition"""
+
+        try:
+            monitor = self.monitors[message['id']]
+            up = message['up']
+        except (KeyError, TypeError):
+            return
+        if monitor.worker is not worker:
+            # Stopped in the meantime
+            return
+        monitor.transition(up, message.get('reason'))
+
+    def workerEnded(self, worker, reason):
+        """Called when a worker process has exited"""
+
+        if self.processes.get(worker.index) is worker:
+            del self.processes[worker.index]
+        self.metrics['processes'].set(len(self.processes))
+        if self.stopping:
+            return
+
+        log.error("Monitor worker {} exited: {}".format(
+            worker.index, reason.getErrorMessage()))
+        self.metrics['restarts_total'].inc()
+        # Keep the last reported state of the monitors until they have
+        # been restarted
+        self.reactor.callLater(self.RESTART_DELAY, self._restartMonitors,
+                               worker)
+
+    def stop(self):
+        """Stops all worker processes"""
+
+        self.stopping = True
+        for worker in self.processes.values():
+            # Workers exit when their stdin is closed
+            worker.transport.closeStdin()
+
+    def _restartMonitors(self, worker):
+        for monitorID in worker.monitors:
+            monitor = self.monitors.get(monitorID)
+            if monitor is not None and monitor.worker is worker:
+                self._assign(monitor, self._pickWorker(monitor.server.host))
+
+    def _assign(self, monitor, worker):
+        monitor.worker = worker
+        worker.monitors.add(monitor.monitorID)
+        server = monitor.server
+        lvsservice = server.lvsservice
+        worker.sendMessage({
+            'op': 'start',
+            'id': monitor.monitorID,
+            'monitor': monitor.name(),
+            'service': {'name': lvsservice.name, 'protocol': lvsservice.protocol,
+                        'ip': lvsservice.ip, 'port': lvsservice.port},
+            'server': {'host': server.host, 'ip': server.ip,
+                       'port': server.port, 'weight': server.weight,
+                       'ip4_addresses': sorted(server.ip4_addresses),
+                       'ip6_addresses': sorted(server.ip6_addresses)},
+            'configuration': dict(monitor.configuration)
+        })
+        self._updateMetrics(worker)
+
+    def _pickWorker(self, host):
+        """
+        Returns the worker running the monitors of server host, or the
+        worker running the fewest monitors for a new server
+        """
+
+        for index in range(self.workers):
+            if index not in self.processes:
+                self._spawn(index)
+        if host in self.servers:
+            return self.processes[self.servers[host][0]]
+        return min(self.processes.itervalues(),
+                   key=lambda worker: (len(worker.monitors), worker.index))
+
+    def _workerConfiguration(self):
+        """
+        Returns the global configuration for a worker, with its share of
+        the global check limits
+        """
+
+        configuration = dict(self.configuration)
+        for key in self.SHARED_LIMITS:
+            try:
+                limit = float(configuration[key])
+            except (KeyError, ValueError):
+                continue
+            if limit <= 0:
+                continue
+            if key == 'check-rate-budget':
+                configuration[key] = str(limit / self.workers)
+            else:
+                # At least one, so every worker can run checks
+                configuration[key] = str(max(1, int(limit) // self.workers))
+        return configuration
+
+    def _spawn(self, index):
+        if self._shutdownTriggerID is None:
+            self._shutdownTriggerID = self.reactor.addSystemEventTrigger(
+                'before', 'shutdown', self.stop)
+
+        worker = WorkerProcessProtocol(self, index)
+        self.reactor.spawnProcess(
+            worker, sys.executable,
+            [sys.executable, '-c', 'from pybal.worker import main; main()'],
+            env=os.environ,
+            childFDs={0: 'w', 1: 'r', 2: 2})
+        self.processes[index] = worker
+        worker.sendMessage({'op': 'configure',
+                            'configuration': self._workerConfiguration()})
+        self.metrics['processes'].set(len(self.processes))
+        return worker
+
+    def _updateMetrics(self, worker):
+        self.metrics['monitors'].labels(worker=str(worker.index)).set(
+            len(worker.monitors))
+
+
+class RemoteMonitor(monitor.MonitoringProtocol):
+    """
+    Stands in for a monitor that runs in a worker process, and applies
+    the state transitions it reports
+    """
+
+    def __init__(self, coordinator, server, configuration, monitorName, reactor=None):
+        self.__name__ = monitorName
+
+        # Call ancestor constructor
+        super(RemoteMonitor, self).__init__(
+            coordinator,
+            server,
+            configuration,
+            reactor=reactor)
+
+        self.pool = MonitorWorkerPool.forReactor(self.reactor)
+        self.monitorID = None
+        self.worker = None
+
+    def run(self):
+        """Start the monitoring"""
+
+        super(RemoteMonitor, self).run()
+        self.pool.startMonitor(self)
+
+    def stop(self):
+        """Stop the monitoring"""
+
+        super(RemoteMonitor, self).stop()
+        self.pool.stopMonitor(self)
+
+    def transition(self, up, reason=None):
+        """Called when the monitor in the worker has changed state"""
+
+        if up:
+            self._resultUp()
+        else:
+            self._resultDown(reason)
+
+
+def _encode(obj):
+    """
+    Returns a decoded JSON object with all unicode strings encoded to
+    str, as monitors expect their configuration values to be
+    """
+
+    if isinstance(obj, unicode):
+        return obj.encode('utf-8')
+    elif isinstance(obj, dict):
+        return dict((_encode(k), _encode(v)) for k, v in obj.iteritems())
+    elif isinstance(obj, list):
+        return [_encode(v) for v in obj]
+    return obj
+
+
+class WorkerService(object):
+    """The LVS service of a monitored server, as seen by a worker"""
+
+    def __init__(self, name, protocol, ip, port, configuration):
+        self.name = name
+        self.protocol = protocol
+        self.ip = ip
+        self.port = port
+        self.configuration = configuration
+
+
+class WorkerServer(object):
+    """A monitored server, as seen by a worker"""
+
+    def __init__(self, host, ip, port, weight, lvsservice,
+                 ip4_addresses=(), ip6_addresses=()):
+        self.host = host
+        self.ip = ip
+        self.port = port
+        self.weight = weight
+        self.lvsservice = lvsservice
+        # The resolved addresses of the server, as in the main process
+        self.ip4_addresses = set(ip4_addresses)
+        self.ip6_addresses = set(ip6_addresses)
+
+    def textStatus(self):
+        # The server state is kept by the main process
+        return "worker %d" % os.getpid()
+
+
+class WorkerControlProtocol(basic.LineReceiver):
+    """
+    The worker side of the connection to the main process. Runs the
+    monitors it is asked to, and acts as their coordinator.
+    """
+
+    delimiter = '\n'
+    MAX_LENGTH = 1 << 20
+
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.monitors = {}
+
+    def lineReceived(self, line):
+        try:
+            message = _encode(json.loads(line))
+            handler = getattr(self, 'do_' + message['op'])
+        except (ValueError, KeyError, TypeError, AttributeError):
+            log.warn("Invalid message from the main process: {!r}".format(line[:80]))
+            return
+        handler(message)
+
+    def do_configure(self, message):
+        # Apply the global check limits within this worker
+        from pybal.main import configureChecks
+        configuration = util.ConfigDict(message['configuration'])
+        configureChecks(configuration, self.reactor)
+        if configuration.getboolean('debug', False):
+            util.PyBalLogObserver.level = logging.DEBUG
+
+    def do_start(self, message):
+        monitorName = message['monitor']
+        configuration = util.ConfigDict(message['configuration'])
+        service = message['service']
+        lvsservice = WorkerService(configuration=configuration, **service)
+        server = WorkerServer(lvsservice=lvsservice, **message['server'])
+
+        monitor = None
+        try:
+            monitormodule = importlib.import_module(
+                "pybal.monitors.{}".format(monitorName.lower()))
+            monitorclass = getattr(monitormodule, monitorName + 'MonitoringProtocol')
+            monitor = monitorclass(self, server, configuration)
+            monitor.monitorID = message['id']
+            monitor.run()
+        except Exception:
+            log.err(None, "Could not start monitor {}".format(monitorName))
+            if monitor is not None and monitor.active:
+                monitor.stop()
+            self.sendResult(message['id'], False, "Could not start monitor in worker")
+            return
+
+        self.monitors[monitor.monitorID] = monitor
+
+    def do_stop(self, message):
+        monitor = self.monitors.pop(message['id'], None)
+        if monitor is not None and monitor.active:
+            monitor.stop()
+
+    def resultUp(self, monitor):
+        self.sendResult(monitor.monitorID, True)
+
+    def resultDown(self, monitor, reason=None):
+        self.sendResult(monitor.monitorID, False, reason)
+
+    def sendResult(self, monitorID, up, reason=None):
+        """Reports a monitor state transition to the main process"""
+
+        message = {'id': monitorID, 'up': up}
+        if not up:
+            message['reason'] = reason
+        self.sendLine(json.dumps(message))
+
+    def connectionLost(self, reason):
+        # The main process has gone away
+        for monitor in self.monitors.values():
+            if monitor.active:
+                monitor.stop()
+        self.monitors.clear()
+        try:
+            self.reactor.stop()
+        except error.ReactorNotRunning:
+            pass
+
+
+def main():
+    """Runs a monitor worker on stdin and stdout"""
+
+    from twisted.internet import reactor, stdio
+
+    stdio.StandardIO(WorkerControlProtocol(reactor), reactor=reactor)
+    reactor.run()